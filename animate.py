@@ -0,0 +1,98 @@
+"""
+Renders a keyframed animation to numbered frames.
+
+Every frame is rendered in one pool of worker processes, each of which
+imports the renderer, loads the textures and builds the scene (with
+its meshes' bounding volume hierarchies) once, then only re-poses the
+camera and objects from frame to frame. Frames are spread across the
+workers, one per core by default. See modules/raytracing/animation.py
+for the sequence file.
+
+To Run:
+    python3 animate.py turntable.json -o frames/frame%04d.png -w 4
+    ffmpeg -i frames/frame%04d.png turntable.mp4
+"""
+import os
+import io
+import time
+import argparse
+import contextlib
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+from render import FILE_EXTENSIONS
+from renderServer import warmUp, getTracer
+from modules.raytracing.animation import Sequence
+
+OUTPUT_PATTERN = "frames/frame%04d.png"
+
+
+def renderFrame(sequence, frame, path):
+    """Renders one frame of sequence with this process's tracer and
+       saves it to path.
+       Returns the seconds it took."""
+    import pygame
+    startTime = time.time()
+    with contextlib.redirect_stdout(io.StringIO()):
+        tracer = getTracer(sequence.scene, sequence.width,
+                           sequence.height, sequence.samples)
+        sequence.apply(tracer.scene, frame)
+        # Occluders remembered from the last frame may have moved
+        tracer.clearShadowCache()
+        # Seeded per frame, so a frame is the same whichever worker
+        # renders it and whatever it rendered before
+        tracer.random = np.random.default_rng(0)
+        tracer.restartRender()
+        for _ in tracer.render():
+            pass
+    pygame.image.save(tracer.image, path)
+    return time.time() - startTime
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("sequence", help="Sequence file")
+    parser.add_argument("-o", "--output",
+                        help="Frame file name, with a %%d for the number",
+                        default=OUTPUT_PATTERN)
+    parser.add_argument("-w", "--workers", help="Workers", type=int)
+    parser.add_argument("--start", help="First frame", type=int, default=0)
+    parser.add_argument("--end", help="Frame to stop before", type=int)
+    args = parser.parse_args()
+    if "%" not in args.output or \
+       os.path.splitext(args.output)[1] not in FILE_EXTENSIONS:
+        raise Exception("Output must have a %d for the frame number and "
+                        "end in \".jpg\" or \".png\".")
+    sequence = Sequence.load(args.sequence)
+    frames = range(args.start, sequence.frames if args.end is None
+                   else args.end)
+    os.makedirs(os.path.dirname(args.output) or ".", exist_ok=True)
+    workers = min(args.workers or os.cpu_count(), len(frames)) or 1
+    startTime = time.time()
+    print(f"Rendering {len(frames)} frames of {sequence.width}x"
+          f"{sequence.height} on {workers} workers")
+    if workers == 1:
+        # No pool to start, for profiling and debugging
+        warmUp()
+        results = ((frame, renderFrame(sequence, frame,
+                                       args.output % frame))
+                   for frame in frames)
+    else:
+        pool = ProcessPoolExecutor(workers, initializer=warmUp)
+        futures = {pool.submit(renderFrame, sequence, frame,
+                               args.output % frame): frame
+                   for frame in frames}
+        results = ((futures[future], future.result())
+                   for future in as_completed(futures))
+    for done, (frame, seconds) in enumerate(results, 1):
+        print(f"Frame {frame} in {seconds:.2f} seconds "
+              f"({done}/{len(frames)})")
+    if workers > 1:
+        pool.shutdown()
+    elapsed = time.time() - startTime
+    print(f"Rendered {len(frames)} frames in {elapsed:.2f} seconds, "
+          f"{len(frames) / elapsed:.2f} frames per second")
+
+
+if __name__ == "__main__":
+    main()
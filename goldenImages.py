@@ -0,0 +1,430 @@
+"""
+Golden image regression harness.
+
+Renders canonical scenes at a small size through each renderer and
+shading mode, and compares them with the reference images stored in
+golden/. A case fails if too many pixels differ by more than the
+tolerance, or if its PSNR drops below the threshold. Render times are
+printed next to the times the references took, so optimizations can
+show both that they are faster and that they did not change the image.
+
+To Run:
+    python3 goldenImages.py
+    python3 goldenImages.py --update
+    python3 goldenImages.py default-quilt objects-light-tree
+    python3 goldenImages.py --roulette
+    python3 goldenImages.py --incremental
+"""
+import os
+import io
+import sys
+import json
+import time
+import queue
+import argparse
+import tempfile
+import contextlib
+import numpy as np
+
+os.environ.setdefault("SDL_VIDEODRIVER", "dummy")
+import pygame  # noqa: E402
+
+pygame.init()
+
+from render import ShowTypes  # noqa: E402
+from rayTracer import RayTracer  # noqa: E402
+from quilt import QuiltRenderer, readChunkRows  # noqa: E402
+from modules.raytracing.scene import Scene, LIGHT_POSITION  # noqa: E402
+from modules.raytracing.spherical import Sphere  # noqa: E402
+from modules.raytracing.materials import Material  # noqa: E402
+from modules.utils.vector import vec, rotationMatrix  # noqa: E402
+from modules.utils.definitions import COLORS  # noqa: E402
+
+GOLDEN_FOLDER = "golden"
+TIMES_FILE = "times.json"
+WIDTH = 64
+HEIGHT = 48
+# Channel difference out of 255 a pixel may have and still match
+TOLERANCE = 4
+# Fraction of pixels allowed beyond the tolerance
+MAX_BAD_PIXELS = 0.002
+MIN_PSNR = 40
+QUILT_CHUNK_SIZE = 20
+# Cases that must reproduce another case's reference
+SHARED_REFERENCES = {"default-relight": "default"}
+# Russian roulette check: size, ray threshold and seeds averaged
+ROULETTE_WIDTH = 32
+ROULETTE_HEIGHT = 24
+ROULETTE_THRESHOLD = 2
+ROULETTE_RUNS = 16
+# Incremental check: default scene objects moved, by index and offset
+INCREMENTAL_MOVES = {"sphere": (7, vec(0.3, 0.2, 0)),
+                     "cube": (6, vec(0, 0.8, 0))}
+
+
+class ObjectsScene(Scene):
+    """Canonical scene of the newer primitives: a rotated ellipsoid,
+       instanced spheres, a mesh, and several colored point lights."""
+    def __init__(self, meshFile, **kwargs):
+        self.meshFile = meshFile
+        super().__init__(**kwargs)
+
+    def setup(self):
+        for color, offset in ((vec(1, 1, 1), vec(0, 0, 0)),
+                              (vec(0.8, 0.3, 0.3), vec(3, 0, 0)),
+                              (vec(0.3, 0.3, 0.8), vec(-3, 1, 1)),
+                              (vec(0.3, 0.8, 0.3), vec(0, 2, -4))):
+            self.addPointLight(color=color,
+                               position=LIGHT_POSITION + offset)
+        self.addPlane(normal=vec(0, 1, 0),
+                      position=vec(0, -1, 0),
+                      color=COLORS["gray"],
+                      ambient=vec(0.3, 0.3, 0.3),
+                      diffuse=vec(0.7, 0.7, 0.7),
+                      specular=vec(1, 1, 1),
+                      shininess=5,
+                      specCoeff=0.1,
+                      refractiveIndex=1)
+        self.addEllipsoid(a=0.3, b=0.6, c=0.3,
+                          position=vec(-1, 0, -2.5),
+                          color=vec(1, 0.5, 0),
+                          ambient=vec(0.3, 0.15, 0),
+                          diffuse=vec(0.6, 0.3, 0),
+                          specular=vec(1, 1, 1),
+                          shininess=50,
+                          specCoeff=1,
+                          refractiveIndex=1,
+                          rotation=rotationMatrix(vec(0, 0, 1),
+                                                  np.radians(40)))
+        self.addMesh(self.meshFile, scale=0.4,
+                     position=vec(0, -0.2, -2),
+                     color=vec(0.2, 0.8, 0.8),
+                     ambient=vec(0.1, 0.3, 0.3),
+                     diffuse=vec(0.2, 0.6, 0.6),
+                     specular=vec(1, 1, 1),
+                     shininess=20,
+                     specCoeff=0.5,
+                     refractiveIndex=1)
+        group = self.addInstanceGroup()
+        sphere = group.addGeometry(Sphere(1, vec(0, 0, 0), COLORS["white"],
+                                          COLORS["white"], COLORS["black"],
+                                          COLORS["white"], 0, 100, 0,
+                                          None, 1, None))
+        material = group.addMaterial(Material(vec(0.8, 0.2, 0.8),
+                                              vec(0.3, 0.1, 0.3),
+                                              vec(0.6, 0.2, 0.6),
+                                              vec(1, 1, 1), 30, 0.5))
+        for i in range(5):
+            group.addInstance(sphere, material,
+                              vec(1.2 - i * 0.1, -0.8 + i * 0.3, -1.5 - i),
+                              scale=(0.2, 0.2, 0.15))
+
+
+def writeOctahedron(path):
+    """Writes a small OBJ mesh to path."""
+    with open(path, "w") as file:
+        for vertex in ((1, 0, 0), (-1, 0, 0), (0, 1, 0),
+                       (0, -1, 0), (0, 0, 1), (0, 0, -1)):
+            file.write("v %d %d %d\n" % vertex)
+        for face in ((1, 3, 5), (3, 2, 5), (2, 4, 5), (4, 1, 5),
+                     (3, 1, 6), (2, 3, 6), (4, 2, 6), (1, 4, 6)):
+            file.write("f %d %d %d\n" % face)
+
+
+def makeTracer(scene, samples=1):
+    """Returns a tracer that renders scene without showing it."""
+    with contextlib.redirect_stdout(io.StringIO()):
+        tracer = RayTracer(WIDTH, HEIGHT, show=ShowTypes.NoShow,
+                           samplePerPixel=samples, scene=scene)
+        tracer.startPygame("Golden Images")
+    return tracer
+
+
+def renderProgressive(tracer):
+    """Renders with the progressive renderer's passes."""
+    with contextlib.redirect_stdout(io.StringIO()):
+        for _ in tracer.render():
+            pass
+    return tracer.pixels.copy()
+
+
+def renderRelit(tracer):
+    """Renders with a G-buffer and relights it with nothing changed,
+       which must give back the frame that was traced."""
+    tracer.enableGBuffer()
+    renderProgressive(tracer)
+    with contextlib.redirect_stdout(io.StringIO()):
+        tracer.relight()
+    return tracer.pixels.copy()
+
+
+class TracerQuilt(QuiltRenderer):
+    """Quilt renderer tracing each pixel with a RayTracer."""
+    def __init__(self, tracer, file):
+        self.tracer = tracer
+        super().__init__(tracer.width, tracer.height,
+                         chunkSize=QUILT_CHUNK_SIZE,
+                         displayUpdates=False,
+                         file=file)
+
+    def getColor(self, x, y, samplePerPixel=1):
+        return self.tracer.getColor(x, y, samplePerPixel)
+
+
+def renderQuilt(tracer):
+    """Renders chunk by chunk with the quilt renderer, in a scratch
+       folder, and joins the chunks back together."""
+    cwd = os.getcwd()
+    with tempfile.TemporaryDirectory() as folder, \
+            contextlib.redirect_stdout(io.StringIO()):
+        os.chdir(folder)
+        try:
+            quilt = TracerQuilt(tracer, "golden")
+            quilt.startPygame("Golden Images")
+            quilt.render()
+            rows = list(readChunkRows(quilt.quiltFolder, tracer.width))
+        finally:
+            os.chdir(cwd)
+    return np.concatenate(rows, axis=1)
+
+
+def renderServerJob(tracer):
+    """Renders the default scene as a render server job would, in this
+       process, and decodes the png it sends back."""
+    import renderServer
+    params = {"width": WIDTH, "height": HEIGHT, "samples": 1}
+    with contextlib.redirect_stdout(io.StringIO()):
+        image = renderServer.renderJob(1, params, queue.Queue(), {})
+    return pygame.surfarray.array3d(pygame.image.load(io.BytesIO(image)))
+
+
+def getCases(meshFile):
+    """Returns {name: (make tracer, render)} for every case. Making
+       the tracer is not timed."""
+    def default():
+        return Scene(aspect=WIDTH/HEIGHT, fov=45)
+
+    def objects():
+        return ObjectsScene(meshFile, aspect=WIDTH/HEIGHT, fov=45)
+
+    def accumulating():
+        tracer = makeTracer(default(), samples=2)
+        tracer.accumulate = True
+        return tracer
+
+    def lightSamples(count):
+        def make():
+            tracer = makeTracer(objects())
+            tracer.lightSamples = count
+            return tracer
+        return make
+
+    def hilbert():
+        tracer = makeTracer(default())
+        tracer.setTraversal("hilbert")
+        return tracer
+
+    def denoised():
+        tracer = makeTracer(default())
+        tracer.enableDenoiser()
+        return tracer
+
+    return {"default": (lambda: makeTracer(default()), renderProgressive),
+            "default-hilbert": (hilbert, renderProgressive),
+            "default-accumulate": (accumulating, renderProgressive),
+            "default-quilt": (lambda: makeTracer(default()), renderQuilt),
+            "default-server": (lambda: None, renderServerJob),
+            "default-denoise": (denoised, renderProgressive),
+            "default-relight": (lambda: makeTracer(default()), renderRelit),
+            "objects": (lambda: makeTracer(objects()), renderProgressive),
+            "objects-all-lights": (lightSamples(0), renderProgressive),
+            "objects-light-tree": (lightSamples(1), renderProgressive)}
+
+
+def compare(image, reference):
+    """Returns the largest channel difference, the fraction of pixels
+       beyond the tolerance and the PSNR of image against reference."""
+    difference = np.abs(image.astype(int) - reference.astype(int))
+    bad = np.mean(difference.max(axis=2) > TOLERANCE)
+    meanSquare = np.mean(difference.astype(float) ** 2)
+    psnr = np.inf if meanSquare == 0 else \
+        10 * np.log10(255 ** 2 / meanSquare)
+    return difference.max(), bad, psnr
+
+
+def meanColor(tracer):
+    """Returns the mean color of every pixel traced by tracer, before
+       it is rounded to the image."""
+    return np.mean([tracer.getColor(x, y) for x in range(tracer.width)
+                    for y in range(tracer.height)], axis=0)
+
+
+def checkRoulette():
+    """Compares the mean color of the default scene traced in full
+       with dropping rays below a threshold and with Russian roulette
+       averaged over many seeds. Roulette keeps the expected weight of
+       each ray, but the colors it scales are normalized once blended,
+       so it is only close to unbiased. Fails if it strays further than
+       dropping the rays does."""
+    with contextlib.redirect_stdout(io.StringIO()):
+        tracer = RayTracer(ROULETTE_WIDTH, ROULETTE_HEIGHT,
+                           show=ShowTypes.NoShow,
+                           scene=Scene(aspect=ROULETTE_WIDTH /
+                                       ROULETTE_HEIGHT, fov=45))
+    full = meanColor(tracer)
+    tracer.rayThreshold = ROULETTE_THRESHOLD
+    dropped = meanColor(tracer)
+    tracer.roulette = True
+    runs = []
+    for seed in range(ROULETTE_RUNS):
+        tracer.random = np.random.default_rng(seed)
+        runs.append(meanColor(tracer))
+    rouletted = np.mean(runs, axis=0)
+    dropError = np.abs(dropped - full).max()
+    rouletteError = np.abs(rouletted - full).max()
+    print(f"full      {np.round(full, 6)}")
+    print(f"dropped   {np.round(dropped, 6)} off by {dropError:.2e}")
+    print(f"roulette  {np.round(rouletted, 6)} off by {rouletteError:.2e} "
+          f"over {ROULETTE_RUNS} seeds")
+    if rouletteError > dropError:
+        print("Roulette strays further than dropping rays.")
+        sys.exit(1)
+
+
+def renderMoved(tracer, index, offset, incremental):
+    """Moves an object of the tracer's scene by offset and returns the
+       image, either re-traced in full or updated from the ray log of a
+       render before the move."""
+    obj = tracer.scene.objects[index]
+    if incremental:
+        tracer.enableRayLog()
+        renderProgressive(tracer)
+    obj.setPosition(obj.getPosition() + offset)
+    if not incremental:
+        return renderProgressive(tracer)
+    with contextlib.redirect_stdout(io.StringIO()):
+        tracer.applySceneDiff()
+    return tracer.pixels.copy()
+
+
+def checkIncremental():
+    """Moves a sphere and a cube of the default scene and compares the
+       incrementally updated image with a full render of the moved
+       scene, traced directly and accumulated. Fails if they differ."""
+    failed = False
+    for accumulate in (False, True):
+        for name, (index, offset) in INCREMENTAL_MOVES.items():
+            images = []
+            for incremental in (False, True):
+                tracer = makeTracer(Scene(aspect=WIDTH/HEIGHT, fov=45),
+                                    samples=2 if accumulate else 1)
+                tracer.accumulate = accumulate
+                images.append(renderMoved(tracer, index, offset,
+                                          incremental))
+            largest, bad, psnr = compare(*images)
+            passed = bad <= MAX_BAD_PIXELS and psnr >= MIN_PSNR
+            failed = failed or not passed
+            mode = "accumulated" if accumulate else "direct"
+            print(f"{name:7} {mode:12} {largest:4} {bad:7.2%} {psnr:6.1f}"
+                  f"{'' if passed else '  FAILED'}")
+    if failed:
+        print("Incremental updates differ from full renders.")
+        sys.exit(1)
+
+
+def saveImage(image, path):
+    pygame.image.save(pygame.surfarray.make_surface(image), path)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("cases", nargs="*", help="Cases to run, or all")
+    parser.add_argument("--update", help="Replace the reference images",
+                        action="store_true")
+    parser.add_argument("--list", help="List the cases",
+                        action="store_true")
+    parser.add_argument("--roulette",
+                        help="Check Russian roulette against the full "
+                             "render instead",
+                        action="store_true")
+    parser.add_argument("--incremental",
+                        help="Check incremental re-rendering of moved "
+                             "objects against full renders instead",
+                        action="store_true")
+    args = parser.parse_args()
+    if args.roulette:
+        checkRoulette()
+        return
+    if args.incremental:
+        checkIncremental()
+        return
+    os.makedirs(GOLDEN_FOLDER, exist_ok=True)
+    timesPath = os.path.join(GOLDEN_FOLDER, TIMES_FILE)
+    times = {}
+    if os.path.isfile(timesPath):
+        with open(timesPath) as file:
+            times = json.load(file)
+    with tempfile.TemporaryDirectory() as meshFolder:
+        meshFile = os.path.join(meshFolder, "octahedron.obj")
+        writeOctahedron(meshFile)
+        cases = getCases(meshFile)
+        if args.list:
+            print("\n".join(cases))
+            return
+        names = args.cases or list(cases)
+        unknown = [name for name in names if name not in cases]
+        if unknown:
+            raise Exception(f"Unknown cases {', '.join(unknown)}.")
+        failed = []
+        print(f"{'case':20} {'max':>4} {'bad':>7} {'PSNR':>6} "
+              f"{'seconds':>8} {'reference':>9}")
+        for name in names:
+            make, render = cases[name]
+            tracer = make()
+            startTime = time.time()
+            image = render(tracer)
+            seconds = time.time() - startTime
+            path = os.path.join(GOLDEN_FOLDER,
+                                SHARED_REFERENCES.get(name, name) + ".png")
+            if args.update and name in SHARED_REFERENCES:
+                times[name] = round(seconds, 4)
+                print(f"{name:20} {'shares':>20} "
+                      f"{SHARED_REFERENCES[name]}")
+                continue
+            if args.update:
+                saveImage(image, path)
+                times[name] = round(seconds, 4)
+                print(f"{name:20} {'updated':>20} {seconds:8.3f}")
+                continue
+            if not os.path.isfile(path):
+                print(f"{name:20} no reference, run with --update")
+                failed.append(name)
+                continue
+            reference = pygame.surfarray.array3d(pygame.image.load(path))
+            largest, bad, psnr = compare(image, reference)
+            passed = bad <= MAX_BAD_PIXELS and psnr >= MIN_PSNR
+            print(f"{name:20} {largest:4} {bad:7.2%} {psnr:6.1f} "
+                  f"{seconds:8.3f} {times.get(name, np.nan):9.3f}"
+                  f"{'' if passed else '  FAILED'}")
+            if not passed:
+                failed.append(name)
+                # Kept for a look at what changed
+                failures = os.path.join(GOLDEN_FOLDER, "failures")
+                os.makedirs(failures, exist_ok=True)
+                saveImage(image, os.path.join(failures, name + ".png"))
+                difference = np.abs(image.astype(int) - reference)
+                saveImage(np.clip(difference * 8, 0, 255).astype(np.uint8),
+                          os.path.join(failures, name + "_diff.png"))
+    if args.update:
+        with open(timesPath, "w") as file:
+            json.dump(times, file, indent=4, sort_keys=True)
+    elif failed:
+        print(f"{len(failed)} of {len(names)} cases failed: "
+              f"{', '.join(failed)}")
+        sys.exit(1)
+    else:
+        print(f"All {len(names)} cases match.")
+
+
+if __name__ == "__main__":
+    main()
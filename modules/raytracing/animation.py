@@ -0,0 +1,109 @@
+"""
+Keyframed animation of a scene's camera and objects.
+A sequence is read from JSON, for example:
+
+    {"scene": "modules.raytracing.scene:Scene",
+     "width": 160, "height": 120, "samples": 1,
+     "frames": 48, "ease": "smooth",
+     "camera": [{"frame": 0, "direction": [0, 0, -1]},
+                {"frame": 24, "direction": [-1, 0, 0], "fov": 40},
+                {"frame": 47, "direction": [0, 0, 1]}],
+     "objects": {"7": [{"frame": 0, "position": [0, 0, -3]},
+                       {"frame": 47, "position": [0, 1, -3]}]}}
+
+Each camera setting (focus, direction, up, fov and distance, as given
+to Camera.set) and each object position is interpolated between the
+keyframes that give it, and held before the first and after the last.
+Directions turn along the arc between keyframes, so an orbit keeps
+its distance. Settings no keyframe gives keep the scene's own value.
+Objects are keyed by their index in the scene's objects.
+"""
+import json
+import numpy as np
+
+from ..utils.vector import vec, lerp, slerp, smerp
+
+CAMERA_SETTINGS = ("focus", "direction", "up", "fov", "distance")
+VECTOR_SETTINGS = ("focus", "direction", "up", "position")
+EASES = ("linear", "smooth")
+
+
+def interpolate(keyframes, setting, frame, ease="linear"):
+    """Returns the value of setting at frame, from the keyframes that
+       give it, or None if none do."""
+    keys = [key for key in keyframes if setting in key]
+    if not keys:
+        return None
+    if frame <= keys[0]["frame"]:
+        return keys[0][setting]
+    for before, after in zip(keys, keys[1:]):
+        if frame <= after["frame"]:
+            percent = (frame - before["frame"]) / \
+                (after["frame"] - before["frame"])
+            if ease == "smooth":
+                percent = smerp(0.0, 1.0, percent)
+            if setting == "direction":
+                return slerp(before[setting], after[setting], percent)
+            return lerp(before[setting], after[setting], percent)
+    return keys[-1][setting]
+
+
+def readKeyframes(keyframes, settings):
+    """Returns keyframes sorted by frame, with vectors as arrays,
+       checking that they only give the settings allowed."""
+    result = []
+    for key in keyframes:
+        unknown = set(key) - set(settings) - {"frame"}
+        if "frame" not in key or unknown:
+            raise Exception(f"Keyframe {key} needs a frame and can only "
+                            f"set {', '.join(settings)}.")
+        result.append({name: vec(value) if name in VECTOR_SETTINGS
+                       else value for name, value in key.items()})
+    result.sort(key=lambda key: key["frame"])
+    frames = [key["frame"] for key in result]
+    if len(set(frames)) != len(frames):
+        raise Exception(f"Two keyframes share a frame in {frames}.")
+    return result
+
+
+class Sequence(object):
+    """The render settings and keyframes of an animation."""
+    def __init__(self, frames, scene="modules.raytracing.scene:Scene",
+                 width=160, height=120, samples=1, ease="linear",
+                 camera=(), objects=None):
+        if ease not in EASES:
+            raise Exception(f"Ease must be one of {', '.join(EASES)}.")
+        self.frames = frames
+        self.scene = scene
+        self.width = width
+        self.height = height
+        self.samples = samples
+        self.ease = ease
+        self.camera = readKeyframes(camera, CAMERA_SETTINGS)
+        self.objects = {int(index): readKeyframes(keyframes, ("position",))
+                        for index, keyframes in (objects or {}).items()}
+
+    @classmethod
+    def load(cls, path):
+        """Reads a sequence from a JSON file."""
+        with open(path) as file:
+            return cls(**json.load(file))
+
+    def apply(self, scene, frame):
+        """Poses the camera and objects of scene for frame."""
+        camera = scene.camera
+        current = {"focus": camera.focus, "direction": camera.direction,
+                   "up": camera.worldUp, "fov": camera.fov,
+                   "distance": camera.distance}
+        for setting in CAMERA_SETTINGS:
+            value = interpolate(self.camera, setting, frame, self.ease)
+            if value is not None:
+                current[setting] = value
+        camera.set(current["focus"], current["direction"], current["up"],
+                   current["fov"], current["distance"], camera.aspect)
+        for index, keyframes in self.objects.items():
+            position = interpolate(keyframes, "position", frame, self.ease)
+            # Cubes rebuild their sides when moved, so only move on change
+            if position is not None and not np.array_equal(
+                    position, scene.objects[index].getPosition()):
+                scene.objects[index].setPosition(position)
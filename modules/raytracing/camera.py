@@ -3,7 +3,7 @@ Author: Liz Matthews, Geoff Matthews
 """
 import numpy as np
 
-from ..utils.vector import vec, lerp, normalize
+from ..utils.vector import vec, lerp, normalize, rotationMatrix
 from .ray import Ray
 
 
@@ -23,6 +23,14 @@ class Camera(object):
             aspect=4/3):
         """Sets up the camera given the parameters.
            Calculates position, ul, ur, ll, and lr."""
+        # Kept as given so the camera can be set again after moving,
+        # the length of fwd scales the distance to the focus
+        self.focus = focus
+        self.direction = fwd
+        self.worldUp = up
+        self.fov = fov
+        self.distance = distance
+        self.aspect = aspect
         # 08 Slides, Slide 17
         self.fwd = normalize(fwd)
         self.up = normalize(up)
@@ -61,7 +69,8 @@ class Camera(object):
         p0 = lerp(self.ul, self.ur, xPercent)
         p1 = lerp(self.ll, self.lr, xPercent)
         worldPos = lerp(p0, p1, yPercent)
-        return Ray(self.position, worldPos - self.position)
+        return Ray.trusted(self.position,
+                           normalize(vec(worldPos - self.position)))
 
     def getPosition(self):
         """Getter method for position."""
@@ -76,3 +85,37 @@ class Camera(object):
     def getForward(self):
         """Getter method for position."""
         return self.fwd
+
+    def getUp(self):
+        """Getter method for the up vector."""
+        return self.up
+
+    def getRight(self):
+        """Getter method for the right vector."""
+        return self.right
+
+    def getFocus(self):
+        """Getter method for the point the camera looks at."""
+        return self.focus
+
+    def move(self, offset):
+        """Moves the camera and its focus by offset."""
+        self.set(self.focus + offset, self.direction, self.worldUp,
+                 self.fov, self.distance, self.aspect)
+
+    def orbit(self, yaw, pitch):
+        """Turns the camera around its focus, yaw radians around the up
+           it was set with, then pitch radians around its new right vector.
+           Pitching stops short of looking straight up or down."""
+        direction = rotationMatrix(self.worldUp, yaw) @ self.direction
+        right = np.cross(direction, self.worldUp)
+        pitched = rotationMatrix(right, pitch) @ direction
+        if abs(np.dot(normalize(pitched), normalize(self.worldUp))) < 0.99:
+            direction = pitched
+        self.set(self.focus, direction, self.worldUp,
+                 self.fov, self.distance, self.aspect)
+
+    def zoom(self, factor):
+        """Moves the camera factor times as far from its focus."""
+        self.set(self.focus, self.direction, self.worldUp,
+                 self.fov, self.distance * factor, self.aspect)
@@ -0,0 +1,87 @@
+"""
+Geometry buffer captured from primary visibility.
+Holds everything about the first hit of each pixel that does not
+depend on the lights, so the image can be relit without re-tracing.
+"""
+import numpy as np
+
+# Every per-pixel array, by attribute name
+ARRAYS = ("objectId", "distance", "position", "normal", "uv", "materialId",
+          "surfaceColor", "viewDirection", "secondary")
+
+
+class GBuffer(object):
+    """Per-pixel primary hit information.
+       Contains hit object ID, distance, position, normal, UV,
+       material ID, the unlit surface color and the view direction.
+       Also marks pixels whose surface color includes reflections
+       or refractions, which depend on the lights elsewhere.
+       Pixels whose primary ray hit nothing have an object ID of -1."""
+    def __init__(self, width, height):
+        self.width = width
+        self.height = height
+        self.objectId = np.full((width, height), -1, dtype=np.int32)
+        self.distance = np.full((width, height), np.inf, dtype=np.float32)
+        self.position = np.zeros((width, height, 3), dtype=np.float32)
+        self.normal = np.zeros((width, height, 3), dtype=np.float32)
+        self.uv = np.full((width, height, 2), np.nan, dtype=np.float32)
+        self.materialId = np.full((width, height), -1, dtype=np.int32)
+        self.surfaceColor = np.zeros((width, height, 3), dtype=np.float32)
+        self.viewDirection = np.zeros((width, height, 3), dtype=np.float32)
+        self.secondary = np.zeros((width, height), dtype=bool)
+        self.materials = []
+
+    def crop(self, x0, y0, x1, y1):
+        """Returns a GBuffer viewing the pixels from (x0, y0) up to
+           (x1, y1), sharing this one's arrays and materials."""
+        cropped = GBuffer.__new__(GBuffer)
+        cropped.width = x1 - x0
+        cropped.height = y1 - y0
+        for name in ARRAYS:
+            setattr(cropped, name, getattr(self, name)[x0:x1, y0:y1])
+        cropped.materials = self.materials
+        return cropped
+
+    def getArrays(self, materials):
+        """Returns every per-pixel array by name, and the materials as
+           their index in materials, so the buffer can be saved."""
+        arrays = {name: getattr(self, name) for name in ARRAYS}
+        arrays["materials"] = [
+            next(i for i, known in enumerate(materials) if known is material)
+            for material in self.materials]
+        return arrays
+
+    def setArrays(self, arrays, materials):
+        """Restores the buffer from arrays given by getArrays with the
+           same materials."""
+        for name in ARRAYS:
+            getattr(self, name)[:] = arrays[name]
+        self.materials = [materials[i] for i in arrays["materials"]]
+
+    def getMaterialId(self, material):
+        """Returns the ID of material, assigning a new one if unseen."""
+        for i, known in enumerate(self.materials):
+            if known is material:
+                return i
+        self.materials.append(material)
+        return len(self.materials) - 1
+
+    def clear(self, pixel):
+        """Marks pixel as hitting nothing."""
+        self.objectId[pixel] = -1
+        self.materialId[pixel] = -1
+        self.distance[pixel] = np.inf
+        self.secondary[pixel] = False
+
+    def store(self, pixel, objectId, distance, position, normal, uv,
+              material, surfaceColor, viewDirection, secondary):
+        """Records the primary hit of pixel."""
+        self.objectId[pixel] = objectId
+        self.distance[pixel] = distance
+        self.position[pixel] = position
+        self.normal[pixel] = normal
+        self.uv[pixel] = uv
+        self.materialId[pixel] = self.getMaterialId(material)
+        self.surfaceColor[pixel] = surfaceColor
+        self.viewDirection[pixel] = viewDirection
+        self.secondary[pixel] = secondary
@@ -0,0 +1,22 @@
+"""
+Hit records returned by the intersection routines.
+"""
+from collections import namedtuple
+
+import numpy as np
+
+# Texture coordinates of objects without a mapping
+NO_UV = (np.nan, np.nan)
+
+
+class Hit(namedtuple("Hit", ("distance", "point", "normal",
+                             "obj", "face", "uv"))):
+    """Everything about where a ray hit an object, worked out once by
+       the object from what its intersection test already had.
+       Contains the distance along the ray, the point hit, the unit
+       normal there and the object hit.
+       Contains the face hit (a cube side, a mesh triangle) or None,
+       and the (u, v) texture coordinates, NaNs if there are none.
+       Immutable, so objects keep no per-ray state and can be shared
+       between threads."""
+    __slots__ = ()
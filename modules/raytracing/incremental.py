@@ -0,0 +1,122 @@
+"""
+Bookkeeping for incremental re-rendering.
+Remembers every ray segment traced for each pixel so that a scene
+change only needs to re-trace the pixels it could have affected.
+"""
+import numpy as np
+
+# Rays end exactly on the surface they hit, so pad bounds against float error
+BOUNDS_SLACK = 1e-3
+
+
+class SceneDiff(object):
+    """The difference between two states of a scene.
+       Contains the (center, radius) bounds touched by changed objects,
+       both where they were and where they are now.
+       Contains whether any light was added, removed, or edited."""
+    def __init__(self, bounds=None, lightsChanged=False):
+        self.bounds = bounds if bounds is not None else []
+        self.lightsChanged = lightsChanged
+
+    def isEmpty(self):
+        """Returns True if nothing in the scene changed."""
+        return not self.bounds and not self.lightsChanged
+
+    def __repr__(self):
+        return f"SceneDiff: {len(self.bounds)} bounds, " + \
+            f"lights changed: {self.lightsChanged}"
+
+
+class RayLog(object):
+    """Per-pixel record of the ray tree behind each pixel.
+       Every primary, shadow and secondary ray is stored as a segment
+       (origin, direction, length) under the pixel that spawned it."""
+    def __init__(self):
+        self.segments = {}
+        self.current = None
+        self.arrays = None
+
+    def begin(self, pixel):
+        """Starts a fresh record for pixel, replacing any older one."""
+        self.current = []
+        self.segments[pixel] = self.current
+        self.arrays = None
+
+    def resume(self, pixel):
+        """Continues the record of pixel, for another sample of it."""
+        self.current = self.segments.setdefault(pixel, [])
+        self.arrays = None
+
+    def record(self, ray, length):
+        """Records a ray that travelled length before stopping.
+           Rays that escaped the scene have an infinite length."""
+        if self.current is not None:
+            self.current.append((ray.position, ray.direction, length))
+
+    def recordSegment(self, start, end):
+        """Records the straight segment a ray took from start to end,
+           such as through the inside of a refracting object."""
+        offset = np.asarray(end, dtype=float) - start
+        length = np.linalg.norm(offset)
+        if self.current is not None and length > 0:
+            self.current.append((start, offset / length, length))
+
+    def end(self):
+        """Stops recording for the current pixel."""
+        self.current = None
+
+    def getPixels(self):
+        """Returns every pixel with a record."""
+        return self.segments.keys()
+
+    def hasHit(self, pixel):
+        """Returns True if any ray of the pixel hit an object."""
+        return any(np.isfinite(length)
+                   for _, _, length in self.segments.get(pixel, ()))
+
+    def getArrays(self):
+        """Returns the segments packed into numpy arrays, rebuilt lazily
+           only when records have changed since the last query."""
+        if self.arrays is None:
+            pixels = []
+            origins = []
+            directions = []
+            lengths = []
+            for pixel, segments in self.segments.items():
+                for origin, direction, length in segments:
+                    pixels.append(pixel)
+                    origins.append(origin)
+                    directions.append(direction)
+                    lengths.append(length)
+            self.arrays = (pixels,
+                           np.array(origins, dtype=float).reshape(-1, 3),
+                           np.array(directions, dtype=float).reshape(-1, 3),
+                           np.array(lengths, dtype=float))
+        return self.arrays
+
+    def pixelsTouching(self, center, radius):
+        """Returns the set of pixels that have a segment passing
+           within radius of center."""
+        pixels, origins, directions, lengths = self.getArrays()
+        if not np.isfinite(radius):
+            return set(pixels)
+        # Closest point on each segment to the center
+        toCenter = center - origins
+        t = np.clip(np.einsum("ij,ij->i", toCenter, directions),
+                    0, lengths)
+        closest = origins + directions * t[:, np.newaxis]
+        distanceSquared = np.einsum("ij,ij->i",
+                                    closest - center,
+                                    closest - center)
+        return {pixels[i] for i in np.nonzero(
+            distanceSquared <= (radius + BOUNDS_SLACK) ** 2)[0]}
+
+    def pixelsAffectedBy(self, diff):
+        """Returns the set of pixels that must be re-traced for diff."""
+        affected = set()
+        for center, radius in diff.bounds:
+            affected |= self.pixelsTouching(center, radius)
+        if diff.lightsChanged:
+            affected |= {pixel for pixel in self.segments
+                         if self.hasHit(pixel)}
+        return affected
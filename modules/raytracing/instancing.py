@@ -0,0 +1,242 @@
+"""
+Geometry instancing.
+Many copies of the same object share one geometry and one material,
+and only differ by a transform kept in a packed array. Rays are moved
+into each instance's object space instead of copying the geometry
+into world space.
+"""
+import numpy as np
+
+from .objects import Object3D
+from .ray import Ray
+from .hit import Hit
+from ..utils.vector import normalize
+
+
+class InstanceGroup(Object3D):
+    """Holds shared geometries, shared materials, and the instances
+       that place them in the scene. Instances refer to geometries and
+       materials by the IDs returned when adding them.
+       Geometries are ordinary objects centered on the origin; their
+       own materials are ignored."""
+    def __init__(self):
+        self.position = np.zeros(3)
+        self.geometries = []
+        self.materials = []
+        self.geometryIds = []
+        self.materialIds = []
+        self.transforms = []
+        self.packed = None
+
+    def getMaterial(self):
+        """Returns the material of the first instance, if any."""
+        return self.materials[self.materialIds[0]] \
+            if self.materialIds else None
+
+    def addGeometry(self, geometry):
+        """Adds a shared geometry and returns its ID."""
+        self.geometries.append(geometry)
+        self.packed = None
+        return len(self.geometries) - 1
+
+    def addMaterial(self, material):
+        """Adds a shared material and returns its ID."""
+        self.materials.append(material)
+        return len(self.materials) - 1
+
+    def addInstance(self, geometryId, materialId, position,
+                    scale=1, rotation=None):
+        """Places a copy of a geometry, scaled (uniformly or per axis),
+           then rotated by a 3x3 matrix, then moved to position.
+           Returns the instance ID."""
+        linear = np.eye(3) * scale
+        if rotation is not None:
+            linear = np.asarray(rotation, dtype=float) @ linear
+        self.geometryIds.append(geometryId)
+        self.materialIds.append(materialId)
+        self.transforms.append(np.column_stack((linear, position)))
+        self.packed = None
+        return len(self.transforms) - 1
+
+    def pack(self):
+        """Packs the instances into arrays of world-to-object transforms
+           and world bounding spheres, after instances are added."""
+        transforms = np.array(self.transforms, dtype=float).reshape(-1, 3, 4)
+        linear = transforms[:, :, :3]
+        inverseLinear = np.linalg.inv(linear)
+        inverses = np.concatenate(
+            (inverseLinear,
+             -inverseLinear @ transforms[:, :, 3:]), axis=2)
+        geometryIds = np.array(self.geometryIds, dtype=np.int32)
+        centers = np.empty((len(self.geometries), 3))
+        radii = np.empty(len(self.geometries))
+        for i, geometry in enumerate(self.geometries):
+            centers[i], radii[i] = geometry.getBoundingSphere()
+        worldCenters = np.einsum("kij,kj->ki", linear,
+                                 centers[geometryIds]) + transforms[:, :, 3]
+        # The largest stretch of each transform bounds its radius
+        stretch = np.linalg.norm(linear, ord=2, axis=(1, 2))
+        self.packed = (geometryIds, inverses, worldCenters,
+                       radii[geometryIds] * stretch, stretch)
+        return self.packed
+
+    def getCandidates(self, ray):
+        """Returns the instances whose bounding spheres the ray crosses,
+           nearest first, with the distance the ray enters each."""
+        _, _, centers, radii, _ = \
+            self.packed if self.packed is not None else self.pack()
+        toCenter = centers - ray.position
+        middle = toCenter @ ray.direction
+        with np.errstate(invalid="ignore"):
+            halfChord = np.sqrt(radii ** 2 -
+                                np.einsum("ij,ij->i", toCenter, toCenter) +
+                                middle ** 2)
+        candidates = np.nonzero(middle + halfChord >= 0)[0]
+        enters = np.maximum(middle - halfChord, 0)[candidates]
+        order = np.argsort(enters, kind="stable")
+        return zip(candidates[order], enters[order])
+
+    def toObjectSpace(self, ray, instance):
+        """Returns ray moved into the object space of an instance, and
+           how much longer a unit of distance is there than in world
+           space."""
+        inverse = self.packed[1][instance]
+        direction = inverse[:, :3] @ ray.direction
+        return Ray(inverse[:, :3] @ ray.position + inverse[:, 3],
+                   direction), np.linalg.norm(direction)
+
+    def intersect(self, ray, leaving=None):
+        """Find the intersection for the group. Every instance whose
+           bounding sphere the ray crosses is tested, nearest first,
+           in its own object space. A ray leaving an instance only meets
+           that instance again if its geometry is not convex.
+           Returns the distance or infinity."""
+        nearest = np.inf
+        for instance, enter in self.getCandidates(ray):
+            if enter >= nearest:
+                break
+            objectRay, stretch = self.toObjectSpace(ray, instance)
+            geometry = self.geometries[self.packed[0][instance]]
+            distance = geometry.intersectFrom(objectRay, geometry) \
+                if instance == leaving else geometry.intersect(objectRay)
+            nearest = min(nearest, distance / stretch)
+        return nearest
+
+    def intersectFrom(self, ray, obj):
+        """Find the intersection for a ray leaving obj. A ray leaving
+           one instance can still meet every other. A ray leaving the
+           group, as known only to a G-buffer, leaves the instance it
+           starts on."""
+        if obj is self:
+            return self.intersect(ray, self.findInstance(ray.position))
+        if obj is not None and obj.getOwner() is self:
+            return self.intersect(ray, obj.instance)
+        return self.intersect(ray)
+
+    def getHit(self, ray, maxDistance=np.inf):
+        """Returns the Hit on the nearest instance, or None.
+           The object hit is an Instance carrying its material."""
+        nearest = None
+        for instance, enter in self.getCandidates(ray):
+            if enter >= maxDistance:
+                break
+            objectRay, stretch = self.toObjectSpace(ray, instance)
+            geometry = self.geometries[self.packed[0][instance]]
+            hit = geometry.getHit(objectRay, maxDistance * stretch)
+            if hit is not None:
+                maxDistance = hit.distance / stretch
+                nearest = (instance, hit)
+        if nearest is None:
+            return None
+        instance, hit = nearest
+        inverse = self.packed[1][instance]
+        # Normals go back to world space by the inverse transpose
+        return Hit(maxDistance, ray.getPositionAt(maxDistance),
+                   normalize(inverse[:, :3].T @ hit.normal),
+                   Instance(self, instance), hit.face, hit.uv)
+
+    def findInstance(self, point):
+        """Returns the instance whose bounding sphere point is nearest
+           the surface of, as the one a point on the group is on."""
+        _, _, centers, radii, _ = \
+            self.packed if self.packed is not None else self.pack()
+        return np.argmin(np.abs(np.linalg.norm(centers - point, axis=1) -
+                                radii))
+
+    def getNormal(self, intersection):
+        """Find the normal at a point on the group, on the instance
+           the point is on."""
+        return Instance(self, self.findInstance(intersection)) \
+            .getNormal(intersection)
+
+    def getDistance(self):
+        """Find the largest distance across any instance."""
+        geometryIds, *_, stretch = \
+            self.packed if self.packed is not None else self.pack()
+        distances = np.array([geometry.getDistance()
+                              for geometry in self.geometries])
+        return np.max(distances[geometryIds] * stretch, initial=0)
+
+    def getBoundingSphere(self):
+        """Returns a (center, radius) tuple enclosing every instance."""
+        if not self.transforms:
+            return self.position, 0
+        _, _, centers, radii, _ = \
+            self.packed if self.packed is not None else self.pack()
+        center = centers.mean(axis=0)
+        return center, np.max(np.linalg.norm(centers - center, axis=1) +
+                              radii)
+
+    def __repr__(self):
+        return f"{len(self.transforms)} Instances"
+
+
+class Instance(Object3D):
+    """One instance of a group, as returned in a Hit.
+       Shades with the instance's shared material and belongs to the
+       group in the scene."""
+    def __init__(self, group, instance):
+        self.group = group
+        self.instance = instance
+        self.geometry = group.geometries[group.geometryIds[instance]]
+        self.material = group.materials[group.materialIds[instance]]
+        self.position = group.packed[2][instance]
+
+    def getOwner(self):
+        return self.group
+
+    def intersect(self, ray):
+        """Find the intersection for this instance alone."""
+        objectRay, stretch = self.group.toObjectSpace(ray, self.instance)
+        return self.geometry.intersect(objectRay) / stretch
+
+    def getHit(self, ray, maxDistance=np.inf):
+        """Returns the Hit on this instance alone, or None."""
+        objectRay, stretch = self.group.toObjectSpace(ray, self.instance)
+        hit = self.geometry.getHit(objectRay, maxDistance * stretch)
+        if hit is None:
+            return None
+        inverse = self.group.packed[1][self.instance]
+        distance = hit.distance / stretch
+        return Hit(distance, ray.getPositionAt(distance),
+                   normalize(inverse[:, :3].T @ hit.normal),
+                   self, hit.face, hit.uv)
+
+    def getNormal(self, intersection):
+        """Find the normal at a point on the instance, as its geometry
+           gives it in object space, carried back to world space by the
+           inverse transpose. Mesh geometries take a triangle index
+           instead of a point, as their own getNormal does."""
+        inverse = self.group.packed[1][self.instance]
+        if np.ndim(intersection):
+            intersection = inverse[:, :3] @ intersection + inverse[:, 3]
+        return normalize(inverse[:, :3].T @
+                         self.geometry.getNormal(intersection))
+
+    def getDistance(self):
+        """Find the distance across the instance."""
+        return self.geometry.getDistance() * \
+            self.group.packed[4][self.instance]
+
+    def __repr__(self):
+        return f"Instance {self.instance} of {self.group!r}"
@@ -2,6 +2,7 @@ import numpy as np
 
 from abc import ABC, abstractmethod
 from ..utils.vector import vec, normalize, magnitude
+from ..utils.definitions import EPSILON
 
 
 class AbstractLight(ABC):
@@ -13,11 +14,25 @@ class AbstractLight(ABC):
         """Returns the color of the light"""
         return self.color
 
+    def getPower(self):
+        """Returns a scalar estimate of how bright the light is"""
+        return float(np.mean(self.color))
+
+    def getIntensity(self, point):
+        """Returns the color of the light as it arrives at point"""
+        return self.color
+
     @abstractmethod
     def getVectorToLight(self, point):
         """Returns a vector pointing towards the light"""
         pass
 
+    @abstractmethod
+    def getVectorsToLight(self, points):
+        """Returns vectors pointing towards the light
+           from each row of points"""
+        pass
+
     @abstractmethod
     def getDistance(self, point):
         """Returns the distance to the light"""
@@ -25,13 +40,27 @@ class AbstractLight(ABC):
 
 
 class PointLight(AbstractLight):
-    def __init__(self, color, position=vec(0, 0, 0)):
+    def __init__(self, color, position=vec(0, 0, 0), falloff=False):
         super().__init__(color, position)
+        self.falloff = falloff
+
+    def getIntensity(self, point):
+        """Returns the color of the light as it arrives at point,
+           dimmed by the inverse square of the distance if it falls off"""
+        if not self.falloff:
+            return self.color
+        return self.color / max(self.getDistance(point) ** 2, EPSILON)
 
     def getVectorToLight(self, point):
         """Returns a normalized vector pointing towards the light"""
         return normalize(self.position - point)
 
+    def getVectorsToLight(self, points):
+        """Returns normalized vectors pointing towards the light
+           from each row of points"""
+        vectors = self.position - points
+        return vectors / np.linalg.norm(vectors, axis=1)[:, np.newaxis]
+
     def getDistance(self, point):
         """Returns the distance to the light"""
         return magnitude(self.position - point)
@@ -49,6 +78,11 @@ class DirectionalLight(AbstractLight):
         """Returns a vector pointing towards the light"""
         return self.lightVector
 
+    def getVectorsToLight(self, points):
+        """Returns a vector pointing towards the light
+           for each row of points"""
+        return np.broadcast_to(self.lightVector, points.shape)
+
     def getDistance(self, point):
         """Returns the distance to the light"""
         return np.inf
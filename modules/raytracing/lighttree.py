@@ -0,0 +1,71 @@
+"""
+Light bounding volume hierarchy for shading with many lights.
+Lets each hit pick a few point lights at random, in proportion to how
+much they are likely to contribute, instead of shading every light.
+"""
+import numpy as np
+
+from .lights import PointLight
+from ..utils.definitions import EPSILON
+
+
+class LightNode(object):
+    """A box around a group of point lights and their total power.
+       Leaves hold a single light, other nodes hold two children."""
+    def __init__(self, lights):
+        positions = np.array([light.position for light in lights],
+                             dtype=float).reshape(-1, 3)
+        self.lower = positions.min(axis=0)
+        self.upper = positions.max(axis=0)
+        self.power = sum(light.getPower() for light in lights)
+        self.light = lights[0] if len(lights) == 1 else None
+        self.children = ()
+        if self.light is None:
+            # Split at the median along the widest axis
+            axis = np.argmax(self.upper - self.lower)
+            order = np.argsort(positions[:, axis], kind="stable")
+            half = len(lights) // 2
+            self.children = (LightNode([lights[i] for i in order[:half]]),
+                             LightNode([lights[i] for i in order[half:]]))
+
+    def getImportance(self, point):
+        """Returns an estimate of how much the lights in the node can
+           add at point. Never 0 for a lit node, so that every light
+           keeps a chance of being picked."""
+        closest = np.clip(point, self.lower, self.upper)
+        distanceSquared = np.dot(closest - point, closest - point)
+        radiusSquared = np.dot(self.upper - self.lower,
+                               self.upper - self.lower) / 4
+        return self.power / max(distanceSquared, radiusSquared, EPSILON)
+
+
+class LightTree(object):
+    """Importance sampling over the point lights of a scene.
+       Other lights have no position to bound, so they are kept
+       aside to be shaded every time."""
+    def __init__(self, lights):
+        self.pointLights = [light for light in lights
+                            if isinstance(light, PointLight)]
+        self.otherLights = [light for light in lights
+                            if not isinstance(light, PointLight)]
+        self.root = LightNode(self.pointLights) if self.pointLights \
+            else None
+
+    def sample(self, point, random):
+        """Picks a point light by walking down the tree, choosing each
+           child in proportion to its importance at point.
+           Returns the light and the probability it was picked."""
+        node = self.root
+        probability = 1.0
+        while node.children:
+            left, right = node.children
+            leftImportance = left.getImportance(point)
+            total = leftImportance + right.getImportance(point)
+            leftChance = leftImportance / total if total > 0 else 0.5
+            if random.random() < leftChance:
+                node = left
+                probability *= leftChance
+            else:
+                node = right
+                probability *= 1 - leftChance
+        return node.light, probability
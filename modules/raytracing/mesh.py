@@ -0,0 +1,236 @@
+"""
+Triangle meshes loaded from OBJ files.
+Parsed meshes are cached beside the OBJ as .npy files together with
+their bounding volume hierarchy, and memory-mapped on later loads so
+large models open instantly and share pages across worker processes.
+"""
+import os
+import numpy as np
+
+from .objects import Object3D
+from .hit import Hit
+from ..utils.files import atomicWrite
+from ..utils.vector import normalize
+from ..utils.definitions import EPSILON, SHIFT_EPSILON
+
+# Triangles tested together at each leaf of the hierarchy
+LEAF_SIZE = 8
+CACHE_ARRAYS = ("vertices", "faces", "bounds", "nodes")
+
+
+def parseObj(path):
+    """Reads the vertices and faces of an OBJ file.
+       Polygons are split into fans of triangles; texture coordinates,
+       normals and everything else are ignored.
+       Returns float vertices (n, 3) and int faces (m, 3)."""
+    vertices = []
+    faces = []
+    with open(path) as file:
+        for line in file:
+            if line.startswith("v "):
+                vertices.append(line.split()[1:4])
+            elif line.startswith("f "):
+                indices = [int(token.split("/")[0])
+                           for token in line.split()[1:]]
+                # Negative indices count back from the latest vertex
+                indices = [i - 1 if i > 0 else len(vertices) + i
+                           for i in indices]
+                for i in range(1, len(indices) - 1):
+                    faces.append((indices[0], indices[i], indices[i + 1]))
+    return np.array(vertices, dtype=float).reshape(-1, 3), \
+        np.array(faces, dtype=np.int32).reshape(-1, 3)
+
+
+def buildHierarchy(vertices, faces):
+    """Builds a bounding volume hierarchy over the triangles.
+       Returns the faces reordered so every leaf is a contiguous run,
+       the (lower, upper) bounds of each node, and each node's
+       (start, count, right child). Inner nodes have a count of 0 and
+       their left child directly after them."""
+    corners = vertices[faces]
+    lowers = corners.min(axis=1)
+    uppers = corners.max(axis=1)
+    centroids = corners.mean(axis=1)
+    order = np.arange(len(faces))
+    bounds = []
+    nodes = []
+
+    def build(start, end):
+        index = len(nodes)
+        members = order[start:end]
+        bounds.append((lowers[members].min(axis=0),
+                       uppers[members].max(axis=0)))
+        nodes.append([start, end - start, 0])
+        if end - start <= LEAF_SIZE:
+            return index
+        # Split at the median centroid along the widest axis
+        axis = np.argmax(np.ptp(centroids[members], axis=0))
+        middle = (end - start) // 2
+        split = np.argpartition(centroids[members, axis], middle)
+        order[start:end] = members[split]
+        nodes[index][1] = 0
+        build(start, start + middle)
+        nodes[index][2] = build(start + middle, end)
+        return index
+
+    if len(faces):
+        build(0, len(faces))
+    return faces[order], \
+        np.array(bounds, dtype=float).reshape(-1, 2, 3), \
+        np.array(nodes, dtype=np.int32).reshape(-1, 3)
+
+
+def loadObj(path):
+    """Returns the vertices, faces, node bounds and nodes of an OBJ
+       file, memory-mapped from its cache. The cache is rebuilt when
+       missing or older than the OBJ."""
+    cachePaths = [f"{path}.{name}.npy" for name in CACHE_ARRAYS]
+    objTime = os.path.getmtime(path)
+    if not all(os.path.exists(cachePath) and
+               os.path.getmtime(cachePath) >= objTime
+               for cachePath in cachePaths):
+        vertices, faces = parseObj(path)
+        arrays = (vertices,) + buildHierarchy(vertices, faces)
+        for cachePath, array in zip(cachePaths, arrays):
+            atomicWrite(cachePath, lambda file: np.save(file, array))
+    return tuple(np.load(cachePath, mmap_mode="r")
+                 for cachePath in cachePaths)
+
+
+def intersectTriangles(origin, direction, corners, leaving=False):
+    """Moller-Trumbore intersection of one ray against a batch of
+       triangles given as (m, 3, 3) corners.
+       A ray leaving the mesh misses the triangles whose planes it
+       starts on, however shallow the angle it leaves them at.
+       Returns the distance to each triangle, infinity where missed,
+       and the barycentric (u, v) of where each was hit."""
+    v0 = corners[:, 0]
+    edge1 = corners[:, 1] - v0
+    edge2 = corners[:, 2] - v0
+    p = np.cross(direction, edge2)
+    determinant = np.einsum("ij,ij->i", edge1, p)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        inverse = 1 / determinant
+        s = origin - v0
+        u = np.einsum("ij,ij->i", s, p) * inverse
+        q = np.cross(s, edge1)
+        v = q @ direction * inverse
+        t = np.einsum("ij,ij->i", edge2, q) * inverse
+        hit = (np.abs(determinant) > EPSILON) & (u >= 0) & (v >= 0) & \
+            (u + v <= 1) & (t > SHIFT_EPSILON)
+        if leaving:
+            # The distance from origin to each plane is |t * determinant|
+            # over the length of the plane's normal
+            hit &= np.abs(t * determinant) > SHIFT_EPSILON * \
+                np.linalg.norm(np.cross(edge1, edge2), axis=1)
+    return np.where(hit, t, np.inf), u, v
+
+
+class Mesh(Object3D):
+    """A triangle mesh placed at position and uniformly scaled.
+       The vertices stay in the mesh's own space, so rays are moved
+       into it instead and the arrays can be shared by every copy."""
+    def __init__(self, vertices, faces, bounds, nodes, scale,
+                 position, baseColor, ambient,
+                 diffuse, specular, shininess, specCoeff,
+                 reflective, image, refractiveIndex,
+                 noiseFunction):
+        super().__init__(position, baseColor, ambient,
+                         diffuse, specular, shininess,
+                         specCoeff, reflective, image,
+                         refractiveIndex, noiseFunction)
+        self.vertices = vertices
+        self.faces = faces
+        self.bounds = bounds
+        self.nodes = nodes
+        self.scale = scale
+
+    def intersectBounds(self, origin, inverseDirection, node):
+        """Slab test of a ray against the box of a node.
+           Returns the distance the ray enters it, infinity if missed."""
+        with np.errstate(invalid="ignore"):
+            t0 = (self.bounds[node, 0] - origin) * inverseDirection
+            t1 = (self.bounds[node, 1] - origin) * inverseDirection
+        enter = np.nanmax(np.minimum(t0, t1))
+        exit = np.nanmin(np.maximum(t0, t1))
+        return max(enter, 0) if enter <= exit and exit >= 0 else np.inf
+
+    def intersectTriangle(self, ray, leaving=False):
+        """Find the intersection for the mesh by walking its hierarchy,
+           nearest boxes first, and testing each leaf's triangles
+           at once, skipping the triangles a leaving ray starts on.
+           Returns the distance, the triangle hit and the
+           barycentric (u, v) on it, or infinity and None if missed."""
+        if not len(self.nodes):
+            return np.inf, None, None
+        origin = (ray.position - self.position) / self.scale
+        direction = ray.direction
+        with np.errstate(divide="ignore"):
+            inverseDirection = 1 / direction
+        nearest = np.inf
+        nearestTriangle = None
+        nearestUV = None
+        stack = [(self.intersectBounds(origin, inverseDirection, 0), 0)]
+        while stack:
+            enter, node = stack.pop()
+            if enter >= nearest:
+                continue
+            start, count, right = self.nodes[node]
+            if count:
+                distances, u, v = intersectTriangles(
+                    origin, direction,
+                    self.vertices[self.faces[start:start + count]],
+                    leaving)
+                closest = np.argmin(distances)
+                if distances[closest] < nearest:
+                    nearest = distances[closest]
+                    nearestTriangle = start + closest
+                    nearestUV = (u[closest], v[closest])
+                continue
+            children = sorted(((self.intersectBounds(origin,
+                                                     inverseDirection,
+                                                     child), child)
+                               for child in (node + 1, right)),
+                              reverse=True)
+            stack.extend(child for child in children if child[0] < nearest)
+        return nearest * self.scale, nearestTriangle, nearestUV
+
+    def intersect(self, ray):
+        """Find the intersection for the mesh."""
+        return self.intersectTriangle(ray)[0]
+
+    def intersectFrom(self, ray, obj):
+        """Find the intersection for a ray leaving obj. A mesh need not
+           be convex, so a ray leaving it is still tested against every
+           triangle but the ones it starts on."""
+        if obj is not None and obj.getOwner() is self:
+            return self.intersectTriangle(ray, leaving=True)[0]
+        return self.intersect(ray)
+
+    def getHit(self, ray, maxDistance=np.inf):
+        """Returns the Hit on the nearest triangle, with its index as
+           the face and the barycentric coordinates as UV, or None."""
+        distance, triangle, uv = self.intersectTriangle(ray)
+        if distance >= maxDistance:
+            return None
+        return Hit(distance, ray.getPositionAt(distance),
+                   self.getNormal(triangle), self, triangle, uv)
+
+    def getNormal(self, intersection):
+        """Find the normal of a triangle, given its index."""
+        v0, v1, v2 = self.vertices[self.faces[intersection]]
+        return normalize(np.cross(v1 - v0, v2 - v0))
+
+    def getDistance(self):
+        return np.linalg.norm(self.bounds[0, 1] - self.bounds[0, 0]) * \
+            self.scale if len(self.bounds) else 0
+
+    def getBoundingSphere(self):
+        """Returns a (center, radius) tuple enclosing the mesh."""
+        if not len(self.bounds):
+            return self.position, 0
+        center = (self.bounds[0, 0] + self.bounds[0, 1]) / 2
+        return self.position + center * self.scale, self.getDistance() / 2
+
+    def __repr__(self):
+        return str(self.getBaseColor()) + " Mesh"
@@ -5,13 +5,16 @@ from abc import ABC, abstractmethod
 import numpy as np
 
 from .materials import Material, NoiseMaterial
+from .hit import Hit, NO_UV
 
 
 class Object3D(ABC):
     """Abstract base class for all objects in the raytraced scene.
        Has a position, material.
        Has getter methods for all material properties.
-       Has abstract methods intersect and getNormal."""
+       Has abstract methods intersect and getNormal.
+       Has getHit, which objects override when their intersection
+       test already knows the normal, face or texture coordinates."""
     def __init__(self, position, baseColor, ambient,
                  diffuse, specular, shininess, specCoeff,
                  reflective, image, refractiveIndex,
@@ -44,6 +47,48 @@ class Object3D(ABC):
     def getPosition(self):
         return self.position
 
+    def setPosition(self, position):
+        """Moves the object so that it is centered on position."""
+        self.position = np.array(position)
+
+    def getOwner(self):
+        """Returns the object in the scene this belongs to."""
+        return self
+
+    def intersectFrom(self, ray, obj):
+        """Find the intersection for a ray leaving obj, which may be
+           None. A convex object is never met again by a ray leaving it,
+           so it is skipped; objects that are not convex override this."""
+        if obj is not None and obj.getOwner() is self:
+            return np.inf
+        return self.intersect(ray)
+
+    def getHit(self, ray, maxDistance=np.inf):
+        """Returns the Hit where ray meets the object, or None if it
+           misses or only meets it at maxDistance or beyond."""
+        distance = self.intersect(ray)
+        if distance >= maxDistance:
+            return None
+        point = ray.getPositionAt(distance)
+        normal = self.getNormal(point)
+        return Hit(distance, point, normal, self, None,
+                   self.getUV(point, normal))
+
+    def getUV(self, point, normal):
+        """Returns the (u, v) texture coordinates of a point on the
+           object. Objects without a mapping give NaNs."""
+        return NO_UV
+
+    def getTransform(self):
+        """Returns the matrix shaping the object, or None if it has
+           none, so that turning it in place shows in a scene diff."""
+        return None
+
+    def getBoundingSphere(self):
+        """Returns a (center, radius) tuple enclosing the object.
+           Unbounded objects use an infinite radius."""
+        return self.position, np.inf
+
     def getBaseColor(self):
         """Getter method for the material's color."""
         return self.material.getBaseColor()
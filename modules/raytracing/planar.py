@@ -1,8 +1,10 @@
+import itertools
 import numpy as np
 from enum import Enum
 
 from .objects import Object3D
-from ..utils.vector import normalize
+from .hit import Hit
+from ..utils.vector import normalize, vec
 
 
 class Side(Enum):
@@ -26,11 +28,23 @@ class Plane(Object3D):
                          specCoeff, reflective, image,
                          refractiveIndex, noiseFunction)
         self.normal = normalize(normal)
+        # Texture axes along the plane
+        reference = vec(0, 0, 1) if abs(self.normal[2]) < 0.9 \
+            else vec(1, 0, 0)
+        self.uAxis = normalize(np.cross(self.normal, reference))
+        self.vAxis = np.cross(self.normal, self.uAxis)
 
     def getNormal(self, intersection=None):
         """Find the normal for the given object. Must override."""
         return self.normal
 
+    def getUV(self, point, normal):
+        """Returns the (u, v) texture coordinates of a point, with the
+           texture repeating every unit along the plane."""
+        # 11 Slides, Slide 24
+        offset = point - self.position
+        return np.dot(self.uAxis, offset), np.dot(self.vAxis, offset)
+
     def intersect(self, ray):
         """Find the intersection for the plane.
            Returns a t only if it's positive."""
@@ -66,7 +80,12 @@ class Cube(Object3D):
         self.sides = []
         self.top = top
         self.forward = forward
-        self.lastIntersectedPlane = None
+        self.setSides()
+
+    def setPosition(self, position):
+        """Moves the cube and rebuilds its sides around the new center."""
+        super().setPosition(position)
+        self.sides = []
         self.setSides()
 
     def setSides(self):
@@ -75,6 +94,7 @@ class Cube(Object3D):
             self.sides.append(self.generateSide(side))
 
     def generateSide(self, side):
+        """Returns the plane of one side, sharing the cube's material."""
         distance = self.length / 2
         if side is Side.Top:
             normal = self.top
@@ -91,38 +111,68 @@ class Cube(Object3D):
         else:
             raise Exception("We messed up somewhere \
                             in the cube side generation.")
-        return Plane(normal=normal,
-                     position=self.position + distance * normal,
-                     baseColor=self.getBaseColor(),
-                     ambient=self.getAmbient(),
-                     diffuse=self.getDiffuse(),
-                     specular=self.getSpecular(),
-                     shininess=self.getShine(),
-                     specCoeff=self.getSpecularCoefficient(),
-                     reflective=self.getReflective(),
-                     image=self.getImage(),
-                     refractiveIndex=self.getRefractiveIndex())
-
-    def intersect(self, ray):
-        """Find the intersection for the cube."""
+        plane = Plane(normal=normal,
+                      position=self.position + distance * normal,
+                      baseColor=self.getBaseColor(),
+                      ambient=self.getAmbient(),
+                      diffuse=self.getDiffuse(),
+                      specular=self.getSpecular(),
+                      shininess=self.getShine(),
+                      specCoeff=self.getSpecularCoefficient(),
+                      reflective=self.getReflective(),
+                      image=self.getImage(),
+                      refractiveIndex=self.getRefractiveIndex())
+        plane.material = self.material
+        return plane
+
+    def intersectSides(self, ray):
+        """Find the intersection for the cube.
+           Returns the distance and the side the ray enters through,
+           or infinity and None if it misses."""
         maxEnter = 0
         minExit = np.inf
+        enterSide = None
         intersections = [side.signedIntersect(ray) for side in self.sides]
         for i, side in enumerate(self.sides):
             # Is an enter
             if np.dot(ray.direction, side.getNormal()) < 0 \
               and intersections[i] > maxEnter:
                 maxEnter = intersections[i]
-                self.lastIntersectedPlane = side
+                enterSide = side
             # Is an exit
             elif np.dot(ray.direction, side.getNormal()) > 0 \
               and intersections[i] < minExit:
                 minExit = intersections[i]
-        return maxEnter if maxEnter < minExit else np.inf
+            # Runs parallel to the side, so misses if outside it
+            elif np.dot(ray.direction, side.getNormal()) == 0 \
+              and np.dot(ray.position - side.position,
+                         side.getNormal()) > 0:
+                return np.inf, None
+        return (maxEnter, enterSide) if maxEnter < minExit else (np.inf, None)
+
+    def intersect(self, ray):
+        """Find the intersection for the cube."""
+        return self.intersectSides(ray)[0]
+
+    def getHit(self, ray, maxDistance=np.inf):
+        """Returns the Hit where ray enters the cube, with the side it
+           enters through as the face, or None."""
+        distance, side = self.intersectSides(ray)
+        if distance >= maxDistance:
+            return None
+        point = ray.getPositionAt(distance)
+        # Rays starting inside enter through no side
+        normal = normalize(side.getNormal()) if side is not None \
+            else self.getNormal(point)
+        return Hit(distance, point, normal, self, side,
+                   self.getUV(point, normal))
 
     def getNormal(self, intersection):
-        """Find the normal for the given object. Must override."""
-        return normalize(self.lastIntersectedPlane.getNormal())
+        """Find the normal of the side closest to a point on the cube."""
+        side = min(self.sides,
+                   key=lambda side: abs(np.dot(intersection - side.position,
+                                               side.getNormal())))
+        return normalize(side.getNormal())
 
     def getLength(self):
         """Find the normal for the given object. Must override."""
@@ -131,5 +181,24 @@ class Cube(Object3D):
     def getDistance(self):
         return self.length
 
+    def getCorners(self):
+        """Returns the 8 corners where the sides meet. Top and forward
+           need not be unit length or square to each other, so the
+           cube can be stretched and sheared."""
+        sides = (self.sides[Side.Top.value], self.sides[Side.Right.value],
+                 self.sides[Side.Front.value])
+        normals = np.array([side.getNormal() for side in sides])
+        # How far each side is from the center along its normal
+        extents = np.array([np.dot(side.position - self.position,
+                                   side.getNormal()) for side in sides])
+        signs = np.array(list(itertools.product((-1, 1), repeat=3)))
+        return self.position + \
+            np.linalg.solve(normals, (signs * extents).T).T
+
+    def getBoundingSphere(self):
+        """Returns a (center, radius) tuple enclosing the cube."""
+        return self.position, np.linalg.norm(
+            self.getCorners() - self.position, axis=1).max()
+
     def __repr__(self):
         return str(self.getBaseColor()) + " Cube"
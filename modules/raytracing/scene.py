@@ -7,8 +7,11 @@ import pathlib
 
 from ..raytracing.planar import Plane, Cube
 from ..raytracing.spherical import Sphere, Ellipsoid
+from ..raytracing.mesh import Mesh, loadObj
+from ..raytracing.instancing import InstanceGroup
 from ..raytracing.lights import DirectionalLight, PointLight
 from .camera import Camera
+from .incremental import SceneDiff
 from ..utils.vector import vec
 from ..utils.definitions import COLORS
 from ..utils.noise import NoisePatterns
@@ -143,29 +146,94 @@ class Scene(object):
 
     def nearestObject(self, ray, obj=None):
         """Returns the nearest collision object
-           and the distance to the object, excluding obj."""
-        distances = [o.intersect(ray) for o in self.objects if o is not obj]
+           and the distance to the object, for a ray leaving obj."""
         colObj = None
         distanceToObj = np.inf
-        for i, distance in enumerate(distances):
-            if distance < distanceToObj and self.objects[i] is not obj:
+        for o in self.objects:
+            if (distance := o.intersectFrom(ray, obj)) < distanceToObj:
                 distanceToObj = distance
-                colObj = self.objects[i]
+                colObj = o
         return colObj, distanceToObj
 
+    def nearestHit(self, ray):
+        """Returns the Hit of the nearest object, or None.
+           Objects further than the nearest so far only test distance."""
+        nearest = None
+        distance = np.inf
+        for o in self.objects:
+            if (hit := o.getHit(ray, distance)) is not None:
+                nearest = hit
+                distance = hit.distance
+        return nearest
+
+    def snapshot(self):
+        """Returns a record of the current object bounds and light
+           settings, to later compare against with diff."""
+        objects = {}
+        for obj in self.objects:
+            center, radius = obj.getBoundingSphere()
+            material = obj.getMaterial()
+            material = {key: np.array(value) if isinstance(value, np.ndarray)
+                        else value
+                        for key, value in vars(material).items()} \
+                if material is not None else {}
+            transform = obj.getTransform()
+            objects[id(obj)] = (obj, np.array(center), radius, material,
+                                None if transform is None
+                                else np.array(transform))
+        lights = {}
+        for light in self.lights:
+            lights[id(light)] = (light, np.array(light.position),
+                                 np.array(light.getColor()),
+                                 np.array(light.getVectorToLight(
+                                     light.position)))
+        return objects, lights
+
+    def diff(self, snapshot):
+        """Returns a SceneDiff of every change made to the objects
+           and lights since snapshot was taken."""
+        oldObjects, oldLights = snapshot
+        newObjects, newLights = self.snapshot()
+        bounds = []
+        for key in oldObjects.keys() | newObjects.keys():
+            old = oldObjects.get(key)
+            new = newObjects.get(key)
+            if old is not None and new is not None and \
+               np.array_equal(old[1], new[1]) and old[2] == new[2] and \
+               self.sameMaterial(old[3], new[3]) and \
+               np.array_equal(old[4], new[4]):
+                continue
+            # Moved, edited, added, or removed, so both bounds count
+            for entry in (old, new):
+                if entry is not None:
+                    bounds.append((entry[1], entry[2]))
+        lightsChanged = oldLights.keys() != newLights.keys() or \
+            any(not all(np.array_equal(old, new) for old, new in
+                        zip(oldLights[key][1:], newLights[key][1:]))
+                for key in newLights)
+        return SceneDiff(bounds, lightsChanged)
+
+    def sameMaterial(self, old, new):
+        """Returns True if two material snapshots are equal."""
+        return old.keys() == new.keys() and \
+            all(np.array_equal(old[key], new[key])
+                if isinstance(old[key], np.ndarray)
+                else old[key] is new[key] or old[key] == new[key]
+                for key in old)
+
     def addSphere(self, radius=0.5,
                   position=vec(0, 0, 0), color=COLORS["blue"],
                   ambient=COLORS["blue"],
                   diffuse=COLORS["black"], specular=COLORS["white"],
                   shininess=0, specCoeff=100, reflective=0,
                   image=None, refractiveIndex=0.0,
-                  noiseFunction=None):
+                  noiseFunction=None, rotation=None, transform=None):
         self.objects.append(Sphere(radius, position, color,
                                    ambient, diffuse,
                                    specular, shininess,
                                    specCoeff, reflective,
                                    image, refractiveIndex,
-                                   noiseFunction))
+                                   noiseFunction, rotation, transform))
 
     def addEllipsoid(self, a=1, b=2, c=1,
                      position=vec(0, 0, 0), color=COLORS["red"],
@@ -173,13 +241,14 @@ class Scene(object):
                      diffuse=COLORS["black"], specular=COLORS["white"],
                      shininess=0, specCoeff=100, reflective=0,
                      image=None, refractiveIndex=0.0,
-                     noiseFunction=None):
+                     noiseFunction=None, rotation=None, transform=None):
         self.objects.append(Ellipsoid(a, b, c, position, color,
                                       ambient, diffuse,
                                       specular, shininess,
                                       specCoeff, reflective,
                                       image, refractiveIndex,
-                                      noiseFunction))
+                                      noiseFunction, rotation,
+                                      transform))
 
     def addPlane(self, normal=vec(0, 1, 0),
                  position=vec(0, 0, 0), color=COLORS["gray"],
@@ -210,6 +279,28 @@ class Scene(object):
                                  image, refractiveIndex,
                                  noiseFunction))
 
+    def addMesh(self, fileName, scale=1,
+                position=vec(0, 0, 0), color=COLORS["gray"],
+                ambient=COLORS["blue"],
+                diffuse=COLORS["black"], specular=COLORS["white"],
+                shininess=0, specCoeff=100, reflective=0,
+                image=None, refractiveIndex=0.0,
+                noiseFunction=None):
+        self.objects.append(Mesh(*loadObj(fileName), scale,
+                                 position, color,
+                                 ambient, diffuse,
+                                 specular, shininess,
+                                 specCoeff, reflective,
+                                 image, refractiveIndex,
+                                 noiseFunction))
+
+    def addInstanceGroup(self):
+        """Adds an empty group of instances and returns it,
+           to be filled with addGeometry, addMaterial and addInstance."""
+        group = InstanceGroup()
+        self.objects.append(group)
+        return group
+
     def addDirectionalLight(self,
                             color=COLORS["white"],
                             position=vec(0, 0, 0),
@@ -220,5 +311,6 @@ class Scene(object):
 
     def addPointLight(self,
                       color=COLORS["white"],
-                      position=vec(0, 0, 0)):
-        self.lights.append(PointLight(color, position))
+                      position=vec(0, 0, 0),
+                      falloff=False):
+        self.lights.append(PointLight(color, position, falloff))
@@ -5,6 +5,27 @@ from ..utils.vector import normalize, magnitude
 
 
 class Spherical(Object3D):
+    """A unit sphere in object space, placed in the world by a linear
+       transform (scale, rotation or shear) and then its position.
+       The world-to-object matrix and its transpose, which carries
+       normals back to the world, are computed once per transform."""
+    def setTransform(self, objectToWorld):
+        """Sets the 3x3 matrix taking the unit sphere to the shape."""
+        self.objectToWorld = np.asarray(objectToWorld, dtype=float)
+        self.worldToObject = np.linalg.inv(self.objectToWorld)
+        self.normalMatrix = self.worldToObject.T
+
+    def getTransform(self):
+        return self.objectToWorld
+
+    def placeShape(self, scale, rotation, transform):
+        """Sets the transform from the shape's scale matrix, then an
+           optional rotation, then an optional 3x3 transform, which
+           can also shear or stretch it."""
+        linear = (rotation if rotation is not None else np.eye(3)) @ scale
+        self.setTransform(linear if transform is None
+                          else np.asarray(transform, dtype=float) @ linear)
+
     def quadraticFormula(self, a, b, c):
         """Calulates the quadratic formula.
            Returns a tuple with -b plus and minus
@@ -20,9 +41,39 @@ class Spherical(Object3D):
         return b ** 2 - 4 * a * c
 
     def getNormal(self, surfacePoint, intersection=None):
-        """Find the unit normal."""
+        """Find the unit normal, the object space normal carried back
+           by the inverse transpose of the transform."""
         # https://www.scratchapixel.com/lessons/3d-basic-rendering/introduction-to-shading/shading-normals.html
-        return normalize(surfacePoint - self.position)
+        return normalize(self.normalMatrix @ (self.worldToObject @
+                                              (surfacePoint - self.position)))
+
+    def getUV(self, point, normal):
+        """Returns the (u, v) texture coordinates of a point,
+           each in [0, 1] around the center in object space, so
+           textures turn with the object."""
+        # 11 Slides, Slide 49
+        x, y, z = normalize(self.worldToObject @ (self.position - point))
+        return 0.5 + np.arctan2(z, x) / (2 * np.pi), \
+            np.arccos(np.clip(y, -1, 1)) / np.pi
+
+    def intersect(self, ray):
+        """Find the intersection for the shape, by intersecting the
+           ray moved into object space with the unit sphere.
+           Returns either a float representing the distance
+           to the shape (t) or infinity if it misses"""
+        # 10 Slides, Slide 22
+        q = self.worldToObject @ (ray.position - self.position)
+        v = self.worldToObject @ ray.direction
+        a = self.getA(v)
+        b = self.getB(v, q)
+        c = self.getC(q, 1)
+        return np.inf if self.getDiscriminant(a, b, c) < 0 else \
+            self.positiveOnly(min(self.quadraticFormula(a, b, c)))
+
+    def getBoundingSphere(self):
+        """Returns a (center, radius) tuple enclosing the shape,
+           the radius being the longest stretch of the transform."""
+        return self.position, np.linalg.norm(self.objectToWorld, ord=2)
 
     def getA(self, vector):
         """Returns the dot product of a vector by itself."""
@@ -43,32 +94,19 @@ class Sphere(Spherical):
     def __init__(self, radius, position, baseColor, ambient,
                  diffuse, specular, shininess, specCoeff,
                  reflective, image, refractiveIndex,
-                 noiseFunction):
+                 noiseFunction, rotation=None, transform=None):
         super().__init__(position, baseColor, ambient,
                          diffuse, specular, shininess,
                          specCoeff, reflective, image,
                          refractiveIndex, noiseFunction)
         self.radius = radius
+        # Rotation only turns the texture
+        self.placeShape(np.eye(3) * radius, rotation, transform)
 
     def getRadius(self):
         """Returns the radius of the circle."""
         return self.radius
 
-    def intersect(self, ray):
-        """Find the intersection for the sphere.
-           Returns either a float representing the distance
-           to the sphere (t) or infinity if it misses"""
-        # 06 Slides, slide 43
-        q = ray.position - self.position
-        # 1 b/c normalized
-        a = self.getA(ray.direction)
-        b = self.getB(q, ray.direction)
-        c = self.getC(q, self.radius ** 2)
-        # https://www.csee.umbc.edu/~olano/class/435-02-8/ray-sphere.html
-        # We miss if discriminent is negative
-        return np.inf if self.getDiscriminant(a, b, c) < 0 else \
-            self.positiveOnly(min(self.quadraticFormula(a, b, c)))
-
     def getDistance(self):
         return 2 * self.radius
 
@@ -80,7 +118,7 @@ class Ellipsoid(Spherical):
     def __init__(self, a, b, c, position, baseColor, ambient,
                  diffuse, specular, shininess, specCoeff,
                  reflective, image, refractiveIndex,
-                 noiseFunction):
+                 noiseFunction, rotation=None, transform=None):
         super().__init__(position, baseColor, ambient,
                          diffuse, specular, shininess, specCoeff,
                          reflective, image, refractiveIndex,
@@ -88,39 +126,9 @@ class Ellipsoid(Spherical):
         self.a = a
         self.b = b
         self.c = c
+        # Scale the unit sphere to the semi-axes, then rotate
+        self.placeShape(np.diag((a, b, c)), rotation, transform)
 
-    def intersect(self, ray):
-        """Find the intersection for the ellipsoid.
-           Returns either a float representing the distance
-           to the ellipsoid (t) or infinity if it misses"""
-        # 10 Slides, Slide 22
-        q = ray.position - self.position
-        s = (self.a, self.b, self.c)
-        vOverS = ray.direction / s
-        qOverS = q / s
-        a = self.getA(vOverS)
-        b = self.getB(vOverS, qOverS)
-        c = self.getC(qOverS, 1)
-        return np.inf if self.getDiscriminant(a, b, c) < 0 else \
-            self.positiveOnly(min(self.quadraticFormula(a, b, c)))
-
-    # TODO Do the rotation stuff
-    """
-    def rotateX(self, x, y, z):
-        (x,
-         y * np.cos(theta) - z * np.sin(theta),
-         y * np.sin(theta) + z * np.cos(theta))
-
-    def rotateY(self, x, y, z):
-        (x,
-         y * np.cos(theta) - z * np.sin(theta),
-         y * np.sin(theta) + z * np.cos(theta))
-
-    def rotateZ(self, x, y, z):
-        (x,
-         y * np.cos(theta) - z * np.sin(theta),
-         y * np.sin(theta) + z * np.cos(theta))
-    """
     def getDistance(self):
         return np.sqrt(self.a ** 2 + self.b ** 2 + self.c ** 2)
 
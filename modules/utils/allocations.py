@@ -0,0 +1,194 @@
+"""
+Allocation tracking for the hot path.
+Sampled pixels are traced one bytecode at a time. Between each one,
+the peak of the bytes traced by tracemalloc above where it started is
+charged to the function running the bytecode, with one allocation, or
+more if Python's count of allocated blocks grew by more. Temporaries
+freed within the same bytecode, such as the inner results of
+"a + b * c", still count through the peak. Code outside the
+repository, such as NumPy's own Python, is not traced, so what it
+allocates is charged to the bytecode calling it, and a call counts
+as allocating its result only unless more blocks survive it.
+Tracing itself adds about one small allocation to every call traced.
+Rays are counted by calls to their constructors.
+Tracing is very slow, so only one pixel in every so many is traced.
+"""
+import os
+import sys
+import json
+import tracemalloc
+
+from ..raytracing.ray import Ray
+
+TRACK_EVERY = 16
+REPORT_FUNCTIONS = 15
+RAY_CONSTRUCTORS = (Ray.__init__.__code__, Ray.trusted.__func__.__code__)
+ROOT = os.path.dirname(os.path.dirname(os.path.dirname(
+    os.path.abspath(__file__))))
+
+
+def getFunctionName(code):
+    """Returns the name and file of the function of a code object,
+       which stay the same as lines move between runs being compared."""
+    fileName = os.path.relpath(os.path.abspath(code.co_filename), ROOT)
+    # Qualified names are only kept from Python 3.11 on
+    name = getattr(code, "co_qualname", code.co_name)
+    return f"{name} ({fileName})"
+
+
+class AllocationTracker(object):
+    """Counts the allocations and bytes of sampled pixels, in total and
+       by function, and the rays they traced."""
+    def __init__(self, every=TRACK_EVERY):
+        self.every = every
+        self.calls = 0
+        self.pixels = 0
+        self.rays = 0
+        # code: [allocations, bytes]
+        self.functions = {}
+        # code: whether it is in the repository
+        self.traced = {}
+        self.lastCode = None
+        self.lastBlocks = 0
+        self.lastMemory = 0
+        # Set during a wrapped call, whose pixel any nested one is part of
+        self.inside = False
+        # Returned to keep tracing without making a new bound method,
+        # which would be charged to every bytecode
+        self.opcodeTracer = self.traceOpcode
+
+    def wrap(self, function):
+        """Returns function, traced on every every-th call. Each call
+           counts as a pixel, except calls made from within another
+           wrapped call, which are already part of its pixel."""
+        def tracked(*args, **kwargs):
+            if self.inside:
+                return function(*args, **kwargs)
+            self.inside = True
+            try:
+                self.calls += 1
+                if self.calls % self.every:
+                    return function(*args, **kwargs)
+                return self.measure(function, *args, **kwargs)
+            finally:
+                self.inside = False
+        return tracked
+
+    def measure(self, function, *args, **kwargs):
+        """Calls function, charging what it allocates."""
+        tracemalloc.start()
+        self.lastCode = None
+        sys.settrace(self.traceCall)
+        try:
+            return function(*args, **kwargs)
+        finally:
+            # The last bytecode was charged by the return event
+            sys.settrace(None)
+            tracemalloc.stop()
+            self.pixels += 1
+
+    def charge(self, code):
+        """Charges what the last bytecode allocated to its function,
+           then starts counting for code."""
+        peak = tracemalloc.get_traced_memory()[1]
+        blocks = sys.getallocatedblocks()
+        if self.lastCode is not None and peak > self.lastMemory:
+            totals = self.functions.setdefault(self.lastCode, [0, 0])
+            totals[0] += max(blocks - self.lastBlocks, 1)
+            totals[1] += peak - self.lastMemory
+        self.lastCode = code
+        # Read again so this bookkeeping is not charged, and only
+        # then reset the peak, past the tuple the reading returned
+        self.lastBlocks = sys.getallocatedblocks()
+        self.lastMemory = tracemalloc.get_traced_memory()[0]
+        tracemalloc.reset_peak()
+
+    def traceCall(self, frame, event, arg):
+        """Traces the bytecodes of calls into the repository."""
+        code = frame.f_code
+        if code not in self.traced:
+            path = os.path.abspath(code.co_filename)
+            self.traced[code] = path.startswith(ROOT) and \
+                path != os.path.abspath(__file__)
+        if not self.traced[code]:
+            return None
+        if code in RAY_CONSTRUCTORS:
+            self.rays += 1
+        # Frame objects are only made because of tracing, so what the
+        # call allocated before its first bytecode is not charged
+        self.lastCode = None
+        self.charge(code)
+        frame.f_trace_lines = False
+        frame.f_trace_opcodes = True
+        return self.opcodeTracer
+
+    def traceOpcode(self, frame, event, arg):
+        self.charge(frame.f_code)
+        return self.opcodeTracer
+
+    def getReport(self):
+        """Returns the totals as a dict that can be saved as JSON."""
+        functions = {}
+        for code, (allocations, size) in self.functions.items():
+            # Lambdas and nested functions can share a name
+            totals = functions.setdefault(getFunctionName(code), [0, 0])
+            totals[0] += allocations
+            totals[1] += size
+        return {"pixels": self.pixels,
+                "rays": self.rays,
+                "allocations": sum(a for a, _ in functions.values()),
+                "bytes": sum(b for _, b in functions.values()),
+                "functions": functions}
+
+    def save(self, path):
+        with open(path, "w") as file:
+            json.dump(self.getReport(), file, indent=4)
+
+    def report(self):
+        """Prints the allocations per pixel and per ray, and the
+           functions allocating most."""
+        printReport(self.getReport())
+
+    def compare(self, path):
+        """Prints how allocations changed from a report saved before."""
+        with open(path) as file:
+            printComparison(json.load(file), self.getReport())
+
+
+def perPixel(report, value):
+    return value / report["pixels"] if report["pixels"] else 0
+
+
+def printReport(report):
+    """Prints a report from AllocationTracker.getReport."""
+    pixels = max(report["pixels"], 1)
+    rays = max(report["rays"], 1)
+    print(f"Allocations over {report['pixels']} traced pixels, "
+          f"{report['rays']} rays:")
+    print(f"{report['allocations'] / pixels:.1f} allocations and "
+          f"{report['bytes'] / pixels:.0f} bytes per pixel, "
+          f"{report['allocations'] / rays:.1f} and "
+          f"{report['bytes'] / rays:.0f} per ray")
+    functions = sorted(report["functions"].items(),
+                       key=lambda item: -item[1][0])
+    for name, (allocations, size) in functions[:REPORT_FUNCTIONS]:
+        print(f"{allocations / pixels:10.1f} {size / pixels:10.0f}  {name}")
+
+
+def printComparison(old, new):
+    """Prints the change per pixel in allocations and bytes, overall
+       and for the functions that changed most."""
+    print("Allocations per pixel, before -> after:")
+    print(f"{perPixel(old, old['allocations']):10.1f} -> "
+          f"{perPixel(new, new['allocations']):10.1f} allocations, "
+          f"{perPixel(old, old['bytes']):10.0f} -> "
+          f"{perPixel(new, new['bytes']):10.0f} bytes")
+    names = set(old["functions"]) | set(new["functions"])
+    changes = []
+    for name in names:
+        before = perPixel(old, old["functions"].get(name, (0, 0))[0])
+        after = perPixel(new, new["functions"].get(name, (0, 0))[0])
+        changes.append((before, after, name))
+    changes.sort(key=lambda change: -abs(change[1] - change[0]))
+    for before, after, name in changes[:REPORT_FUNCTIONS]:
+        print(f"{before:10.1f} -> {after:10.1f}  {name}")
@@ -0,0 +1,16 @@
+"""
+File helpers shared by the renderers.
+"""
+import os
+
+
+def atomicWrite(path, write):
+    """Calls write with a temporary file object next to path, then
+       flushes it to disk and renames it over path. Readers only ever
+       see the old file or the complete new one."""
+    temporaryPath = path + ".partial"
+    with open(temporaryPath, "wb") as file:
+        write(file)
+        file.flush()
+        os.fsync(file.fileno())
+    os.replace(temporaryPath, path)
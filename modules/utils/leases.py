@@ -0,0 +1,379 @@
+"""
+Leases on quilt chunks, so several render nodes can share one quilt.
+A node claims a chunk before tracing it and keeps renewing the claim
+while it works. Once the chunk is saved it is recorded in the manifest
+and never handed out again. Claims that stop being renewed, because
+their node crashed or hung, expire and go to the next node asking.
+
+Nodes coordinate either through lease files in a shared quilt folder,
+which needs their clocks kept in sync, or through a small coordinator
+process (quiltCoordinator.py) that keeps the leases itself.
+"""
+import os
+import json
+import time
+import socket
+import threading
+from abc import ABC, abstractmethod
+
+from .files import atomicWrite
+
+LEASE_SECONDS = 60
+HEARTBEAT_INTERVAL = 10
+LEASE_FOLDER = "leases"
+MANIFEST_FOLDER = "manifest"
+
+
+def defaultNodeName():
+    """Returns a name unique to this process on this machine."""
+    return f"{socket.gethostname()}-{os.getpid()}"
+
+
+def readManifest(folder):
+    """Returns every chunk completion recorded in a quilt folder, as
+       dicts of the chunk, node, seconds and pixels. A line torn by a
+       crash mid-append is skipped."""
+    path = os.path.join(folder, MANIFEST_FOLDER)
+    records = []
+    if not os.path.isdir(path):
+        return records
+    for name in sorted(os.listdir(path)):
+        if not name.endswith(".jsonl"):
+            continue
+        with open(os.path.join(path, name)) as file:
+            for line in file:
+                try:
+                    records.append(json.loads(line))
+                except ValueError:
+                    pass
+    return records
+
+
+def appendManifest(folder, record):
+    """Appends a chunk completion to the manifest file of its node.
+       Every node appends to its own file only, so appends never
+       interleave even on filesystems without atomic appends."""
+    path = os.path.join(folder, MANIFEST_FOLDER)
+    os.makedirs(path, exist_ok=True)
+    with open(os.path.join(path, f"{record['node']}.jsonl"), "a") as file:
+        file.write(json.dumps(record) + "\n")
+        file.flush()
+        os.fsync(file.fileno())
+
+
+def summarizeManifest(records):
+    """Returns {node: [chunks, pixels, seconds]} over the records."""
+    stats = {}
+    for record in records:
+        totals = stats.setdefault(record["node"], [0, 0, 0.0])
+        totals[0] += 1
+        totals[1] += record["pixels"]
+        totals[2] += record["seconds"]
+    return stats
+
+
+def printNodeStats(stats):
+    """Prints the chunks and throughput of every node."""
+    for node, (chunks, pixels, seconds) in sorted(stats.items()):
+        rate = pixels / seconds if seconds > 0 else 0
+        print(f"{node}: {chunks} chunks, {pixels} pixels in "
+              f"{seconds:.2f} seconds, {rate:.1f} pixels per second")
+
+
+class ChunkLeases(ABC):
+    """Abstract base class for claiming chunks.
+       Renews the leases this node holds on a background thread, and
+       remembers any that were lost to another node."""
+    def __init__(self, node=None, heartbeatInterval=HEARTBEAT_INTERVAL):
+        self.node = node if node is not None else defaultNodeName()
+        self.heartbeatInterval = heartbeatInterval
+        self.held = set()
+        self.lost = set()
+        self.lock = threading.Lock()
+        self.stopping = threading.Event()
+        self.thread = threading.Thread(target=self.beat, daemon=True)
+        self.thread.start()
+
+    def beat(self):
+        """Renews every held lease once per heartbeat interval."""
+        while not self.stopping.wait(self.heartbeatInterval):
+            with self.lock:
+                held = list(self.held)
+            for chunk in held:
+                if not self.renew(chunk):
+                    with self.lock:
+                        self.held.discard(chunk)
+                        self.lost.add(chunk)
+
+    def claim(self, chunks):
+        """Claims the first of chunks that is neither completed nor
+           leased to a live node. Returns it, or None if there is none."""
+        for chunk in chunks:
+            if self.tryClaim(chunk):
+                with self.lock:
+                    self.held.add(chunk)
+                    self.lost.discard(chunk)
+                return chunk
+        return None
+
+    def isLost(self, chunk):
+        """Returns True if the lease on chunk expired and was taken."""
+        with self.lock:
+            return chunk in self.lost
+
+    def complete(self, chunk, seconds, pixels):
+        """Records chunk as saved, after seconds tracing pixels."""
+        self.record({"chunk": chunk, "node": self.node,
+                     "seconds": seconds, "pixels": pixels,
+                     "finished": time.time()})
+        with self.lock:
+            self.held.discard(chunk)
+
+    def release(self, chunk):
+        """Gives up the lease on chunk without completing it."""
+        with self.lock:
+            self.held.discard(chunk)
+        self.drop(chunk)
+
+    def close(self):
+        """Stops the heartbeats and releases every held lease."""
+        self.stopping.set()
+        self.thread.join()
+        for chunk in list(self.held):
+            self.release(chunk)
+
+    @abstractmethod
+    def tryClaim(self, chunk):
+        """Must lease chunk to this node and return True, or return
+           False if it is completed or leased to a live node."""
+        return False
+
+    @abstractmethod
+    def renew(self, chunk):
+        """Must extend this node's lease, returning False if lost."""
+        return False
+
+    @abstractmethod
+    def record(self, record):
+        """Must add a completion to the manifest and end its lease."""
+        pass
+
+    @abstractmethod
+    def drop(self, chunk):
+        """Must end this node's lease on chunk."""
+        pass
+
+    @abstractmethod
+    def getCompleted(self):
+        """Must return the set of completed chunks."""
+        return set()
+
+    @abstractmethod
+    def getNodeStats(self):
+        """Must return {node: [chunks, pixels, seconds]}."""
+        return {}
+
+
+class FileLeases(ChunkLeases):
+    """Leases kept as files in the quilt folder, for nodes sharing it
+       over a network filesystem. Leases are created exclusively, so
+       only one node gets a free chunk, and expired leases are renamed
+       away first, so only one node takes each over. A completed
+       chunk's lease is kept, marked done."""
+    def __init__(self, folder, node=None, leaseSeconds=LEASE_SECONDS,
+                 heartbeatInterval=HEARTBEAT_INTERVAL):
+        self.folder = folder
+        self.leaseFolder = os.path.join(folder, LEASE_FOLDER)
+        self.leaseSeconds = leaseSeconds
+        os.makedirs(self.leaseFolder, exist_ok=True)
+        super().__init__(node, heartbeatInterval)
+
+    def getLeasePath(self, chunk):
+        return os.path.join(self.leaseFolder, chunk + ".lease")
+
+    def makeLease(self, done=False):
+        """Returns the encoded lease of this node, expiring after the
+           lease time."""
+        return json.dumps({"node": self.node,
+                           "expires": time.time() + self.leaseSeconds,
+                           "done": done}).encode()
+
+    def readLease(self, chunk):
+        """Returns the lease on chunk, or None if there is none or it
+           is still being written."""
+        try:
+            with open(self.getLeasePath(chunk), "rb") as file:
+                return json.loads(file.read())
+        except (OSError, ValueError):
+            return None
+
+    def createLease(self, chunk):
+        """Creates this node's lease on chunk if nobody has one."""
+        try:
+            descriptor = os.open(self.getLeasePath(chunk),
+                                 os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+        except FileExistsError:
+            return False
+        with os.fdopen(descriptor, "wb") as file:
+            file.write(self.makeLease())
+            file.flush()
+            os.fsync(file.fileno())
+        return True
+
+    def tryClaim(self, chunk):
+        if self.createLease(chunk):
+            return True
+        lease = self.readLease(chunk)
+        if lease is None or lease["done"] or lease["expires"] > time.time():
+            return False
+        # Only one node can rename the expired lease away
+        path = self.getLeasePath(chunk)
+        stalePath = f"{path}.{self.node}.stale"
+        try:
+            os.rename(path, stalePath)
+        except FileNotFoundError:
+            return False
+        os.remove(stalePath)
+        return self.createLease(chunk)
+
+    def renew(self, chunk):
+        lease = self.readLease(chunk)
+        if lease is None or lease["node"] != self.node or lease["done"] \
+           or lease["expires"] <= time.time():
+            return False
+        # Other nodes only take over expired leases, and this one is
+        # replaced whole, so it is never missing or anyone else's
+        atomicWrite(self.getLeasePath(chunk),
+                    lambda file: file.write(self.makeLease()))
+        return True
+
+    def record(self, record):
+        appendManifest(self.folder, record)
+        atomicWrite(self.getLeasePath(record["chunk"]),
+                    lambda file: file.write(self.makeLease(done=True)))
+
+    def drop(self, chunk):
+        lease = self.readLease(chunk)
+        if lease is not None and lease["node"] == self.node and \
+           not lease["done"]:
+            os.remove(self.getLeasePath(chunk))
+
+    def getCompleted(self):
+        return {record["chunk"] for record in readManifest(self.folder)}
+
+    def getNodeStats(self):
+        return summarizeManifest(readManifest(self.folder))
+
+
+class LeaseTable(object):
+    """The leases a coordinator hands out, kept in memory with its own
+       clock. Completions go to the quilt folder's manifest, and are
+       read back from it when the coordinator starts."""
+    def __init__(self, folder, leaseSeconds=LEASE_SECONDS):
+        self.folder = folder
+        self.leaseSeconds = leaseSeconds
+        # chunk: (node, expires)
+        self.leases = {}
+        self.completed = {record["chunk"] for record in readManifest(folder)}
+
+    def claim(self, node, chunks):
+        now = time.time()
+        for chunk in chunks:
+            if chunk in self.completed:
+                continue
+            lease = self.leases.get(chunk)
+            if lease is None or lease[1] <= now:
+                self.leases[chunk] = (node, now + self.leaseSeconds)
+                return chunk
+        return None
+
+    def renew(self, node, chunk):
+        lease = self.leases.get(chunk)
+        if lease is None or lease[0] != node:
+            return False
+        self.leases[chunk] = (node, time.time() + self.leaseSeconds)
+        return True
+
+    def complete(self, record):
+        appendManifest(self.folder, record)
+        self.completed.add(record["chunk"])
+        self.leases.pop(record["chunk"], None)
+
+    def release(self, node, chunk):
+        if self.leases.get(chunk, (None,))[0] == node:
+            del self.leases[chunk]
+
+    def handleRequest(self, request):
+        """Handles a claim, renew, complete, release, completed or
+           stats request. Returns the reply."""
+        op = request["op"]
+        if op == "claim":
+            return {"chunk": self.claim(request["node"], request["chunks"])}
+        elif op == "renew":
+            return {"held": self.renew(request["node"], request["chunk"])}
+        elif op == "complete":
+            self.complete(request["record"])
+            return {}
+        elif op == "release":
+            self.release(request["node"], request["chunk"])
+            return {}
+        elif op == "completed":
+            return {"chunks": sorted(self.completed)}
+        elif op == "stats":
+            now = time.time()
+            return {"nodes": summarizeManifest(readManifest(self.folder)),
+                    "leased": sum(expires > now
+                                  for _, expires in self.leases.values())}
+        raise ValueError(f"Unknown op {op}")
+
+
+class CoordinatorLeases(ChunkLeases):
+    """Leases held by a coordinator process, asked over one TCP
+       connection in JSON lines."""
+    def __init__(self, host, port, node=None,
+                 heartbeatInterval=HEARTBEAT_INTERVAL):
+        self.connection = socket.create_connection((host, port))
+        self.reader = self.connection.makefile("r")
+        self.requestLock = threading.Lock()
+        super().__init__(node, heartbeatInterval)
+
+    def request(self, op, **params):
+        """Sends one request and returns the reply."""
+        request = dict(params, op=op, node=self.node)
+        with self.requestLock:
+            self.connection.sendall((json.dumps(request) + "\n").encode())
+            reply = json.loads(self.reader.readline())
+        if "error" in reply:
+            raise Exception(reply["error"])
+        return reply
+
+    def claim(self, chunks):
+        # One request for the whole list instead of one per chunk
+        chunk = self.request("claim", chunks=list(chunks))["chunk"]
+        if chunk is not None:
+            with self.lock:
+                self.held.add(chunk)
+                self.lost.discard(chunk)
+        return chunk
+
+    def tryClaim(self, chunk):
+        return self.request("claim", chunks=[chunk])["chunk"] is not None
+
+    def renew(self, chunk):
+        return self.request("renew", chunk=chunk)["held"]
+
+    def record(self, record):
+        self.request("complete", record=record)
+
+    def drop(self, chunk):
+        self.request("release", chunk=chunk)
+
+    def getCompleted(self):
+        return set(self.request("completed")["chunks"])
+
+    def getNodeStats(self):
+        return self.request("stats")["nodes"]
+
+    def close(self):
+        super().close()
+        self.connection.close()
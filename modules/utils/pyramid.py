@@ -0,0 +1,97 @@
+"""
+Deep zoom (DZI) tile pyramids, so huge renders can be panned and
+zoomed in a viewer without ever decoding the whole image.
+Images are streamed in as strips of rows from the top. Each level
+tiles the rows it has been given as soon as a row of tiles is full,
+and passes them on halved to the level above, so only about one row
+of tiles per level is ever held in memory.
+"""
+import os
+import numpy as np
+import pygame
+
+TILE_SIZE = 256
+DZI_TEMPLATE = """<?xml version="1.0" encoding="UTF-8"?>
+<Image xmlns="http://schemas.microsoft.com/deepzoom/2008"
+       Format="png" Overlap="0" TileSize="{tileSize}">
+  <Size Width="{width}" Height="{height}"/>
+</Image>
+"""
+
+
+def halve(rows):
+    """Averages each 2 by 2 block of an even number of uint8 rows,
+       indexed [x, y]. An odd last column is repeated."""
+    if rows.shape[0] % 2:
+        rows = np.concatenate((rows, rows[-1:]), axis=0)
+    total = rows[0::2, 0::2].astype(np.uint16) + rows[1::2, 0::2] + \
+        rows[0::2, 1::2] + rows[1::2, 1::2]
+    return ((total + 2) // 4).astype(np.uint8)
+
+
+class PyramidLevel(object):
+    """One level of a pyramid, writing its tiles into its own folder
+       and feeding the next smaller level."""
+    def __init__(self, level, width, folder, tileSize):
+        self.level = level
+        self.width = width
+        self.folder = os.path.join(folder, str(level))
+        self.tileSize = tileSize
+        self.tileRow = 0
+        self.pending = np.zeros((width, 0, 3), dtype=np.uint8)
+        self.unpaired = self.pending
+        self.next = None
+        if level > 0:
+            self.next = PyramidLevel(level - 1, -(-width // 2), folder,
+                                     tileSize)
+        os.makedirs(self.folder, exist_ok=True)
+
+    def push(self, rows):
+        """Adds the next uint8 rows of this level, indexed [x, y]."""
+        self.pending = np.concatenate((self.pending, rows), axis=1)
+        while self.pending.shape[1] >= self.tileSize:
+            self.writeTiles(self.pending[:, :self.tileSize])
+            self.pending = self.pending[:, self.tileSize:]
+        if self.next is not None:
+            self.unpaired = np.concatenate((self.unpaired, rows), axis=1)
+            paired = self.unpaired.shape[1] // 2 * 2
+            if paired:
+                self.next.push(halve(self.unpaired[:, :paired]))
+                self.unpaired = self.unpaired[:, paired:]
+
+    def finish(self):
+        """Writes the last partial row of tiles, on every level."""
+        if self.pending.shape[1]:
+            self.writeTiles(self.pending)
+        if self.next is not None:
+            if self.unpaired.shape[1]:
+                # An odd last row is repeated
+                self.next.push(halve(np.repeat(self.unpaired, 2, axis=1)))
+            self.next.finish()
+
+    def writeTiles(self, rows):
+        """Cuts one row of tiles and saves them as column_row.png."""
+        for column, x in enumerate(range(0, self.width, self.tileSize)):
+            surface = pygame.surfarray.make_surface(
+                np.ascontiguousarray(rows[x:x + self.tileSize]))
+            pygame.image.save(surface, os.path.join(
+                self.folder, f"{column}_{self.tileRow}.png"))
+        self.tileRow += 1
+
+
+def writePyramid(strips, width, height, path, tileSize=TILE_SIZE):
+    """Writes a DZI pyramid of a width by height image given as strips
+       of uint8 rows from the top, each indexed [x, y]. Tiles go in the
+       folder path + "_files", the description in path + ".dzi"."""
+    levels = int(np.ceil(np.log2(max(width, height, 1))))
+    top = PyramidLevel(levels, width, path + "_files", tileSize)
+    rowsSeen = 0
+    for rows in strips:
+        top.push(rows)
+        rowsSeen += rows.shape[1]
+    if rowsSeen != height:
+        raise Exception(f"Got {rowsSeen} rows for an image {height} tall.")
+    top.finish()
+    with open(path + ".dzi", "w") as file:
+        file.write(DZI_TEMPLATE.format(tileSize=tileSize,
+                                       width=width, height=height))
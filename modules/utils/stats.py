@@ -0,0 +1,31 @@
+"""
+Counters for instrumenting renders.
+"""
+
+
+class RenderStats(object):
+    """Named counters collected while rendering."""
+    def __init__(self):
+        self.counters = {}
+
+    def count(self, name, amount=1):
+        """Adds amount to the counter called name."""
+        self.counters[name] = self.counters.get(name, 0) + amount
+
+    def get(self, name):
+        """Returns the value of a counter, 0 if never counted."""
+        return self.counters.get(name, 0)
+
+    def getRate(self, hits, misses):
+        """Returns hits / (hits + misses), or 0 if neither happened."""
+        total = self.get(hits) + self.get(misses)
+        return self.get(hits) / total if total else 0
+
+    def reset(self):
+        """Clears every counter."""
+        self.counters = {}
+
+    def report(self):
+        """Prints every counter."""
+        for name in sorted(self.counters):
+            print(f"{name}: {self.counters[name]}")
@@ -0,0 +1,112 @@
+"""
+Orders to visit the cells of a grid in, for pixels of a pass or
+chunks of a quilt. Curves keep consecutive cells close together so
+caches stay warm; spirals and regions of interest finish the part
+of the frame someone is looking at first.
+"""
+import argparse
+import numpy as np
+
+TRAVERSALS = ("scanline", "morton", "hilbert", "spiral", "roi")
+
+
+def spreadBits(values):
+    """Spreads the bits of values apart with a zero between each."""
+    result = np.zeros_like(values)
+    for bit in range(16):
+        result |= ((values >> bit) & 1) << (2 * bit)
+    return result
+
+
+def mortonOrder(columns, rows):
+    """Returns the Z-order curve index of each cell."""
+    i, j = np.meshgrid(np.arange(columns), np.arange(rows), indexing="ij")
+    return (spreadBits(i) | (spreadBits(j) << 1)).ravel()
+
+
+def hilbertOrder(columns, rows):
+    """Returns the Hilbert curve index of each cell, on the smallest
+       power of two square covering the grid."""
+    i, j = np.meshgrid(np.arange(columns), np.arange(rows), indexing="ij")
+    x = i.ravel().copy()
+    y = j.ravel().copy()
+    index = np.zeros_like(x)
+    side = 1 << int(np.ceil(np.log2(max(columns, rows, 1))))
+    s = side // 2
+    while s > 0:
+        rx = (x & s) > 0
+        ry = (y & s) > 0
+        index += s * s * ((3 * rx) ^ ry)
+        # Rotate the quadrant so the curve lines up
+        flip = ~ry & rx
+        x = np.where(flip, side - 1 - x, x)
+        y = np.where(flip, side - 1 - y, y)
+        x, y = np.where(~ry, y, x), np.where(~ry, x, y)
+        s //= 2
+    return index
+
+
+def spiralOrder(columns, rows, center=None):
+    """Returns an index going out from center (in cells, the middle of
+       the grid by default) one square ring at a time, turning around
+       each ring."""
+    if center is None:
+        center = ((columns - 1) / 2, (rows - 1) / 2)
+    i, j = np.meshgrid(np.arange(columns), np.arange(rows), indexing="ij")
+    dx = i.ravel() - center[0]
+    dy = j.ravel() - center[1]
+    ring = np.ceil(np.maximum(np.abs(dx), np.abs(dy)))
+    angle = np.arctan2(dy, dx)
+    return np.lexsort((angle, ring))
+
+
+def traversalOrder(traversal, columns, rows, cellSize=1,
+                   regionOfInterest=None):
+    """Returns the (column, row) cells of a grid in visiting order.
+       traversal is one of TRAVERSALS. The region of interest is given
+       in pixels as (x0, y0, x1, y1) over cells of cellSize pixels; the
+       "roi" order visits cells touching it first, spiralling out from
+       its center."""
+    i, j = np.meshgrid(np.arange(columns), np.arange(rows), indexing="ij")
+    cells = np.column_stack((i.ravel(), j.ravel()))
+    if traversal == "scanline":
+        return cells
+    elif traversal == "morton":
+        return cells[np.argsort(mortonOrder(columns, rows), kind="stable")]
+    elif traversal == "hilbert":
+        return cells[np.argsort(hilbertOrder(columns, rows), kind="stable")]
+    elif traversal == "spiral":
+        return cells[spiralOrder(columns, rows)]
+    elif traversal == "roi":
+        if regionOfInterest is None:
+            raise Exception("The roi traversal needs a region of interest.")
+        x0, y0, x1, y1 = regionOfInterest
+        center = ((x0 + x1) / 2 / cellSize - 0.5,
+                  (y0 + y1) / 2 / cellSize - 0.5)
+        spiral = cells[spiralOrder(columns, rows, center)]
+        inside = touchesRegion(spiral, cellSize, regionOfInterest)
+        return np.concatenate((spiral[inside], spiral[~inside]))
+    raise Exception(f"Unknown traversal {traversal}, must be one of "
+                    f"{', '.join(TRAVERSALS)}.")
+
+
+def touchesRegion(cells, cellSize, region):
+    """Returns which (column, row) cells of cellSize pixels overlap the
+       (x0, y0, x1, y1) pixel region."""
+    x0, y0, x1, y1 = region
+    left = cells[:, 0] * cellSize
+    top = cells[:, 1] * cellSize
+    return (left < x1) & (left + cellSize > x0) & \
+        (top < y1) & (top + cellSize > y0)
+
+
+def parseRegion(text):
+    """Parses an "x0,y0,x1,y1" region given on the command line."""
+    try:
+        region = tuple(int(value) for value in text.split(","))
+    except ValueError:
+        region = ()
+    if len(region) != 4 or region[0] >= region[2] or region[1] >= region[3]:
+        raise argparse.ArgumentTypeError("Regions must be x0,y0,x1,y1 "
+                                         "with x0 < x1 and y0 < y1.")
+    return region
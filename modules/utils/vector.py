@@ -20,6 +20,20 @@ def lerp(a, b, percent):
     return (1.0 - percent)*a + percent*b
 
 
+def slerp(a, b, percent):
+    """Interpolate between vectors a and b along the arc between their
+       directions, with the length interpolated linearly."""
+    lengthA, lengthB = magnitude(a), magnitude(b)
+    unitA, unitB = a / lengthA, b / lengthB
+    angle = np.arccos(np.clip(np.dot(unitA, unitB), -1, 1))
+    # The arc is undefined for parallel or opposite vectors
+    if np.sin(angle) < 1e-6:
+        return lerp(a, b, percent)
+    unit = (np.sin((1 - percent) * angle) * unitA +
+            np.sin(percent * angle) * unitB) / np.sin(angle)
+    return unit * lerp(lengthA, lengthB, percent)
+
+
 def smerp(a, b, percent):
     """Smooth interpolation."""
     percent = min(1.0, max(0.0, percent))
@@ -38,3 +52,13 @@ def vec(x, y=None, z=None):
 def posDot(v, w):
     dot = np.dot(v, w)
     return max(0.0, dot)
+
+
+def rotationMatrix(axis, angle):
+    """Make the 3x3 matrix rotating by angle radians around axis."""
+    x, y, z = normalize(np.asarray(axis, dtype=float))
+    cos, sin = np.cos(angle), np.sin(angle)
+    # Rodrigues' rotation formula
+    cross = np.array(((0, -z, y), (z, 0, -x), (-y, x, 0)))
+    return cos * np.eye(3) + sin * cross + \
+        (1 - cos) * np.outer((x, y, z), (x, y, z))
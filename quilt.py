@@ -1,11 +1,21 @@
 import pygame
 import os
 import time
+import queue
 import platform
+import threading
 import psutil
 import argparse
+import functools
+import numpy as np
 
 from render import ProgressiveRenderer, ShowTypes
+from modules.utils.files import atomicWrite
+from modules.utils.traversal import TRAVERSALS, traversalOrder, \
+    touchesRegion, parseRegion
+from modules.utils.leases import FileLeases, CoordinatorLeases, \
+    printNodeStats
+from modules.utils.pyramid import TILE_SIZE, writePyramid
 
 try:
     if platform.system() == "Windows":
@@ -20,6 +30,7 @@ except Exception as e:
     print(e)
 
 QUILT_SUBFOLDER = "quilt"
+MAX_PENDING_CHUNKS = 4
 
 
 def stitch(folderName):
@@ -44,6 +55,115 @@ def stitch(folderName):
     print("All done!")
 
 
+def blankRows(width, count):
+    """Yields count black rows, a tile's height at a time."""
+    for start in range(0, count, TILE_SIZE):
+        yield np.zeros((width, min(TILE_SIZE, count - start), 3),
+                       dtype=np.uint8)
+
+
+def readChunkRows(path, width, height=None):
+    """Yields the rows of a quilt from the top, one row of chunks at a
+       time, as uint8 arrays indexed [x, y]. Chunks missing from a row
+       are black, as are rows no chunk covers, such as those outside
+       a region, down to height if given."""
+    chunks = {}
+    for imageName in os.listdir(path):
+        if imageName.endswith(".png"):
+            x, y = [int(v) for v in imageName.split(".")[0].split("_")]
+            chunks.setdefault(y, []).append((x, imageName))
+    top = 0
+    for y in sorted(chunks):
+        yield from blankRows(width, y - top)
+        images = [(x, pygame.surfarray.array3d(
+                   pygame.image.load(os.path.join(path, imageName))))
+                  for x, imageName in chunks[y]]
+        rows = np.zeros((width, images[0][1].shape[1], 3), dtype=np.uint8)
+        for x, image in images:
+            rows[x:x + image.shape[0]] = image
+        yield rows
+        top = y + rows.shape[1]
+    if height is not None:
+        yield from blankRows(width, height - top)
+
+
+def buildPyramid(folderName, tileSize=TILE_SIZE):
+    """Writes a deep zoom pyramid of a quilt straight from its chunks,
+       one row of chunks at a time, beside where stitch would put the
+       finished image."""
+    path = os.path.join(QUILT_SUBFOLDER, folderName)
+    info = open(os.path.join(path, "info.txt"), "r")
+    width, height = [int(x) for x in info.read().split()]
+    info.close()
+    print("Building pyramid...")
+    writePyramid(readChunkRows(path, width, height), width, height, path,
+                 tileSize)
+    print(f"Pyramid written to {path}.dzi")
+
+
+class ChunkWriter(object):
+    """Quantizes, encodes and saves finished chunks on a background
+       thread so tracing can carry on during compression.
+       At most maxPending chunks wait in memory, after which submit
+       blocks until the disk catches up."""
+    def __init__(self, folder, maxPending=MAX_PENDING_CHUNKS,
+                 displayUpdates=True):
+        self.folder = folder
+        self.displayUpdates = displayUpdates
+        self.pending = queue.Queue(maxPending)
+        self.error = None
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def submit(self, fileName, colors, onSaved=None):
+        """Queues a chunk of colors in [0, 1], indexed [x, y].
+           onSaved is called on the writer thread once it is on disk."""
+        self.raiseError()
+        self.pending.put((fileName, colors, onSaved))
+
+    def run(self):
+        """Writes chunks until told to stop with None."""
+        while (item := self.pending.get()) is not None:
+            fileName, colors, onSaved = item
+            try:
+                if self.error is None:
+                    self.write(fileName, colors)
+                    if onSaved is not None:
+                        onSaved()
+            except Exception as e:
+                self.error = e
+            finally:
+                self.pending.task_done()
+        self.pending.task_done()
+
+    def write(self, fileName, colors):
+        """Saves one chunk. The png is only renamed into place once it
+           is fully on disk, so a half-written chunk never counts as
+           generated."""
+        surface = pygame.surfarray.make_surface(
+            (colors * 255).astype(np.uint8))
+        atomicWrite(os.path.join(self.folder, fileName),
+                    lambda file: pygame.image.save(surface, file, "png"))
+        if self.displayUpdates:
+            print(f"{fileName} saved.")
+
+    def raiseError(self):
+        """Re-raises a failure from the writer thread."""
+        if self.error is not None:
+            raise self.error
+
+    def flush(self):
+        """Waits for every queued chunk to be saved."""
+        self.pending.join()
+        self.raiseError()
+
+    def close(self):
+        """Flushes and stops the writer thread."""
+        self.pending.put(None)
+        self.thread.join()
+        self.raiseError()
+
+
 class QuiltRenderer(ProgressiveRenderer):
     @classmethod
     def main(cls, caption="Renderer"):
@@ -56,6 +176,25 @@ class QuiltRenderer(ProgressiveRenderer):
         parser.add_argument("-sh", "--show", help="Show")
         parser.add_argument("-s", "--sample", help="Sample", type=int)
         parser.add_argument("-f", "--file", help="File")
+        parser.add_argument("-o", "--order", help="Chunk order",
+                            choices=TRAVERSALS, default="scanline")
+        parser.add_argument("--roi", help="Region of interest x0,y0,x1,y1",
+                            type=parseRegion)
+        parser.add_argument("--region",
+                            help="Only trace the chunks over x0,y0,x1,y1",
+                            type=parseRegion)
+        parser.add_argument("--shared",
+                            help="Lease chunks through files in the quilt "
+                                 "folder, to share it between nodes",
+                            action="store_true")
+        parser.add_argument("--coordinator",
+                            help="Lease chunks from a quiltCoordinator.py "
+                                 "at host:port")
+        parser.add_argument("--node", help="Name of this node in stats")
+        parser.add_argument("--pyramid",
+                            help="Build a deep zoom pyramid once every "
+                                 "chunk is done",
+                            action="store_true")
         args = parser.parse_args()
         filename = args.file if args.file is not None else "quilt"
         if args.show is not None and args.show != "NoShow":
@@ -65,6 +204,17 @@ class QuiltRenderer(ProgressiveRenderer):
         # Set up renderer
         cls.renderer = cls(samplePerPixel=sample,
                            file=filename)
+        cls.renderer.setTraversal(args.order, args.roi)
+        if args.region is not None:
+            cls.renderer.setRegion(args.region)
+        if args.coordinator is not None:
+            host, port = args.coordinator.rsplit(":", 1)
+            cls.renderer.setLeases(CoordinatorLeases(host, int(port),
+                                                     args.node))
+        elif args.shared:
+            cls.renderer.setLeases(FileLeases(cls.renderer.quiltFolder,
+                                              args.node))
+        cls.renderer.pyramid = args.pyramid
         cls.renderer.startPygame(caption)
         cls.stepper = cls.renderer.render()
 
@@ -91,6 +241,8 @@ class QuiltRenderer(ProgressiveRenderer):
         self.chunkStartY = 0
         self.chunkEndX = self.width
         self.chunkEndY = self.height
+        self.leases = None
+        self.pyramid = False
         if not os.path.exists(QUILT_SUBFOLDER):
             os.mkdir(QUILT_SUBFOLDER)
         self.quiltFolder = os.path.join(QUILT_SUBFOLDER,
@@ -106,6 +258,50 @@ class QuiltRenderer(ProgressiveRenderer):
         self.chunkEndX = x
         self.chunkEndY = y
 
+    def setRegion(self, region):
+        """Traces only the chunks over region, laid out from its corner
+           and cut off at its far edges. Stitching puts them in place
+           in the whole image."""
+        super().setRegion(region)
+        x0, y0, x1, y1 = self.region
+        self.setChunkStart(x0, y0)
+        self.setChunkEnd(x1, y1)
+
+    def setLeases(self, leases):
+        """Claims each chunk from leases before tracing it, so several
+           nodes can render the same quilt folder."""
+        self.leases = leases
+
+    def claimChunk(self, pending):
+        """Claims the first of the pending (index, x, y, file name)
+           chunks that no other node holds. While every one left is
+           held elsewhere, waits in case a lease expires.
+           Returns the claimed entry, or None once all are completed."""
+        while True:
+            chunk = self.leases.claim(entry[3] for entry in pending)
+            if chunk is not None:
+                return next(entry for entry in pending if entry[3] == chunk)
+            completed = self.leases.getCompleted()
+            pending[:] = [entry for entry in pending
+                          if entry[3] not in completed]
+            if not pending:
+                return None
+            time.sleep(self.leases.heartbeatInterval)
+
+    def traceChunk(self, x, y, chunkWidth, chunkHeight, chunkFileName):
+        """Returns the colors of a chunk, or None if its lease was lost
+           to another node before it was done."""
+        chunkColors = np.zeros((chunkWidth, chunkHeight, 3))
+        for ix in range(x, x+chunkWidth):
+            if self.leases is not None and \
+               self.leases.isLost(chunkFileName):
+                return None
+            for iy in range(y, y+chunkHeight):
+                # Get color
+                chunkColors[ix - x, iy - y] = \
+                    self.getColor(ix, iy, self.samplePerPixel)
+        return chunkColors
+
     def render(self):
         """The main loop of rendering the image.
         Will create pixels of progressively smaller sizes. Stops rendering
@@ -113,45 +309,117 @@ class QuiltRenderer(ProgressiveRenderer):
         startTime = time.time()
         # First progress is to fill entire image with one color
         color = self.getColor(0, 0)
-        self.image.fill(color, ((0, 0), (self.width, self.height)))
+        self.pixels[:] = color
         info = open(os.path.join(self.quiltFolder, "info.txt"), "w")
         info.write(f"{self.width} {self.height}")
         info.close()
-        # For each pixel in the image, jumping by pixel size
-        for x in range(self.chunkStartX, self.chunkEndX, self.chunkSize):
-            for y in range(self.chunkStartY, self.chunkEndY, self.chunkSize):
-                chunkWidth = min(self.width - x, self.chunkSize)
-                chunkHeight = min(self.height - y, self.chunkSize)
-                chunkImage = pygame.Surface((chunkWidth,
-                                             chunkHeight))
-                chunkFileName = f"{x}_{y}.png"
+        writer = ChunkWriter(self.quiltFolder,
+                             displayUpdates=self.displayUpdates)
+        # Chunks are visited in the traversal order, relative to the start
+        columns = -(-(self.chunkEndX - self.chunkStartX) // self.chunkSize)
+        rows = -(-(self.chunkEndY - self.chunkStartY) // self.chunkSize)
+        regionOfInterest = None
+        if self.regionOfInterest is not None:
+            x0, y0, x1, y1 = self.regionOfInterest
+            regionOfInterest = (x0 - self.chunkStartX, y0 - self.chunkStartY,
+                                x1 - self.chunkStartX, y1 - self.chunkStartY)
+        chunks = traversalOrder(self.traversal, columns, rows,
+                                self.chunkSize, regionOfInterest)
+        # The preview is ready once every chunk over its region is done
+        x0, y0, x1, y1 = self.getPreviewRegion()
+        lastPreviewIndex = np.nonzero(touchesRegion(
+            chunks, self.chunkSize,
+            (x0 - self.chunkStartX, y0 - self.chunkStartY,
+             x1 - self.chunkStartX, y1 - self.chunkStartY)))[0]
+        lastPreviewIndex = lastPreviewIndex[-1] \
+            if len(lastPreviewIndex) else None
+        # Chunks left to trace, as (index, x, y, file name)
+        pending = []
+        chunkFileNames = []
+        for index, (column, row) in enumerate(chunks.tolist()):
+            x = self.chunkStartX + column * self.chunkSize
+            y = self.chunkStartY + row * self.chunkSize
+            chunkFileName = f"{x}_{y}.png"
+            chunkFileNames.append(chunkFileName)
+            if os.path.isfile(os.path.join(self.quiltFolder,
+                                           chunkFileName)):
+                print(f"{chunkFileName} already generated. Skipping.")
+                print("===============================")
+                continue
+            pending.append((index, x, y, chunkFileName))
+        try:
+            while pending:
+                claimed = pending[0] if self.leases is None else \
+                    self.claimChunk(pending)
+                if claimed is None:
+                    break
+                index, x, y, chunkFileName = claimed
+                chunkWidth = min(self.chunkEndX - x, self.chunkSize)
+                chunkHeight = min(self.chunkEndY - y, self.chunkSize)
                 if self.displayUpdates:
                     print(f"{chunkFileName} starting.")
-                if os.path.isfile(os.path.join(self.quiltFolder,
-                                               chunkFileName)):
-                    print(f"{chunkFileName} already generated. Skipping.")
+                chunkStart = time.time()
+                chunkColors = self.traceChunk(x, y, chunkWidth, chunkHeight,
+                                              chunkFileName)
+                if chunkColors is None:
+                    # Left pending, to claim again if the node that took it
+                    # over stops renewing it too, until it is completed
+                    print(f"{chunkFileName} lease lost. Skipping.")
                     print("===============================")
                     continue
-                for ix in range(x, x+self.chunkSize):
-                    for iy in range(y, y+self.chunkSize):
-                        # Get color
-                        color = self.getColor(ix, iy, self.samplePerPixel) * \
-                                255
-                        chunkImage.fill(color, ((ix - x, iy - y), (1, 1)))
-                pygame.image.save(chunkImage, os.path.join(self.quiltFolder,
-                                                           chunkFileName))
+                pending.remove(claimed)
+                # Saved in the background while the next chunk traces,
+                # and only then completed in the manifest
+                onSaved = None if self.leases is None else \
+                    functools.partial(self.leases.complete, chunkFileName,
+                                      time.time() - chunkStart,
+                                      chunkWidth * chunkHeight)
+                writer.submit(chunkFileName, chunkColors, onSaved)
+                if index == lastPreviewIndex:
+                    self.previewTime = time.time() - startTime
                 if self.displayUpdates:
                     print(f"{chunkFileName} completed.")
                     print("===============================")
-        # Done rendering
-        self.done = True
-        endTime = time.time()
-        if self.displayUpdates:
-            print()
-            print(f"Completed in {(endTime - startTime):.4f} seconds",
-                  flush=True)
+            writer.close()
+            # Done rendering
+            self.done = True
+            endTime = time.time()
+            if self.displayUpdates:
+                print()
+                print(f"Completed in {(endTime - startTime):.4f} seconds",
+                      flush=True)
+                if self.previewTime is not None:
+                    print(f"Chunks over {self.getPreviewRegion()} done in "
+                          f"{self.previewTime:.4f} seconds")
+                self.reportStats()
+                if self.leases is not None:
+                    printNodeStats(self.leases.getNodeStats())
+        finally:
+            if self.leases is not None:
+                self.leases.close()
+        if self.pyramid:
+            # With leases, other nodes may still be finishing chunks
+            if all(os.path.isfile(os.path.join(self.quiltFolder, name))
+                   for name in chunkFileNames):
+                buildPyramid(os.path.basename(self.quiltFolder))
+            else:
+                print("Chunks are still missing, build the pyramid with "
+                      "quilt.py --pyramid once they are done.")
 
 
 if __name__ == '__main__':
-    folder = input("Enter folder name to stitch: ")
-    stitch(folder)
+    parser = argparse.ArgumentParser()
+    parser.add_argument("folder", nargs="?", help="Folder to stitch")
+    parser.add_argument("--pyramid",
+                        help="Build a deep zoom pyramid instead, without "
+                             "the whole image in memory",
+                        action="store_true")
+    parser.add_argument("--tile-size", help="Pyramid tile size", type=int,
+                        default=TILE_SIZE)
+    args = parser.parse_args()
+    folder = args.folder if args.folder is not None else \
+        input("Enter folder name to stitch: ")
+    if args.pyramid:
+        buildPyramid(folder, args.tile_size)
+    else:
+        stitch(folder)
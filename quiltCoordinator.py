@@ -0,0 +1,84 @@
+"""
+Coordinator for quilts rendered by several nodes.
+
+Hands out leases on chunks of one quilt folder over localhost or the
+network in JSON lines, expiring leases that stop being renewed, and
+records finished chunks in the folder's manifest.
+Nodes sharing the quilt folder over a network filesystem can use
+lease files instead with quilt --shared, and no coordinator.
+
+To Run:
+    python3 quiltCoordinator.py serve quilt/myQuilt --port 8765
+    python3 yourQuiltRenderer.py -f myQuilt --coordinator host:8765
+    python3 quiltCoordinator.py status quilt/myQuilt
+"""
+import os
+import json
+import asyncio
+import argparse
+
+from modules.utils.leases import LEASE_SECONDS, LEASE_FOLDER, LeaseTable, \
+    readManifest, summarizeManifest, printNodeStats
+
+DEFAULT_PORT = 8765
+
+
+class QuiltCoordinator(object):
+    """Serves a lease table to render nodes."""
+    def __init__(self, folder, leaseSeconds=LEASE_SECONDS):
+        self.table = LeaseTable(folder, leaseSeconds)
+
+    async def serve(self, host="127.0.0.1", port=DEFAULT_PORT):
+        """Serves forever on host and port."""
+        # Claims list every chunk left, so lines can be long
+        server = await asyncio.start_server(self.handleClient, host, port,
+                                            limit=2 ** 24)
+        print(f"Coordinating {self.table.folder} on {host}:{port}, "
+              f"{len(self.table.completed)} chunks already completed")
+        async with server:
+            await server.serve_forever()
+
+    async def handleClient(self, reader, writer):
+        """Reads JSON line requests from one node."""
+        while line := await reader.readline():
+            try:
+                reply = self.table.handleRequest(json.loads(line))
+            except (ValueError, KeyError) as e:
+                reply = {"error": str(e)}
+            writer.write((json.dumps(reply) + "\n").encode())
+            await writer.drain()
+        writer.close()
+
+
+def printStatus(folder):
+    """Prints the completed chunks and throughput of each node, and
+       how many lease files are outstanding for shared folders."""
+    records = readManifest(folder)
+    print(f"{len(records)} chunks completed")
+    printNodeStats(summarizeManifest(records))
+    leaseFolder = os.path.join(folder, LEASE_FOLDER)
+    if os.path.isdir(leaseFolder):
+        leases = [name for name in os.listdir(leaseFolder)
+                  if name.endswith(".lease")]
+        print(f"{len(leases) - len(records)} chunks leased")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("command", choices=("serve", "status"))
+    parser.add_argument("folder", help="Quilt folder")
+    parser.add_argument("--host", help="Host", default="127.0.0.1")
+    parser.add_argument("--port", help="Port", type=int,
+                        default=DEFAULT_PORT)
+    parser.add_argument("--lease-seconds", help="Seconds a lease lasts",
+                        type=float, default=LEASE_SECONDS)
+    args = parser.parse_args()
+    if args.command == "serve":
+        coordinator = QuiltCoordinator(args.folder, args.lease_seconds)
+        asyncio.run(coordinator.serve(args.host, args.port))
+    else:
+        printStatus(args.folder)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,5 +1,8 @@
 # textures on planes,
 """ Author: Liz Matthews, Geoff Matthews """
+import json
+import time
+import threading
 import numpy as np
 import pygame as pg
 
@@ -7,11 +10,14 @@ from render import ProgressiveRenderer, ShowTypes
 # from quilt import QuiltRenderer
 # from reverseQuilt import RQuiltRenderer
 from modules.raytracing.scene import Scene
-from modules.raytracing.spherical import Sphere, Ellipsoid
-from modules.raytracing.planar import Plane
 from modules.raytracing.ray import Ray
+from modules.raytracing.incremental import RayLog
+from modules.raytracing.gbuffer import GBuffer
+from modules.raytracing.lighttree import LightTree
+from modules.raytracing.denoise import RADIUS, Denoiser
 from modules.utils.vector import vec, normalize, lerp
 from modules.utils.definitions import twoFiftyFiveToOnePointO
+from modules.utils.stats import RenderStats
 
 SCREEN_MULTIPLIER = 1/16
 WIDTH = 10800
@@ -21,6 +27,22 @@ X = 0
 Y = 1
 Z = 2
 AIR = None
+# Shared by every ray that adds nothing, so must never be written to
+NO_COLOR = np.zeros(3)
+NO_COLOR.flags.writeable = False
+# What surfaces that do not refract blend with their reflections
+NO_REFRACTION = vec(1, 1, 1)
+NO_REFRACTION.flags.writeable = False
+# Frames per second to hold while the camera moves interactively
+TARGET_FPS = 15
+# Fraction of the distance to the focus moved per key press
+MOVE_STEP = 0.1
+# Radians turned per key press, and per pixel the mouse is dragged
+TURN_STEP = np.radians(5)
+MOUSE_TURN = np.radians(0.25)
+ZOOM_STEP = 1.1
+# Milliseconds before held keys repeat, and between repeats
+KEY_REPEAT = (150, 30)
 
 
 class RayTracer(ProgressiveRenderer):
@@ -29,18 +51,348 @@ class RayTracer(ProgressiveRenderer):
                  height=int(HEIGHT * SCREEN_MULTIPLIER),
                  show=ShowTypes.PerColumn,
                  samplePerPixel=1,
-                 file=None):
+                 file=None,
+                 scene=None):
         super().__init__(width, height, show=show,
                          samplePerPixel=samplePerPixel,
                          file=file)
         self.fog = vec(0.7, 0.9, 1.0)
-        self.scene = Scene(aspect=width/height, fov=45)
+        self.maxRecursionDepth = MAX_RECURSION_DEPTH
+        # Secondary rays carrying less weight than this are dropped
+        self.rayThreshold = 0
+        # Or survive with probability weight / rayThreshold, scaled up
+        # to keep the expected weight. Reflected and refracted colors are
+        # normalized once blended, which is not linear, so the mean
+        # still drifts slightly; goldenImages.py --roulette measures it
+        self.roulette = False
+        self.random = np.random.default_rng(0)
+        self.stats = RenderStats()
+        # Each thread's remembered occluders, texel and scratch colors
+        self.threadState = threading.local()
+        # Bumped to make every thread forget its occluders
+        self.shadowGeneration = 0
+        # None shades every light with the classic loop, 0 sums every
+        # light, more picks that many lights per hit from a light tree
+        self.lightSamples = None
+        self.lightTree = None
+        self.scene = scene if scene is not None else \
+            Scene(aspect=width/height, fov=45)
+        self.rayLog = None
+        self.snapshot = None
+        self.framebuffer = None
+        self.gBuffer = None
+        self.gBufferPixel = None
+        self.interactive = False
+        self.targetFps = TARGET_FPS
+        self.denoiser = None
         print("Camera Position:", self.scene.camera.getPosition())
         for obj in self.scene.objects:
             print(repr(obj) + " Position: " + str(obj.position))
         for light in self.scene.lights:
             print(repr(light) + " Position: " + str(light.position))
 
+    @classmethod
+    def addArguments(cls, parser):
+        parser.add_argument("--ray-threshold",
+                            help="Drop secondary rays below this weight",
+                            type=float, default=0)
+        parser.add_argument("--roulette",
+                            help="Russian roulette below the threshold",
+                            action="store_true")
+        parser.add_argument("--light-samples",
+                            help="Shadow rays per hit, 0 for every light",
+                            type=int)
+        parser.add_argument("--interactive",
+                            help="Move the camera with the keyboard "
+                                 "and mouse",
+                            action="store_true")
+        parser.add_argument("--target-fps",
+                            help="Frames per second while moving",
+                            type=float, default=TARGET_FPS)
+        parser.add_argument("--denoise",
+                            help="Filter the finished image guided by "
+                                 "albedo, normals, depth and object IDs",
+                            action="store_true")
+        parser.add_argument("--denoise-radius",
+                            help="Pixels the denoiser looks out to",
+                            type=int, default=RADIUS)
+
+    def applyArguments(self, args):
+        self.rayThreshold = args.ray_threshold
+        self.roulette = args.roulette
+        self.lightSamples = args.light_samples
+        self.interactive = args.interactive
+        self.targetFps = args.target_fps
+        if self.interactive:
+            pg.key.set_repeat(*KEY_REPEAT)
+        if args.denoise:
+            self.enableDenoiser(args.denoise_radius)
+
+    def reportStats(self):
+        self.stats.report()
+        shadowRate = self.stats.getRate("shadowCacheHits",
+                                        "shadowCacheMisses")
+        texelRate = self.stats.getRate("texelCacheHits", "texelCacheMisses")
+        print(f"Shadow cache hit rate: {shadowRate:.2%}")
+        print(f"Texel cache hit rate: {texelRate:.2%}")
+        if self.denoiser is not None:
+            self.denoiser.report()
+
+    def restartRender(self):
+        super().restartRender()
+        self.clearShadowCache()
+
+    def handleOtherInput(self, event):
+        """Moves the camera when interactive. The arrow keys move it
+           and its focus, page up and down raise and lower them, i, j,
+           k and l or dragging the mouse turn it around the focus, and
+           the mouse wheel zooms."""
+        if not self.interactive:
+            return
+        camera = self.scene.camera
+        step = camera.distance * MOVE_STEP
+        # Moving forward and sideways keeps to the level of the focus
+        up = normalize(camera.worldUp)
+        flat = normalize(camera.getForward() -
+                         np.dot(camera.getForward(), up) * up)
+        moves = {pg.K_UP: flat * step,
+                 pg.K_DOWN: -flat * step,
+                 pg.K_RIGHT: camera.getRight() * step,
+                 pg.K_LEFT: -camera.getRight() * step,
+                 pg.K_PAGEUP: up * step,
+                 pg.K_PAGEDOWN: -up * step}
+        turns = {pg.K_j: (TURN_STEP, 0),
+                 pg.K_l: (-TURN_STEP, 0),
+                 pg.K_i: (0, TURN_STEP),
+                 pg.K_k: (0, -TURN_STEP)}
+        if event.type == pg.KEYDOWN and event.key in moves:
+            camera.move(moves[event.key])
+        elif event.type == pg.KEYDOWN and event.key in turns:
+            camera.orbit(*turns[event.key])
+        elif event.type == pg.MOUSEMOTION and event.buttons[0]:
+            dx, dy = event.rel
+            camera.orbit(-dx * MOUSE_TURN, -dy * MOUSE_TURN)
+        elif event.type == pg.MOUSEWHEEL:
+            camera.zoom(ZOOM_STEP ** -event.y)
+        else:
+            return
+        self.requestRestart(self.getInteractivePixelSize())
+
+    def getInteractivePixelSize(self):
+        """Returns the finest pixel size whose pass fits in one frame
+           at the target frame rate, going by the last measured seconds
+           per sample. Rendering restarts there while the camera moves
+           and refines from it once it stops."""
+        if self.secondsPerSample is None:
+            return self.startPixelSize
+        pixelSize = 1
+        while pixelSize < self.startPixelSize and \
+                self.getPassCost(pixelSize, self.secondsPerSample) > \
+                1 / self.targetFps:
+            pixelSize *= 2
+        return pixelSize
+
+    def clearShadowCache(self):
+        """Forgets the remembered occluders and the light tree, for
+           when objects or lights change. Each thread drops its
+           occluders the next time it looks one up."""
+        self.shadowGeneration += 1
+        self.lightTree = None
+
+    def findOccluder(self, shadowRay, light, nearestObject,
+                     maxDistance=np.inf):
+        """Returns the object blocking shadowRay, which leaves
+           nearestObject, and the distance to it. Neighboring pixels
+           are usually blocked by the same object, so the last occluder
+           found for light on this thread is tried before searching
+           every object.
+           A remembered occluder only counts if closer than maxDistance."""
+        state = self.threadState
+        if getattr(state, "generation", None) != self.shadowGeneration:
+            state.occluders = {}
+            state.generation = self.shadowGeneration
+        cached = state.occluders.get(light)
+        if cached is not None and \
+           (distance := cached.intersectFrom(shadowRay, nearestObject)) < \
+           maxDistance:
+            self.stats.count("shadowCacheHits")
+            return cached, distance
+        self.stats.count("shadowCacheMisses")
+        occluder, distance = self.scene.nearestObject(shadowRay,
+                                                      nearestObject)
+        if occluder is not None:
+            state.occluders[light] = occluder
+        return occluder, distance
+
+    def getScratch(self, recursionCount):
+        """Returns this thread's buffer for the color of a hit at
+           recursionCount. Every hit at that depth reuses it, so the
+           color is only good until the next ray at the same depth."""
+        scratch = getattr(self.threadState, "scratch", None)
+        if scratch is None or len(scratch) <= recursionCount:
+            scratch = [np.empty(3) for _ in
+                       range(max(self.maxRecursionDepth, recursionCount) + 1)]
+            self.threadState.scratch = scratch
+        return scratch[recursionCount]
+
+    def getRecursionDepth(self):
+        """Returns how deep reflections and refractions are followed."""
+        return self.maxRecursionDepth
+
+    def setRecursionDepth(self, depth):
+        """Sets how deep reflections and refractions are followed."""
+        self.maxRecursionDepth = depth
+
+    def enableRayLog(self):
+        """Starts recording the ray tree of every traced pixel,
+           so that applySceneDiff can re-trace only what changed."""
+        self.rayLog = RayLog()
+        self.framebuffer = np.zeros((self.width, self.height, 3))
+        self.snapshot = self.scene.snapshot()
+
+    def applySceneDiff(self, diff=None):
+        """Re-traces the pixels whose ray trees touched the old or new
+           bounds of anything in diff. Without a diff, the changes since
+           the last render or update are used.
+           Returns the updated framebuffer."""
+        if self.rayLog is None:
+            raise Exception("Call enableRayLog before rendering to apply "
+                            "scene diffs.")
+        if diff is None:
+            diff = self.scene.diff(self.snapshot)
+        self.clearShadowCache()
+        pixels = self.rayLog.pixelsAffectedBy(diff)
+        print(f"Re-tracing {len(pixels)} of "
+              f"{self.width * self.height} pixels")
+        for x, y in pixels:
+            count = self.sampleCounts[x, y] if self.accumulate else 0
+            if count > 0:
+                # As many samples, at the same offsets, as it had
+                self.accumulation[x, y] = 0
+                self.sampleCounts[x, y] = 0
+                for _ in range(count):
+                    color = self.addSample(x, y)
+            else:
+                color = self.getColor(x, y, self.samplePerPixel)
+            if hasattr(self, "pixels"):
+                self.fillPixels(color * 255, x, y, 1)
+        if hasattr(self, "pixels"):
+            self.uploadImage()
+            self.showProgress()
+        self.snapshot = self.scene.snapshot()
+        return self.framebuffer
+
+    def getCheckpointState(self):
+        """Saves the random state, so that rouletted rays and sampled
+           lights carry on as if never stopped, and any G-buffer."""
+        state = {"random": json.dumps(self.random.bit_generator.state)}
+        if self.gBuffer is not None:
+            arrays = self.gBuffer.getArrays(self.getMaterials())
+            state.update({"gBuffer_" + name: array
+                          for name, array in arrays.items()})
+        return state
+
+    def setCheckpointState(self, checkpoint):
+        self.random.bit_generator.state = json.loads(
+            str(checkpoint["random"]))
+        if self.gBuffer is not None:
+            if "gBuffer_objectId" not in checkpoint:
+                raise Exception("Checkpoint was made without a G-buffer, "
+                                "so cannot be resumed with one.")
+            self.gBuffer.setArrays({name[len("gBuffer_"):]: checkpoint[name]
+                                    for name in checkpoint.files
+                                    if name.startswith("gBuffer_")},
+                                   self.getMaterials())
+
+    def getMaterials(self):
+        """Returns every material in the scene, in the order of the
+           objects, with an instance group's shared ones in theirs."""
+        materials = []
+        for obj in self.scene.objects:
+            materials.extend(getattr(obj, "materials", None)
+                             or [obj.getMaterial()])
+        return materials
+
+    def enableGBuffer(self):
+        """Starts capturing the primary hit of every traced pixel,
+           so that relight can re-shade without re-intersecting."""
+        self.gBuffer = GBuffer(self.width, self.height)
+
+    def enableDenoiser(self, radius=RADIUS):
+        """Denoises every finished render, guided by a GBuffer
+           captured along the way."""
+        self.denoiser = Denoiser(radius)
+        if self.gBuffer is None:
+            self.enableGBuffer()
+
+    def postProcess(self):
+        if self.denoiser is not None:
+            # Only what was traced, so a region costs its own area
+            region = self.getRegionSlices()
+            self.pixels[region] = self.denoiser.denoise(
+                self.pixels[region] / 255,
+                self.gBuffer.crop(*self.getRegion())) * 255
+
+    def relight(self, exact=False):
+        """Re-evaluates only shadows and Phong shading against the
+           current lights, reusing the captured G-buffer.
+           Reflections and refractions keep their captured colors,
+           unless exact is set, in which case pixels that show them
+           are fully re-traced instead.
+           Returns the relit framebuffer."""
+        startTime = time.time()
+        self.clearShadowCache()
+        gBuffer = self.gBuffer
+        hits = gBuffer.objectId >= 0
+        if exact:
+            hits &= ~gBuffer.secondary
+        objects = [self.scene.objects[i] for i in gBuffer.objectId[hits]]
+        materials = [gBuffer.materials[i] for i in gBuffer.materialId[hits]]
+        ambient = np.array([material.getAmbient() for material in materials],
+                           dtype=float).reshape(-1, 3)
+        specular = np.array([material.getSpecular()
+                             for material in materials],
+                            dtype=float).reshape(-1, 3)
+        shine = np.array([material.getShine() for material in materials])
+        specCoeff = np.array([material.getSpecularCoefficient()
+                              for material in materials])
+        points = gBuffer.position[hits]
+        normals = gBuffer.normal[hits]
+        directions = gBuffer.viewDirection[hits]
+        color = gBuffer.surfaceColor[hits]
+        shadowed = np.zeros(len(objects), dtype=bool)
+        for light in self.scene.lights:
+            vectorsToLight = light.getVectorsToLight(points)
+            # Once shadowed by any light a point is only ambient
+            for i in np.nonzero(~shadowed)[0]:
+                shadowedObject, _ = self.findOccluder(
+                    Ray(points[i], vectorsToLight[i]), light, objects[i])
+                shadowed[i] = shadowedObject is not None
+            # 07 Slides, Slide 16
+            diffuse = np.maximum(0, np.einsum("ij,ij->i",
+                                              vectorsToLight, normals))
+            halfway = -vectorsToLight + directions
+            halfway /= np.linalg.norm(halfway, axis=1)[:, np.newaxis]
+            specularAngle = np.einsum("ij,ij->i", normals, halfway) ** \
+                shine * specCoeff
+            specularColor = specularAngle[:, np.newaxis] * specular
+            specularColor[specularColor[:, X] <= 0] = 0
+            color = color * diffuse[:, np.newaxis] + ambient + specularColor
+        color[shadowed] = ambient[shadowed]
+        framebuffer = np.empty((self.width, self.height, 3))
+        framebuffer[:] = self.fog
+        framebuffer[hits] = color
+        framebuffer = np.nan_to_num(np.clip(framebuffer, 0, 1), 0)
+        if exact:
+            for x, y in np.argwhere(gBuffer.secondary):
+                framebuffer[x, y] = self.getColor(x, y, self.samplePerPixel)
+        if hasattr(self, "pixels"):
+            self.pixels[:] = framebuffer * 255
+            self.uploadImage()
+            self.showProgress()
+        print(f"Relit in {(time.time() - startTime):.4f} seconds")
+        return framebuffer
+
     def getBetweenAngle(self, vector1, vector2):
         """Returns an angle that is
            between vector1 and vector2.
@@ -100,33 +452,28 @@ class RayTracer(ProgressiveRenderer):
         # 13 Slides, slide 27
         return reflectance + (1 - reflectance) * (1 - np.cos(theta)) ** 5
 
-    def returnImage(self, obj, surfaceHitPoint):
-        """Returns the color of the image we hit."""
+    def returnImage(self, hit):
+        """Returns the color of the image we hit, with the texture
+           coordinates wrapping around. Objects without texture
+           coordinates show their base color."""
         # 11 Slides, Slide 20
-        if type(obj) is Sphere or \
-           type(obj) is Ellipsoid:
-            # 11 Slides, Slide 49
-            d = normalize(obj.getPosition() - surfaceHitPoint)
-            u = 0.5 + (np.arctan2(d[Z], d[X]) / (2 * np.pi))
-            v = np.arccos(d[Y]) / np.pi
-            # 11 Slides, Slide 21
-            px = int(u * obj.getImage().get_width()) % \
-                obj.getImage().get_width()
-            py = int(v * obj.getImage().get_height()) % \
-                obj.getImage().get_height()
-            return twoFiftyFiveToOnePointO(obj.getImage().get_at((px, py)))
-        # TODO get working for cubes
-        elif type(obj) is Plane:
-            normal = obj.getNormal()
-            forward = self.scene.camera.getForward()
-            u = np.cross(normal, forward)
-            v = np.cross(normal, u)
-            # 11 Slides, Slide 24
-            p = normalize(surfaceHitPoint - obj.getPosition())
-            coordinateU = int(np.dot(u, p)) % obj.getImage().get_width()
-            coordinateV = int(np.dot(v, p)) % obj.getImage().get_height()
-            return twoFiftyFiveToOnePointO(obj.getImage().get_at(
-                (coordinateU, coordinateV)))
+        u, v = hit.uv
+        image = hit.obj.getImage()
+        if np.isnan(u) or np.isnan(v):
+            return hit.obj.getBaseColor()
+        # 11 Slides, Slide 21
+        px = int(u * image.get_width()) % image.get_width()
+        py = int(v * image.get_height()) % image.get_height()
+        # Neighboring pixels often land on the same texel
+        texel = (image, px, py)
+        cached = getattr(self.threadState, "texel", None)
+        if cached is not None and cached[0] == texel:
+            self.stats.count("texelCacheHits")
+            return cached[1]
+        self.stats.count("texelCacheMisses")
+        color = twoFiftyFiveToOnePointO(image.get_at((px, py)))
+        self.threadState.texel = (texel, color)
+        return color
 
     def getDiffuse(self, vectorToLight, normal):
         """Gets the diffuse. Expects normalized vectors"""
@@ -145,30 +492,61 @@ class RayTracer(ProgressiveRenderer):
         # 07 Slides, Slide 20
         return specularColor if \
             (specularColor := specularAngle * objectSpecularColor)[X] > 0 \
-            else vec(0, 0, 0)  # Prevent black specular spots
+            else NO_COLOR  # Prevent black specular spots
 
-    def recur(self, ray, value, recursionCount):
-        return self.getColorR(ray, recursionCount + 1) * value \
-               if value != 0 and recursionCount < MAX_RECURSION_DEPTH \
-               else np.zeros(3)
+    def recur(self, ray, value, recursionCount, weight=1.0):
+        """Returns the color along a secondary ray scaled by value.
+           weight is how much the ray can still add to the pixel, and
+           rays below the threshold are dropped or Russian rouletted,
+           which is close to but not exactly unbiased, see roulette."""
+        if value == 0 or recursionCount >= self.maxRecursionDepth:
+            return NO_COLOR
+        weight = abs(weight * value)
+        survival = 1
+        # Nothing this ray finds can show, so never trace it
+        if weight == 0 or weight < self.rayThreshold:
+            survival = weight / self.rayThreshold \
+                if self.roulette and weight > 0 else 0
+            if survival == 0 or self.random.random() >= survival:
+                self.stats.count("secondaryRaysSaved")
+                return NO_COLOR
+            # Survivors stand in for the rays that were killed
+            weight = self.rayThreshold
+        self.stats.count("secondaryRays")
+        return self.getColorR(ray, recursionCount + 1, weight) * value / \
+            survival
 
-    def getColorR(self, ray, recursionCount=0):
+    def getColorR(self, ray, recursionCount=0, weight=1.0):
         """Returns color with diffuse and specualr attached.
-           Expects a normalized ray."""
-        color = np.zeros(3)
-        nearestObject, minDist = self.scene.nearestObject(ray)
+           Expects a normalized ray.
+           weight is the share of the pixel this ray can still change.
+           The color returned is only good until the next ray traced at
+           the same recursion depth."""
+        hit = self.scene.nearestHit(ray)
+        if self.rayLog is not None:
+            self.rayLog.record(ray, hit.distance if hit is not None
+                               else np.inf)
         # We hit nothing
-        if nearestObject is None:
+        if hit is None:
             return self.fog
-        surfaceHitPoint = ray.getPositionAt(minDist)
-        normal = nearestObject.getNormal(surfaceHitPoint)
+        nearestObject = hit.obj
+        surfaceHitPoint = hit.point
+        normal = hit.normal
+        # Fresnal
+        R0 = self.getReflectance(nearestObject)
+        RTheta = self.schlick(R0, self.getBetweenAngle(ray.direction, normal))
+        # Textures and noise replace what reflects and refracts here
+        if nearestObject.getImage() is not None or \
+           nearestObject.getNoiseFunction() is not None:
+            weight = 0
         # Reflect if it's reflective
-        reflectionRay = Ray(surfaceHitPoint,
-                            self.getReflectionVector(ray.direction,
-                                                     normal))
+        reflectionRay = Ray.trusted(surfaceHitPoint,
+                                    self.getReflectionVector(ray.direction,
+                                                             normal))
         reflectiveColor = self.recur(reflectionRay,
                                      nearestObject.getReflective(),
-                                     recursionCount)
+                                     recursionCount,
+                                     weight * (1 - RTheta))
         # Refractive stuff
         exitOrEnterCheck = np.dot(ray.direction, normal)
         # Entering
@@ -179,13 +557,16 @@ class RayTracer(ProgressiveRenderer):
                                                          normal,
                                                          ratio))
             oppSide = refractiveRay.getPositionAt(nearestObject.getDistance())
+            if self.rayLog is not None:
+                self.rayLog.recordSegment(surfaceHitPoint, oppSide)
             exitingRay = Ray(oppSide,
                              self.getRefractiveVector(refractiveRay.direction,
                                                       normal,
                                                       ratio))
             refractiveColor = self.recur(exitingRay,
                                          nearestObject.getRefractiveIndex(),
-                                         recursionCount)
+                                         recursionCount,
+                                         weight * RTheta)
         # Exiting
         elif exitOrEnterCheck > 0 and nearestObject.getRefractiveIndex() != 0:
             ratio = self.snellsLaw(external=nearestObject)
@@ -194,56 +575,165 @@ class RayTracer(ProgressiveRenderer):
                                                          ratio),
                                 -ray.direction)
             oppSide = refractiveRay.getPositionAt(nearestObject.getDistance())
+            if self.rayLog is not None:
+                self.rayLog.recordSegment(surfaceHitPoint, oppSide)
             exitingRay = Ray(oppSide,
                              self.getRefractiveVector(refractiveRay.direction,
                                                       normal,
                                                       ratio))
             refractiveColor = self.recur(exitingRay,
                                          nearestObject.getRefractiveIndex(),
-                                         recursionCount)
+                                         recursionCount,
+                                         weight * RTheta)
         else:
-            refractiveColor = vec(1, 1, 1)
-        # Fresnal
-        R0 = self.getReflectance(nearestObject)
-        RTheta = self.schlick(R0, self.getBetweenAngle(ray.direction, normal))
+            refractiveColor = NO_REFRACTION
         # TODO Do i normlize this?
         reflectAndRefractColor = normalize(lerp(reflectiveColor,
                                                 refractiveColor,
                                                 RTheta))
-        color = color + reflectAndRefractColor
+        # Shaded in place from here on
+        color = self.getScratch(recursionCount)
         if nearestObject.getImage() is not None:
-            color = self.returnImage(nearestObject, surfaceHitPoint)
+            color[:] = self.returnImage(hit)
         # use the noise function if we got one
         elif nearestObject.getNoiseFunction() is not None:
-            color = nearestObject.getNoiseFunction()(surfaceHitPoint[X],
-                                                     surfaceHitPoint[Y],
-                                                     surfaceHitPoint[Z])
+            color[:] = nearestObject.getNoiseFunction()(surfaceHitPoint[X],
+                                                        surfaceHitPoint[Y],
+                                                        surfaceHitPoint[Z])
         else:
             # Start with base color of object + ambient difference
-            color = color + nearestObject.getBaseColor() - \
-                nearestObject.getAmbient()  # 07 Slides, Slide 16
+            color[:] = reflectAndRefractColor
+            color += nearestObject.getBaseColor()
+            color -= nearestObject.getAmbient()  # 07 Slides, Slide 16
+        if recursionCount == 0 and self.gBufferPixel is not None:
+            self.gBuffer.store(self.gBufferPixel,
+                               self.scene.objects.index(
+                                   nearestObject.getOwner()),
+                               hit.distance,
+                               surfaceHitPoint,
+                               normal,
+                               hit.uv,
+                               nearestObject.getMaterial(),
+                               color,
+                               ray.direction,
+                               # Only what secondary rays brought back
+                               # depends on the lights elsewhere
+                               reflectiveColor is not NO_COLOR or
+                               (refractiveColor is not NO_COLOR and
+                                refractiveColor is not NO_REFRACTION))
+        return self.shade(ray, nearestObject, surfaceHitPoint, normal, color)
+
+    def getLightContribution(self, ray, light, nearestObject,
+                             surfaceHitPoint, normal, color):
+        """Returns the diffuse and specular color one light adds to the
+           point we hit, or nothing if something blocks the light
+           before it reaches the point."""
+        vectorToLight = light.getVectorToLight(surfaceHitPoint)
+        lightDistance = light.getDistance(surfaceHitPoint)
+        shadowRay = Ray(surfaceHitPoint, vectorToLight)
+        _, shadowDist = self.findOccluder(shadowRay, light, nearestObject,
+                                          lightDistance)
+        if self.rayLog is not None:
+            self.rayLog.record(shadowRay, min(shadowDist, lightDistance))
+        if shadowDist < lightDistance:
+            return NO_COLOR
+        # 07 Slides, Slide 16
+        return light.getIntensity(surfaceHitPoint) * (
+            color * self.getDiffuse(vectorToLight, normal) +
+            self.getSpecularColor(self.getSpecularAngle(vectorToLight,
+                                                        normal,
+                                                        ray,
+                                                        nearestObject),
+                                  nearestObject.getSpecular()))
+
+    def shadeManyLights(self, ray, nearestObject, surfaceHitPoint, normal,
+                        color):
+        """Adds the light of each light to the ambient color.
+           With lightSamples above 0 only that many point lights are
+           shaded, picked from the light tree and weighted by how likely
+           they were to be picked, which averages out to the full sum."""
+        if self.lightTree is None:
+            self.lightTree = LightTree(self.scene.lights)
+        sampled = self.lightSamples > 0 and self.lightTree.root is not None
+        lights = self.lightTree.otherLights if sampled else self.scene.lights
+        total = np.array(nearestObject.getAmbient(), dtype=float)
+        for light in lights:
+            total += self.getLightContribution(ray, light, nearestObject,
+                                               surfaceHitPoint, normal, color)
+        if sampled:
+            for _ in range(self.lightSamples):
+                light, probability = self.lightTree.sample(surfaceHitPoint,
+                                                           self.random)
+                total += self.getLightContribution(
+                    ray, light, nearestObject, surfaceHitPoint, normal,
+                    color) / (probability * self.lightSamples)
+        return total
+
+    def shade(self, ray, nearestObject, surfaceHitPoint, normal, color):
+        """Applies shadows and Phong shading from every light
+           to the unlit surface color of the point we hit, which the
+           classic loop shades in place."""
+        if self.lightSamples is not None:
+            return self.shadeManyLights(ray, nearestObject, surfaceHitPoint,
+                                        normal, color)
         for light in self.scene.lights:
             vectorToLight = light.getVectorToLight(surfaceHitPoint)
             # Check if shadowed
-            shadowedObject, _ = self.scene.nearestObject(Ray(
-                                                             surfaceHitPoint,
-                                                             vectorToLight),
-                                                         nearestObject)
+            shadowRay = Ray(surfaceHitPoint, vectorToLight)
+            shadowedObject, shadowDist = self.findOccluder(
+                shadowRay, light, nearestObject)
+            if self.rayLog is not None:
+                self.rayLog.record(shadowRay, shadowDist)
             if shadowedObject is not None:
                 return nearestObject.getAmbient()
             # 07 Slides, Slide 16
-            color = color * \
-                self.getDiffuse(vectorToLight, normal) + \
-                nearestObject.getAmbient() + \
-                self.getSpecularColor(self.getSpecularAngle(  # Slide 23
-                                                            vectorToLight,
-                                                            normal,
-                                                            ray,
-                                                            nearestObject),
-                                      nearestObject.getSpecular())
+            color *= self.getDiffuse(vectorToLight, normal)
+            color += nearestObject.getAmbient()
+            color += self.getSpecularColor(
+                self.getSpecularAngle(vectorToLight,  # Slide 23
+                                      normal,
+                                      ray,
+                                      nearestObject),
+                nearestObject.getSpecular())
+        return color
+
+    def getSample(self, x, y, dx, dy):
+        """Returns the color of one sample at offset (dx, dy)
+           within the pixel."""
+        first = (dx, dy) == (0.5, 0.5)
+        if self.rayLog is not None:
+            # Every sample's rays are logged under the pixel
+            if first:
+                self.rayLog.begin((x, y))
+            else:
+                self.rayLog.resume((x, y))
+        if self.gBuffer is not None and first:
+            # The first, centered sample of accumulated pixels is captured
+            self.gBuffer.clear((x, y))
+            self.gBufferPixel = (x, y)
+        cameraRay = self.scene.camera.getRay((x + dx) / self.width,
+                                             (y + dy) / self.height)
+        # Fixing any NaNs in numpy, clipping to 0, 1.
+        color = np.nan_to_num(np.clip(self.getColorR(cameraRay, 0), 0, 1), 0)
+        self.gBufferPixel = None
+        if self.rayLog is not None:
+            self.rayLog.end()
+        return color
+
+    def addSample(self, x, y):
+        color = super().addSample(x, y)
+        if self.rayLog is not None:
+            self.framebuffer[x, y] = color
         return color
 
     def getColor(self, x, y, samplePerPixel=1):
+        if self.rayLog is not None:
+            self.rayLog.begin((x, y))
+        if self.gBuffer is not None and \
+           x < self.width and y < self.height:
+            # Only the first sample of each pixel is captured
+            self.gBuffer.clear((x, y))
+            self.gBufferPixel = (x, y)
         totalColor = np.zeros(3)
         for i in range(samplePerPixel ** 2):
             # Hit the center of the pixel
@@ -256,6 +746,10 @@ class RayTracer(ProgressiveRenderer):
             # Fixing any NaNs in numpy, clipping to 0, 1.
             totalColor = totalColor + np.nan_to_num(np.clip(
                 self.getColorR(cameraRay, 0), 0, 1), 0)
+            self.gBufferPixel = None
+        if self.rayLog is not None:
+            self.rayLog.end()
+            self.framebuffer[x, y] = totalColor / (samplePerPixel ** 2)
         return totalColor / (samplePerPixel ** 2)
 
 
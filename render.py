@@ -16,6 +16,11 @@ from enum import Enum
 from abc import ABC, abstractmethod
 import argparse
 
+from modules.utils.files import atomicWrite
+from modules.utils.allocations import TRACK_EVERY, AllocationTracker
+from modules.utils.traversal import TRAVERSALS, traversalOrder, \
+    touchesRegion, parseRegion
+
 
 SHOW_TYPES_STRINGS = ("PerPixel",
                       "PerColumn",
@@ -25,6 +30,34 @@ SHOW_TYPES_STRINGS = ("PerPixel",
 
 FILE_EXTENSIONS = (".png", ".jpg")
 
+CHECKPOINT_INTERVAL = 60
+# Coarse passes to measure throughput on before the budget is planned
+BUDGET_START_PIXEL_SIZE = 64
+# Passes this fine or finer count as a useful preview
+PREVIEW_PIXEL_SIZE = 8
+# Times per second the window is redrawn and input is handled
+REFRESH_RATE = 30
+
+
+def halton(index, base):
+    """Returns the index-th value of the Halton sequence in base."""
+    result = 0
+    fraction = 1 / base
+    while index > 0:
+        result += fraction * (index % base)
+        index //= base
+        fraction /= base
+    return result
+
+
+def sampleOffset(index):
+    """Returns the (dx, dy) offset within a pixel of sample index.
+       The first sample is the center of the pixel, and the rest
+       spread evenly over it."""
+    if index == 0:
+        return 0.5, 0.5
+    return halton(index, 2), halton(index, 3)
+
 
 class ShowTypes(Enum):
     """Control for how the progressive pixel renderer shows images.
@@ -50,7 +83,42 @@ class ProgressiveRenderer(ABC):
         parser.add_argument("-sh", "--show", help="Show")
         parser.add_argument("-s", "--sample", help="Sample", type=int)
         parser.add_argument("-f", "--file", help="File")
+        parser.add_argument("-c", "--checkpoint", help="Checkpoint file")
+        parser.add_argument("--checkpoint-interval",
+                            help="Seconds between checkpoints",
+                            type=float, default=CHECKPOINT_INTERVAL)
+        parser.add_argument("--resume", help="Resume from the checkpoint",
+                            action="store_true")
+        parser.add_argument("-a", "--accumulate",
+                            help="Add one sample per pixel per pass",
+                            action="store_true")
+        parser.add_argument("-t", "--time-budget",
+                            help="Seconds the render must finish in",
+                            type=float)
+        parser.add_argument("-o", "--order", help="Traversal order",
+                            choices=TRAVERSALS, default="scanline")
+        parser.add_argument("--roi", help="Region of interest x0,y0,x1,y1",
+                            type=parseRegion)
+        parser.add_argument("--region",
+                            help="Only trace the pixels x0,y0,x1,y1",
+                            type=parseRegion)
+        parser.add_argument("--composite",
+                            help="Earlier full render to put the region "
+                                 "into")
+        parser.add_argument("--track-allocations",
+                            help="Count the allocations of one pixel in "
+                                 "every this many",
+                            type=int, nargs="?", const=TRACK_EVERY)
+        parser.add_argument("--allocation-report",
+                            help="Save the allocation counts to this file")
+        parser.add_argument("--compare-allocations",
+                            help="Compare allocation counts with this file")
+        cls.addArguments(parser)
         args = parser.parse_args()
+        if args.resume and args.checkpoint is None:
+            raise Exception("--resume needs a -c checkpoint file.")
+        if args.composite is not None and args.region is None:
+            raise Exception("--composite needs a --region.")
         fileName = args.file
         if fileName is not None:
             if (not (fileName[-4:] in FILE_EXTENSIONS)):
@@ -71,13 +139,56 @@ class ProgressiveRenderer(ABC):
         cls.renderer = cls(show=show,
                            samplePerPixel=sample,
                            file=fileName)
+        cls.renderer.setCheckpoint(args.checkpoint,
+                                   args.checkpoint_interval,
+                                   args.resume)
+        cls.renderer.accumulate = args.accumulate
+        cls.renderer.setTraversal(args.order, args.roi)
+        if args.region is not None:
+            cls.renderer.setRegion(args.region, args.composite)
+        if args.track_allocations is not None:
+            cls.renderer.trackAllocations(args.track_allocations,
+                                          args.allocation_report,
+                                          args.compare_allocations)
+        cls.renderer.applyArguments(args)
+        if args.time_budget is not None:
+            cls.renderer.setTimeBudget(args.time_budget)
         cls.renderer.startPygame(caption)
         cls.stepper = cls.renderer.render()
-        # Main loop
+        # Main loop, tracing between redraws of the window
         while cls.renderer.isRunning():
+            if cls.renderer.restartRequested:
+                cls.restart()
+            frameEnd = time.time() + 1 / cls.renderer.refreshRate
             # If the renderer has work to do, let it
-            if not cls.renderer.done:
+            while not cls.renderer.done and time.time() < frameEnd:
                 next(cls.stepper)
+            cls.renderer.refreshDisplay()
+            if cls.renderer.done:
+                cls.renderer.clock.tick(cls.renderer.refreshRate)
+        # Stopped early, so keep what we have to resume later
+        if not cls.renderer.done and cls.renderer.checkpointFile is not None:
+            cls.renderer.saveCheckpoint()
+
+    @classmethod
+    def addArguments(cls, parser):
+        """For adding command line arguments, override for new options"""
+        pass
+
+    def applyArguments(self, args):
+        """For applying arguments added by addArguments"""
+        pass
+
+    def reportStats(self):
+        """For printing statistics when a render completes, override
+           for renderers that collect them"""
+        pass
+
+    def postProcess(self):
+        """For filtering the framebuffer once a render completes,
+           override for renderers that do. Not counted in the render
+           time."""
+        pass
 
     @classmethod
     def restart(cls):
@@ -98,6 +209,8 @@ class ProgressiveRenderer(ABC):
         self.minimumPixel = minimumPixel
         self.screen = None
         self.fillColor = (64, 128, 255)
+        self.refreshRate = REFRESH_RATE
+        self.displayDirty = False
         if show is not None:
             self.show = show
         else:
@@ -112,6 +225,308 @@ class ProgressiveRenderer(ABC):
             self.fileName = file
         else:
             self.fileName = None
+        self.checkpointFile = None
+        self.checkpointInterval = CHECKPOINT_INTERVAL
+        self.resume = False
+        self.nextIndex = 0
+        self.traversal = "scanline"
+        self.regionOfInterest = None
+        # Only these pixels are traced, drawn over the background
+        self.region = None
+        self.background = None
+        self.previewTime = None
+        # Accumulate samplePerPixel ** 2 samples one pass at a time
+        self.accumulate = False
+        self.timeBudget = None
+        self.deadline = None
+        # What a time budget plans for this render, leaving the
+        # settings checkpoints must match alone
+        self.plannedMinimumPixel = minimumPixel
+        self.plannedSamples = samplePerPixel
+        self.allocationTracker = None
+        # Set by input handlers, the main loop restarts the render
+        self.restartRequested = False
+        self.restartPixelSize = None
+        self.keepImage = False
+        # Measured on the last finished pass
+        self.secondsPerSample = None
+
+    def setCheckpoint(self, checkpointFile, interval=CHECKPOINT_INTERVAL,
+                      resume=False):
+        """Periodically saves progress to checkpointFile, at most once
+           every interval seconds. If resume is set, the next render
+           continues from the progress saved there."""
+        self.checkpointFile = checkpointFile
+        self.checkpointInterval = interval
+        self.resume = resume
+
+    def requestRestart(self, pixelSize=None):
+        """Asks the main loop to restart the render, from pixelSize
+           instead of the start pixel size if given. Restarts from a
+           given pixel size draw over the image already shown instead
+           of clearing it."""
+        self.restartRequested = True
+        self.restartPixelSize = pixelSize
+
+    def trackAllocations(self, every=TRACK_EVERY, reportFile=None,
+                         compareFile=None):
+        """Counts the allocations of one pixel in every every, reported
+           when the render completes. The counts are saved to
+           reportFile, and compared with those in compareFile."""
+        self.allocationTracker = AllocationTracker(every)
+        self.allocationReportFile = reportFile
+        self.allocationCompareFile = compareFile
+        self.getColor = self.allocationTracker.wrap(self.getColor)
+        self.getSample = self.allocationTracker.wrap(self.getSample)
+
+    def reportAllocations(self):
+        """Prints, saves and compares the allocation counts."""
+        self.allocationTracker.report()
+        if self.allocationReportFile is not None:
+            self.allocationTracker.save(self.allocationReportFile)
+        if self.allocationCompareFile is not None:
+            self.allocationTracker.compare(self.allocationCompareFile)
+
+    def setTraversal(self, traversal, regionOfInterest=None):
+        """Sets the order pixels of each pass are visited in, one of
+           TRAVERSALS. A region of interest (x0, y0, x1, y1) in pixels
+           is visited first by the "roi" order, and is what the preview
+           time is measured on; otherwise the central quarter is."""
+        if traversal == "roi" and regionOfInterest is None:
+            raise Exception("The roi order needs a --roi region.")
+        self.traversal = traversal
+        self.regionOfInterest = regionOfInterest
+
+    def setRegion(self, region, composite=None):
+        """Traces only the pixels of the (x0, y0, x1, y1) region, with
+           the camera still framing the whole image, so the time taken
+           follows the region's area. The rest of the image is the
+           earlier full render in the composite file if given, and
+           otherwise left out of the saved file."""
+        x0, y0, x1, y1 = region
+        region = (max(x0, 0), max(y0, 0),
+                  min(x1, self.width), min(y1, self.height))
+        if region[0] >= region[2] or region[1] >= region[3]:
+            raise Exception(f"Region {(x0, y0, x1, y1)} is outside the "
+                            f"{self.width}x{self.height} image.")
+        self.region = region
+        self.background = None
+        if composite is not None:
+            self.background = pygame.surfarray.array3d(
+                pygame.image.load(composite))
+            if self.background.shape[:2] != (self.width, self.height):
+                raise Exception(f"{composite} is not "
+                                f"{self.width}x{self.height}.")
+
+    def getRegion(self):
+        """Returns the (x0, y0, x1, y1) pixels traced."""
+        return self.region or (0, 0, self.width, self.height)
+
+    def getRegionSlices(self):
+        """Returns the slices indexing the traced pixels of [x, y]
+           arrays."""
+        x0, y0, x1, y1 = self.getRegion()
+        return slice(x0, x1), slice(y0, y1)
+
+    def getPreviewRegion(self):
+        """Returns the (x0, y0, x1, y1) region a preview must cover."""
+        if self.regionOfInterest is not None:
+            return self.regionOfInterest
+        x0, y0, x1, y1 = self.getRegion()
+        width, height = x1 - x0, y1 - y0
+        return (x0 + width // 4, y0 + height // 4,
+                x1 - width // 4, y1 - height // 4)
+
+    def getPassGrid(self, pixelSize):
+        """Returns the columns and rows of pixelSize pixels a pass
+           traces, and the (column, row) of the first, on the grid of
+           the whole image."""
+        x0, y0, x1, y1 = self.getRegion()
+        first = (x0 // pixelSize, y0 // pixelSize)
+        return (-(-x1 // pixelSize) - first[0],
+                -(-y1 // pixelSize) - first[1], first)
+
+    def getPassOrder(self, pixelSize):
+        """Returns the (x, y) corners of every pixel of a pass,
+           in the order they are traced."""
+        columns, rows, first = self.getPassGrid(pixelSize)
+        regionOfInterest = None
+        if self.regionOfInterest is not None:
+            x0, y0, x1, y1 = self.regionOfInterest
+            dx, dy = first[0] * pixelSize, first[1] * pixelSize
+            regionOfInterest = (x0 - dx, y0 - dy, x1 - dx, y1 - dy)
+        cells = traversalOrder(self.traversal, columns, rows,
+                               pixelSize, regionOfInterest)
+        return (cells + first) * pixelSize
+
+    def getLastPreviewIndex(self, order):
+        """Returns the index in a pass order after which the preview
+           region is covered, or None if the pass is too coarse."""
+        if self.pixelSize > PREVIEW_PIXEL_SIZE:
+            return None
+        inside = np.nonzero(touchesRegion(order // self.pixelSize,
+                                          self.pixelSize,
+                                          self.getPreviewRegion()))[0]
+        return inside[-1] if len(inside) else None
+
+    def getSettings(self):
+        """Returns the settings a checkpoint must match to be resumed.
+           Accumulated renders may be resumed with more samples."""
+        return (self.width, self.height, self.minimumPixel,
+                self.accumulate,
+                0 if self.accumulate else self.samplePerPixel,
+                TRAVERSALS.index(self.traversal),
+                *(self.regionOfInterest or (-1, -1, -1, -1)),
+                *(self.region or ()))
+
+    def saveCheckpoint(self):
+        """Atomically writes the image, the current pixel size, how far
+           through the pass it is and any accumulated samples to the
+           checkpoint file."""
+        atomicWrite(self.checkpointFile,
+                    lambda file: np.savez(
+                        file,
+                        image=self.pixels,
+                        pixelSize=self.pixelSize,
+                        nextIndex=self.nextIndex,
+                        accumulation=self.accumulation,
+                        sampleCounts=self.sampleCounts,
+                        settings=self.getSettings(),
+                        **self.getCheckpointState()))
+        self.lastCheckpoint = time.time()
+
+    def loadCheckpoint(self):
+        """Restores the image, pixel size and accumulated samples from
+           the checkpoint file.
+           Returns how many pixels of the pass were already traced."""
+        with np.load(self.checkpointFile) as checkpoint:
+            if tuple(checkpoint["settings"]) != self.getSettings():
+                raise Exception("Checkpoint was made with different \
+render settings.")
+            self.pixels[:] = checkpoint["image"]
+            self.pixelSize = int(checkpoint["pixelSize"])
+            self.accumulation = checkpoint["accumulation"]
+            self.sampleCounts = checkpoint["sampleCounts"]
+            nextIndex = int(checkpoint["nextIndex"])
+            self.setCheckpointState(checkpoint)
+        print(f"Resuming at pixel size {self.pixelSize}, pixel {nextIndex}")
+        return nextIndex
+
+    def getCheckpointState(self):
+        """Returns {name: array} of anything else a renderer needs
+           saved to resume where it stopped.
+           Override to save more than the image and samples."""
+        return {}
+
+    def setCheckpointState(self, checkpoint):
+        """Restores what getCheckpointState saved in checkpoint."""
+        pass
+
+    def setTimeBudget(self, seconds):
+        """Makes the next render finish within seconds. Throughput is
+           measured on coarse passes, then the final pixel size, samples
+           per pixel and recursion depth are chosen to fit. The render
+           stops at the deadline regardless, which may leave the pass
+           it was on partly drawn over the one before. The samples per
+           pixel and recursion depth already set are the most the
+           budget will use."""
+        self.timeBudget = seconds
+        self.budgetMaxSamples = self.samplePerPixel
+        self.budgetMaxDepth = self.getRecursionDepth()
+        self.startPixelSize = max(self.startPixelSize,
+                                  BUDGET_START_PIXEL_SIZE)
+
+    def getRecursionDepth(self):
+        """Returns how deep secondary rays are followed, or None if
+           the renderer has no such setting. Override to let time
+           budgets trade depth for resolution."""
+        return None
+
+    def setRecursionDepth(self, depth):
+        """Sets how deep secondary rays are followed."""
+        pass
+
+    def pastDeadline(self):
+        """Returns True if the time budget has run out."""
+        return self.deadline is not None and time.time() > self.deadline
+
+    def getPassCost(self, pixelSize, secondsPerSample):
+        """Returns the estimated seconds of a pass at pixelSize with
+           one sample per pixel."""
+        columns, rows, _ = self.getPassGrid(pixelSize)
+        return columns * rows * secondsPerSample
+
+    def fitBudget(self, remaining, secondsPerSample):
+        """Returns the (final pixel size, samples per pixel) that the
+           passes from the current pixel size can reach in remaining
+           seconds."""
+        cost = 0
+        finalSize = self.pixelSize * 2
+        size = self.pixelSize
+        while size >= 1 and \
+                cost + (passCost := self.getPassCost(size,
+                                                     secondsPerSample)) \
+                <= remaining:
+            cost += passCost
+            finalSize = size
+            size //= 2
+        samples = 1
+        if finalSize == 1:
+            # Spend what is left on extra samples of the final pass
+            extra = (remaining - cost) / self.getPassCost(1,
+                                                          secondsPerSample)
+            samples = min(self.budgetMaxSamples, int(np.sqrt(1 + extra)))
+        return finalSize, samples
+
+    def planBudget(self, secondsPerSample):
+        """Chooses the final pixel size, samples per pixel and recursion
+           depth that fit in the rest of the time budget, given the
+           seconds per sample measured at the current depth."""
+        remaining = self.deadline - time.time()
+        depth = self.getRecursionDepth()
+        candidates = [None] if depth is None else \
+            range(self.budgetMaxDepth, -1, -1)
+        best = None
+        for candidate in candidates:
+            # Assume each level of recursion costs about the same
+            scale = 1 if depth is None else (candidate + 1) / (depth + 1)
+            finalSize, samples = self.fitBudget(remaining,
+                                                secondsPerSample * scale)
+            if best is None or finalSize < best[0]:
+                best = (finalSize, samples, candidate)
+            if finalSize == 1:
+                break
+        finalSize, samples, depth = best
+        self.plannedMinimumPixel = finalSize // 2
+        self.plannedSamples = samples
+        if depth is not None:
+            self.setRecursionDepth(depth)
+
+    def reportBudget(self, finestPixelSize, elapsed):
+        """Prints the quality reached within the time budget."""
+        depth = self.getRecursionDepth()
+        samples = int(self.sampleCounts[self.getRegionSlices()].min()) \
+            if self.accumulate else \
+            self.plannedSamples ** 2 if finestPixelSize == 1 else 1
+        print(f"Time budget of {self.timeBudget:.2f} seconds used "
+              f"{elapsed:.4f}: pixel size {finestPixelSize}, "
+              f"{samples} samples per pixel" +
+              ("" if depth is None else f", recursion depth {depth}"))
+
+    def getSample(self, x, y, dx, dy):
+        """Returns the color of one sample at offset (dx, dy) within
+           the pixel, in a np.array() between 0 and 1.
+           Override to support accumulation at new offsets."""
+        return self.getColor(x, y)
+
+    def addSample(self, x, y):
+        """Adds the next sample of a pixel to the accumulation buffer.
+           Returns the running average of the pixel."""
+        count = self.sampleCounts[x, y]
+        self.accumulation[x, y] += self.getSample(x, y,
+                                                  *sampleOffset(count))
+        self.sampleCounts[x, y] = count + 1
+        return self.accumulation[x, y] / (count + 1)
 
     @abstractmethod
     def getColor(self, x, y):
@@ -149,6 +564,7 @@ class ProgressiveRenderer(ABC):
         pygame.event.set_blocked(pg.KEYDOWN | pg.KEYUP)
         fname = input("File name?:  ")
         pygame.event.set_blocked(0)
+        self.uploadImage()
         pygame.image.save(self.image, os.path.join("images", fname))
 
     def startPygame(self, caption):
@@ -158,10 +574,12 @@ class ProgressiveRenderer(ABC):
 
         else:
             self.screen = None
-        # Create the image
+        # Create the image, traced into pixels and uploaded to display
         self.image = pygame.Surface((self.width,
                                      self.height))
-        self.image.fill(self.fillColor)
+        self.pixels = np.empty((self.width, self.height, 3), dtype=np.uint8)
+        self.pixels[:] = self.fillColor
+        self.uploadImage()
         # Prepare Game Objects
         self.clock = pygame.time.Clock()
         # Start rendering
@@ -172,59 +590,200 @@ class ProgressiveRenderer(ABC):
                not (self.done and self.show == ShowTypes.NoShow)
 
     def restartRender(self):
-        self.pixelSize = self.startPixelSize
+        self.pixelSize = self.restartPixelSize or self.startPixelSize
+        self.keepImage = self.restartPixelSize is not None
+        self.restartRequested = False
+        self.restartPixelSize = None
         self.done = False
+        self.nextIndex = 0
+        self.previewTime = None
+        self.accumulation = np.zeros((self.width, self.height, 3),
+                                     dtype=np.float32)
+        self.sampleCounts = np.zeros((self.width, self.height),
+                                     dtype=np.int32)
 
-    def showProgress(self, fps=60):
-        """Method to draw the background to the screen and flip."""
-        # Let the clock tick
-        self.clock.tick(fps)
-        if self.show != ShowTypes.NoShow:
+    def fillPixels(self, color, x, y, size):
+        """Fills a size by size square of the framebuffer, within the
+           region if only a region is traced."""
+        if self.region is None:
+            self.pixels[x:x + size, y:y + size] = color
+            return
+        x0, y0, x1, y1 = self.region
+        self.pixels[max(x, x0):min(x + size, x1),
+                    max(y, y0):min(y + size, y1)] = color
+
+    def getOutputImage(self):
+        """Returns the surface to save: the whole image, or only the
+           region if it was traced without a composite."""
+        if self.region is None or self.background is not None:
+            return self.image
+        x0, y0, x1, y1 = self.region
+        return self.image.subsurface((x0, y0, x1 - x0, y1 - y0))
+
+    def uploadImage(self):
+        """Copies the framebuffer into the image surface."""
+        pygame.surfarray.blit_array(self.image, self.pixels)
+
+    def showProgress(self):
+        """Marks the display as out of date. The main loop redraws it
+           at its own refresh rate, so showing never slows tracing."""
+        self.displayDirty = True
+
+    def refreshDisplay(self):
+        """Uploads the framebuffer and flips, if anything changed."""
+        if self.displayDirty and self.show != ShowTypes.NoShow:
+            self.uploadImage()
             # Draw background into screen and show
             self.screen.blit(self.image, (0, 0))
             pygame.display.flip()
+        self.displayDirty = False
 
     def render(self):
         """The main loop of rendering the image.
         Will create pixels of progressively smaller sizes. Stops rendering
         when the pixel size is 0."""
         startTime = time.time()
-        # First progress is to fill entire image with one color
-        color = self.getColor(0, 0)
-        self.image.fill(color, ((0, 0), (self.width, self.height)))
+        self.lastCheckpoint = startTime
+        self.plannedMinimumPixel = self.minimumPixel
+        self.plannedSamples = self.samplePerPixel
+        if self.timeBudget is not None:
+            self.deadline = startTime + self.timeBudget
+            if self.budgetMaxDepth is not None:
+                self.setRecursionDepth(self.budgetMaxDepth)
+        # Time spent tracing only, to plan a time budget with
+        traceSeconds = 0
+        tracedSamples = 0
+        # The first fill is one pixel covering the whole image
+        finestPixelSize = max(self.width, self.height)
+        startIndex = 0
+        if self.resume and os.path.isfile(self.checkpointFile):
+            startIndex = self.loadCheckpoint()
+            finestPixelSize = self.pixelSize * 2
+            self.resume = False
+        elif self.keepImage:
+            finestPixelSize = self.pixelSize * 2
+        elif self.region is not None:
+            # Only the region is filled, over the earlier render if any
+            if self.background is not None:
+                self.pixels[:] = self.background
+            x0, y0, x1, y1 = self.region
+            self.fillPixels(self.getColor(x0, y0), x0, y0,
+                            max(x1 - x0, y1 - y0))
+        else:
+            # First progress is to fill entire image with one color
+            color = self.getColor(0, 0)
+            self.pixels[:] = color
         # Show the progress
         self.showProgress()
         yield
         # Until the pixel size gets too small
-        while self.pixelSize > self.minimumPixel:
+        while self.pixelSize > self.plannedMinimumPixel:
             print(f"Pixel Size: {self.pixelSize:3}")
+            order = self.getPassOrder(self.pixelSize)
+            # Shown and checkpointed every column's worth of pixels
+            _, rows, _ = self.getPassGrid(self.pixelSize)
+            lastPreviewIndex = self.getLastPreviewIndex(order)
             # For each pixel in the image, jumping by pixel size
-            for x in range(0, self.width, self.pixelSize):
-                for y in range(0, self.height, self.pixelSize):
-                    # Get color
-                    # Only anti-alias if down to 1 pixel
-                    color = self.getColor(x, y, 1) * 255 if \
-                        self.pixelSize > 1 else \
-                        self.getColor(x, y, self.samplePerPixel) * 255
-                    self.image.fill(color, ((x, y), (self.pixelSize,
-                                                     self.pixelSize)))
-                    if self.show == ShowTypes.PerPixel:
-                        self.showProgress(256 * 60 // self.pixelSize)
-                    yield
+            for index in range(startIndex, len(order)):
+                x, y = map(int, order[index])
+                # Get color
+                # Only anti-alias if down to 1 pixel
+                traceStart = time.time()
+                if self.pixelSize > 1:
+                    color = self.getColor(x, y, 1) * 255
+                elif self.accumulate:
+                    color = self.addSample(x, y) * 255
+                else:
+                    color = self.getColor(x, y, self.plannedSamples) * 255
+                traceSeconds += time.time() - traceStart
+                tracedSamples += 1 if self.pixelSize > 1 or \
+                    self.accumulate else self.plannedSamples ** 2
+                self.fillPixels(color, x, y, self.pixelSize)
+                # Where a checkpoint resumes, so nothing is traced twice
+                self.nextIndex = index + 1
+                if index == lastPreviewIndex and self.previewTime is None:
+                    self.previewTime = time.time() - startTime
+                if self.show == ShowTypes.PerPixel:
+                    self.showProgress()
+                yield
+                if (index + 1) % rows != 0 and index + 1 != len(order) \
+                   and not self.pastDeadline():
+                    continue
                 if self.show == ShowTypes.PerColumn:
-                    self.showProgress(60)
+                    self.showProgress()
+                if self.pastDeadline():
+                    break
+                if self.checkpointFile is not None and \
+                   time.time() - self.lastCheckpoint > \
+                   self.checkpointInterval:
+                    self.saveCheckpoint()
+            if self.pastDeadline():
+                break
+            finestPixelSize = self.pixelSize
             # Reduce pixel size
+            startIndex = 0
+            self.nextIndex = 0
             self.pixelSize //= 2
             if self.show == ShowTypes.PerImage:
-                self.showProgress(30)
+                self.showProgress()
+            if tracedSamples > 0:
+                self.secondsPerSample = traceSeconds / tracedSamples
+            if self.timeBudget is not None and tracedSamples > 0:
+                self.planBudget(self.secondsPerSample)
+        # Keep adding one sample per pixel until all are taken
+        regionSlices = self.getRegionSlices()
+        while self.accumulate and not self.pastDeadline() and \
+                (samples := self.sampleCounts[regionSlices].min()) < \
+                self.plannedSamples ** 2:
+            print(f"Samples: {samples + 1:3}")
+            order = self.getPassOrder(1)
+            _, rows, _ = self.getPassGrid(1)
+            for index, (x, y) in enumerate(order.tolist()):
+                # Already sampled before being resumed
+                if self.sampleCounts[x, y] <= samples:
+                    color = self.addSample(x, y) * 255
+                    self.fillPixels(color, x, y, 1)
+                    if self.show == ShowTypes.PerPixel:
+                        self.showProgress()
+                    yield
+                if (index + 1) % rows != 0 and \
+                   index + 1 != len(order) and not self.pastDeadline():
+                    continue
+                if self.show == ShowTypes.PerColumn:
+                    self.showProgress()
+                if self.pastDeadline():
+                    break
+                if self.checkpointFile is not None and \
+                   time.time() - self.lastCheckpoint > \
+                   self.checkpointInterval:
+                    self.saveCheckpoint()
+            if self.show == ShowTypes.PerImage:
+                self.showProgress()
         # Done rendering
         self.done = True
+        # Accumulated samples are kept so more can be added later
+        if self.checkpointFile is not None and self.accumulate:
+            self.saveCheckpoint()
+        elif self.checkpointFile is not None and \
+                os.path.isfile(self.checkpointFile):
+            os.remove(self.checkpointFile)
         endTime = time.time()
+        self.postProcess()
+        self.uploadImage()
         print()
         print(f"Completed in {(endTime - startTime):.4f} seconds", flush=True)
+        if self.timeBudget is not None:
+            self.reportBudget(finestPixelSize, endTime - startTime)
+        if self.previewTime is not None:
+            print(f"Preview of {self.getPreviewRegion()} at pixel size "
+                  f"{PREVIEW_PIXEL_SIZE} or finer in "
+                  f"{self.previewTime:.4f} seconds")
+        self.reportStats()
+        if self.allocationTracker is not None:
+            self.reportAllocations()
         if self.show == ShowTypes.FinalShow:
-            self.showProgress(30)
-        elif self.show == ShowTypes.NoShow:
-            pygame.image.save(self.image,
+            self.showProgress()
+        elif self.show == ShowTypes.NoShow and self.fileName is not None:
+            pygame.image.save(self.getOutputImage(),
                               os.path.join("images", self.fileName))
         yield
@@ -0,0 +1,348 @@
+"""
+Long-running local render service.
+
+Keeps a pool of warm worker processes that have already imported pygame
+and NumPy, loaded the scene textures and built the noise patterns, and
+accepts render jobs as JSON lines over a UNIX socket (or localhost TCP).
+Jobs are queued by priority, can be cancelled, and stream back their
+progress and finished image to the connection that submitted them.
+
+To Run:
+    python3 renderServer.py serve -w 4
+    python3 renderServer.py submit --width 64 --height 48 -o out.png
+"""
+import os
+import io
+import sys
+import json
+import time
+import queue
+import base64
+import asyncio
+import argparse
+import importlib
+import itertools
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+
+SOCKET_PATH = "/tmp/pyraytracer.sock"
+# Jobs may only write their images in here
+IMAGE_FOLDER = "images"
+DEFAULT_SCENE = "modules.raytracing.scene:Scene"
+# Scenes clients may ask for, as module:Class
+SCENES = (DEFAULT_SCENE,)
+PROGRESS_INTERVAL = 0.5
+CANCEL_CHECK_STEPS = 64
+
+# Filled once per worker process by warmUp
+WORKER_TRACERS = {}
+
+
+def warmUp():
+    """Imports the renderer in a worker so the first job doesn't pay
+       for pygame, NumPy, texture loading or noise generation."""
+    os.environ.setdefault("SDL_VIDEODRIVER", "dummy")
+    import pygame
+    pygame.init()
+    import rayTracer  # noqa: F401 loads textures and noise patterns
+
+
+def getTracer(sceneName, width, height, samples):
+    """Returns a cached tracer for the scene and render parameters,
+       building it on first use in this worker."""
+    from rayTracer import RayTracer
+    from render import ShowTypes
+    key = (sceneName, width, height, samples)
+    if key not in WORKER_TRACERS:
+        moduleName, className = sceneName.split(":")
+        sceneClass = getattr(importlib.import_module(moduleName), className)
+        tracer = RayTracer(width, height,
+                           show=ShowTypes.NoShow,
+                           samplePerPixel=samples,
+                           scene=sceneClass(aspect=width/height, fov=45))
+        tracer.startPygame("Render Server")
+        WORKER_TRACERS[key] = tracer
+    return WORKER_TRACERS[key]
+
+
+def renderJob(jobId, params, progress, cancelled):
+    """Renders one job in a worker process.
+       Posts (jobId, fraction) tuples to progress and stops early if
+       jobId shows up in cancelled.
+       Returns the PNG bytes of the image, or None if cancelled."""
+    import pygame
+    tracer = getTracer(params.get("scene", DEFAULT_SCENE),
+                       params.get("width", 64),
+                       params.get("height", 48),
+                       params.get("samples", 1))
+    tracer.restartRender()
+    totalSteps = tracer.width * tracer.height + 2
+    lastPost = time.time()
+    for step, _ in enumerate(tracer.render()):
+        if step % CANCEL_CHECK_STEPS == 0:
+            if jobId in cancelled:
+                return None
+            if time.time() - lastPost > PROGRESS_INTERVAL:
+                progress.put((jobId, step / totalSteps))
+                lastPost = time.time()
+    buffer = io.BytesIO()
+    pygame.image.save(tracer.image, buffer, "png")
+    return buffer.getvalue()
+
+
+class Job(object):
+    """A render job and everyone listening for its updates."""
+    def __init__(self, jobId, params, priority):
+        self.jobId = jobId
+        self.params = params
+        self.priority = priority
+        self.state = "queued"
+        self.listeners = []
+        self.submitted = time.time()
+
+    def notify(self, message):
+        """Sends a message about this job to every listener."""
+        message = dict(message, job=self.jobId)
+        line = (json.dumps(message) + "\n").encode()
+        for writer in self.listeners:
+            if not writer.is_closing():
+                writer.write(line)
+
+
+class RenderServer(object):
+    """Queues render jobs by priority and feeds them to warm workers."""
+    def __init__(self, workers=None, imageFolder=IMAGE_FOLDER):
+        self.workers = workers or os.cpu_count()
+        self.imageFolder = os.path.realpath(imageFolder)
+        self.jobs = {}
+        self.counter = itertools.count(1)
+        self.queue = None
+        self.tasks = []
+        self.stopping = False
+        self.manager = multiprocessing.Manager()
+        self.progress = self.manager.Queue()
+        self.cancelled = self.manager.dict()
+        self.pool = ProcessPoolExecutor(self.workers, initializer=warmUp)
+
+    async def serve(self, path=SOCKET_PATH, port=None):
+        """Serves forever on a UNIX socket, or on localhost if a
+           port is given."""
+        self.queue = asyncio.PriorityQueue()
+        if port is not None:
+            server = await asyncio.start_server(self.handleClient,
+                                                "127.0.0.1", port)
+            print(f"Serving on 127.0.0.1:{port}")
+        else:
+            if os.path.exists(path):
+                os.remove(path)
+            server = await asyncio.start_unix_server(self.handleClient,
+                                                     path)
+            print(f"Serving on {path}")
+        # Start every worker now instead of on the first job
+        for _ in range(self.workers):
+            self.pool.submit(time.sleep, 0)
+        self.tasks = [asyncio.create_task(self.dispatch())
+                      for _ in range(self.workers)]
+        self.tasks.append(asyncio.create_task(self.relayProgress()))
+        try:
+            async with server:
+                await server.serve_forever()
+        finally:
+            self.stopping = True
+            for task in self.tasks:
+                task.cancel()
+            self.pool.shutdown(wait=False, cancel_futures=True)
+
+    async def handleClient(self, reader, writer):
+        """Reads JSON line requests from one connection."""
+        while line := await reader.readline():
+            try:
+                request = json.loads(line)
+                reply = self.handleRequest(request, writer)
+            except (ValueError, KeyError, TypeError, AttributeError) as e:
+                reply = {"error": str(e)}
+            writer.write((json.dumps(reply) + "\n").encode())
+            await writer.drain()
+        for job in self.jobs.values():
+            if writer in job.listeners:
+                job.listeners.remove(writer)
+        writer.close()
+
+    def handleRequest(self, request, writer):
+        """Handles a submit, cancel or status request.
+           Returns the immediate reply."""
+        op = request["op"]
+        if op == "submit":
+            params = request.get("params", {})
+            if params.get("scene", DEFAULT_SCENE) not in SCENES:
+                raise ValueError(f"Unknown scene {params['scene']}")
+            if params.get("output") is not None:
+                params["output"] = self.getOutputPath(params["output"])
+            job = Job(next(self.counter), params,
+                      request.get("priority", 0))
+            job.listeners.append(writer)
+            self.jobs[job.jobId] = job
+            # Higher priorities first, then first come first served
+            self.queue.put_nowait((-job.priority, job.jobId))
+            return {"job": job.jobId, "state": job.state}
+        elif op == "cancel":
+            job = self.jobs[request["job"]]
+            if job.state in ("queued", "running"):
+                self.cancelled[job.jobId] = True
+                job.state = "cancelled"
+                job.notify({"state": job.state})
+            return {"job": job.jobId, "state": job.state}
+        elif op == "status":
+            return {"jobs": {jobId: job.state
+                             for jobId, job in self.jobs.items()},
+                    "queued": self.queue.qsize()}
+        raise ValueError(f"Unknown op {op}")
+
+    def getOutputPath(self, output):
+        """Returns where to write an output image, relative to the
+           image folder, refusing paths that lead outside it."""
+        path = os.path.realpath(os.path.join(self.imageFolder, output))
+        if os.path.commonpath((path, self.imageFolder)) != \
+           self.imageFolder or path == self.imageFolder:
+            raise ValueError(f"Output {output} is outside "
+                             f"{self.imageFolder}")
+        return path
+
+    async def dispatch(self):
+        """Hands queued jobs to a worker one at a time."""
+        loop = asyncio.get_running_loop()
+        while True:
+            _, jobId = await self.queue.get()
+            job = self.jobs[jobId]
+            if job.state == "cancelled":
+                continue
+            job.state = "running"
+            job.notify({"state": job.state})
+            startTime = time.time()
+            try:
+                image = await loop.run_in_executor(self.pool, renderJob,
+                                                   jobId, job.params,
+                                                   self.progress,
+                                                   self.cancelled)
+            except Exception as e:
+                job.state = "failed"
+                job.notify({"state": job.state, "error": repr(e)})
+                continue
+            if image is None:
+                continue
+            job.state = "done"
+            message = {"state": job.state,
+                       "seconds": round(time.time() - startTime, 4)}
+            output = job.params.get("output")
+            if output is not None:
+                os.makedirs(os.path.dirname(output), exist_ok=True)
+                with open(output, "wb") as file:
+                    file.write(image)
+                message["output"] = output
+            else:
+                message["image"] = base64.b64encode(image).decode()
+            job.notify(message)
+
+    def getProgress(self):
+        """Returns the next progress a worker posted, or None if there
+           was none for a progress interval."""
+        try:
+            return self.progress.get(timeout=PROGRESS_INTERVAL)
+        except queue.Empty:
+            return None
+
+    async def relayProgress(self):
+        """Forwards progress posted by workers to the job listeners.
+           Waits on the queue one interval at a time, so shutting down
+           never hangs on a thread blocked in it."""
+        loop = asyncio.get_running_loop()
+        while not self.stopping:
+            posted = await loop.run_in_executor(None, self.getProgress)
+            if posted is None:
+                continue
+            jobId, fraction = posted
+            job = self.jobs.get(jobId)
+            if job is not None and job.state == "running":
+                job.notify({"progress": round(fraction, 4)})
+
+
+async def submit(params, priority=0, path=SOCKET_PATH, port=None):
+    """Submits a job and prints its updates until it finishes.
+       Returns the final message."""
+    # Images can be far longer than the default line limit
+    if port is not None:
+        reader, writer = await asyncio.open_connection("127.0.0.1", port,
+                                                       limit=2 ** 30)
+    else:
+        reader, writer = await asyncio.open_unix_connection(path,
+                                                            limit=2 ** 30)
+    request = {"op": "submit", "params": params, "priority": priority}
+    writer.write((json.dumps(request) + "\n").encode())
+    message = {}
+    while line := await reader.readline():
+        message = json.loads(line)
+        if "image" in message:
+            print(f"Job {message['job']}: {message['state']}")
+        else:
+            print(message)
+        if "error" in message or \
+           message.get("state") in ("done", "cancelled", "failed"):
+            break
+    writer.close()
+    return message
+
+
+async def sendRequest(request, path=SOCKET_PATH, port=None):
+    """Sends a single request and returns the reply."""
+    if port is not None:
+        reader, writer = await asyncio.open_connection("127.0.0.1", port)
+    else:
+        reader, writer = await asyncio.open_unix_connection(path)
+    writer.write((json.dumps(request) + "\n").encode())
+    reply = json.loads(await reader.readline())
+    writer.close()
+    return reply
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("command", choices=("serve", "submit",
+                                            "cancel", "status"))
+    parser.add_argument("job", nargs="?", type=int, help="Job to cancel")
+    parser.add_argument("--socket", help="Socket", default=SOCKET_PATH)
+    parser.add_argument("--port", help="Port", type=int)
+    parser.add_argument("-w", "--workers", help="Workers", type=int)
+    parser.add_argument("--scene", help="Scene", choices=SCENES,
+                        default=DEFAULT_SCENE)
+    parser.add_argument("--width", help="Width", type=int, default=64)
+    parser.add_argument("--height", help="Height", type=int, default=48)
+    parser.add_argument("-s", "--sample", help="Sample", type=int, default=1)
+    parser.add_argument("-p", "--priority", help="Priority", type=int,
+                        default=0)
+    parser.add_argument("-o", "--output",
+                        help="Output, in the server's images folder")
+    args = parser.parse_args()
+    if args.command == "serve":
+        asyncio.run(RenderServer(args.workers).serve(args.socket,
+                                                     args.port))
+    elif args.command == "submit":
+        params = {"scene": args.scene,
+                  "width": args.width,
+                  "height": args.height,
+                  "samples": args.sample}
+        if args.output is not None:
+            params["output"] = args.output
+        message = asyncio.run(submit(params, args.priority,
+                                     args.socket, args.port))
+        if message.get("state") != "done":
+            sys.exit(1)
+    elif args.command == "cancel":
+        print(asyncio.run(sendRequest({"op": "cancel", "job": args.job},
+                                      args.socket, args.port)))
+    else:
+        print(asyncio.run(sendRequest({"op": "status"},
+                                      args.socket, args.port)))
+
+
+if __name__ == "__main__":
+    main()
@@ -4,8 +4,11 @@ import time
 import platform
 import psutil
 import argparse
+import numpy as np
 
 from render import ProgressiveRenderer, ShowTypes
+from quilt import ChunkWriter
+from modules.utils.traversal import parseRegion
 
 try:
     if platform.system() == "Windows":
@@ -56,6 +59,9 @@ class RQuiltRenderer(ProgressiveRenderer):
         parser.add_argument("-sh", "--show", help="Show")
         parser.add_argument("-s", "--sample", help="Sample", type=int)
         parser.add_argument("-f", "--file", help="File")
+        parser.add_argument("--region",
+                            help="Only trace the chunks over x0,y0,x1,y1",
+                            type=parseRegion)
         args = parser.parse_args()
         filename = args.file if args.file is not None else "quilt"
         if args.show is not None and args.show != "NoShow":
@@ -65,6 +71,8 @@ class RQuiltRenderer(ProgressiveRenderer):
         # Set up renderer
         cls.renderer = cls(samplePerPixel=sample,
                            file=filename)
+        if args.region is not None:
+            cls.renderer.setRegion(args.region)
         cls.renderer.startPygame(caption)
         cls.stepper = cls.renderer.render()
 
@@ -106,6 +114,14 @@ class RQuiltRenderer(ProgressiveRenderer):
         self.chunkEndX = x
         self.chunkEndY = y
 
+    def setRegion(self, region):
+        """Traces only the chunks over region, laid out from its corner
+           and cut off at its far edges."""
+        super().setRegion(region)
+        x0, y0, x1, y1 = self.region
+        self.setChunkStart(x0, y0)
+        self.setChunkEnd(x1, y1)
+
     def render(self):
         """The main loop of rendering the image.
         Will create pixels of progressively smaller sizes. Stops rendering
@@ -113,17 +129,22 @@ class RQuiltRenderer(ProgressiveRenderer):
         startTime = time.time()
         # First progress is to fill entire image with one color
         color = self.getColor(0, 0)
-        self.image.fill(color, ((0, 0), (self.width, self.height)))
+        self.pixels[:] = color
         info = open(os.path.join(self.quiltFolder, "info.txt"), "w")
         info.write(f"{self.width} {self.height}")
         info.close()
-        # For each pixel in the image, jumping by pixel size
-        for x in range(self.chunkEndX, self.chunkStartX, -self.chunkSize):
-            for y in range(self.chunkEndY, self.chunkStartY, -self.chunkSize):
-                chunkWidth = min(self.width + x, self.chunkSize)
-                chunkHeight = min(self.height + y, self.chunkSize)
-                chunkImage = pygame.Surface((chunkWidth,
-                                             chunkHeight))
+        writer = ChunkWriter(self.quiltFolder,
+                             displayUpdates=self.displayUpdates)
+        # For each chunk, from the last one back to the start
+        lastX = self.chunkStartX + (self.chunkEndX - self.chunkStartX - 1) \
+            // self.chunkSize * self.chunkSize
+        lastY = self.chunkStartY + (self.chunkEndY - self.chunkStartY - 1) \
+            // self.chunkSize * self.chunkSize
+        for x in range(lastX, self.chunkStartX - 1, -self.chunkSize):
+            for y in range(lastY, self.chunkStartY - 1, -self.chunkSize):
+                chunkWidth = min(self.chunkEndX - x, self.chunkSize)
+                chunkHeight = min(self.chunkEndY - y, self.chunkSize)
+                chunkColors = np.zeros((chunkWidth, chunkHeight, 3))
                 chunkFileName = f"{x}_{y}.png"
                 if self.displayUpdates:
                     print(f"{chunkFileName} starting.")
@@ -132,17 +153,17 @@ class RQuiltRenderer(ProgressiveRenderer):
                     print(f"{chunkFileName} already generated. Skipping.")
                     print("===============================")
                     continue
-                for ix in range(x, x+self.chunkSize):
-                    for iy in range(y, y+self.chunkSize):
+                for ix in range(x, x+chunkWidth):
+                    for iy in range(y, y+chunkHeight):
                         # Get color
-                        color = self.getColor(ix, iy, self.samplePerPixel) * \
-                                255
-                        chunkImage.fill(color, ((ix - x, iy - y), (1, 1)))
-                pygame.image.save(chunkImage, os.path.join(self.quiltFolder,
-                                                           chunkFileName))
+                        chunkColors[ix - x, iy - y] = \
+                            self.getColor(ix, iy, self.samplePerPixel)
+                # Saved in the background while the next chunk traces
+                writer.submit(chunkFileName, chunkColors)
                 if self.displayUpdates:
                     print(f"{chunkFileName} completed.")
                     print("===============================")
+        writer.close()
         # Done rendering
         self.done = True
         endTime = time.time()